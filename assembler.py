@@ -1,7 +1,18 @@
+import argparse
+import contextlib
+import copy
+import enum
+import functools
+import os
 import re
 import sys
 
+from build_cache import BuildCache, hash_key
+from machine_code_format import get_binary_path, write_machine_code_file
+
 NUMBER_OF_REGISTERS = 15
+ALLOCATABLE_REGISTERS = range(1, NUMBER_OF_REGISTERS)
+'''Registers the assembler can give constants and label addresses, R1 to R14. R15 is left to programs, and isn't assumed to hold any value.'''
 OPCODES = {
     "ADD":1,
     "SUB":2,
@@ -21,249 +32,165 @@ OPCODES = {
 }
 '''Dict of opcodes in the form "STR":opcode'''
 
-int_branch_labels = {}
-'''Dict of labels and their instruction cycle numbers.'''
-mem_cell_branch_labels = {}
-'''Dict of labels and their instruction memory cell number (integer).'''
+MACRO_OPCODES = ["MOVE", "MUL", "DIV", "MOD", "LSN", "RSN"]
+'''Opcodes of the macros that macro_expander expands into sequences of the opcodes above.'''
+
+Opcode = enum.IntEnum("Opcode", OPCODES)
+'''Machine opcodes as an enum, so that an instruction's opcode is parsed once and compared as a number.'''
 
-unused_registers = []
-'''Stores numbers of all unused registers.'''
-for i in range(1, NUMBER_OF_REGISTERS):
-    unused_registers.append(i)
+REGISTER_OPERAND = 0
+IMMEDIATE_OPERAND = 1
+VIRTUAL_OPERAND = 2
+LABEL_OPERAND = 3
+'''Kinds of operand, from the first character: R (register), # (immediate), V (virtual register of the register allocator), or a label.'''
 
-immediate_registers = {}
-'''Stores all registers that are written to only with LDIs before the first branch of the program. (All of them if there are no branches).
-These are the registers which are suitable to replace immediate operands, as the values in them won't change.
-key:value pairs are in the form, register number : RegisterInfo() instance
-'''
+ASSEMBLER_VERSION = 3
+'''Increase whenever a change to the assembler changes the machine code it produces, so that cached outputs are rebuilt.'''
 
-class RegisterInfo:
-    '''RegisterInfo : Class
+@functools.lru_cache(maxsize=None)
+def parse_operand(operand:str) -> tuple:
+    '''Returns (kind, value) of an operand string, where value is the integer after the first character, or None if there isn't one.
+    Programs only use a few distinct operands, so each one is only parsed once.
+    '''
+    kind = {"R": REGISTER_OPERAND, "#": IMMEDIATE_OPERAND, "V": VIRTUAL_OPERAND}.get(operand[0], LABEL_OPERAND)
+    try:
+        value = int(operand[1:])
+    except ValueError:
+        value = None
+    return (kind, value)
+
+class Instruction:
+    '''Instruction : Class
+    One line of a program, parsed once when the program is read so that passes don't have to re-parse strings.
+    Operands are kept as a tuple so that they can only be changed with set_operand(), which keeps kinds and values up to date.
 
     Attributes:
-    value:int -- value stored in register
-    cycle_last_written:int -- the instruction cycle in which the register was last written to
+    label:str -- label declared at the instruction, without the :, or None
+    opcode_str:str -- opcode as written, e.g. "ADD", or "BRZ" for the custom branches. Comment lines begin with //
+    opcode:int -- the Opcode of opcode_str, or -1 if it isn't one the CPU has
+    operands:tuple -- operand strings, e.g. ("R5", "R3", "#1")
+    kinds:tuple -- kind of each operand (REGISTER_OPERAND, IMMEDIATE_OPERAND, VIRTUAL_OPERAND or LABEL_OPERAND)
+    values:tuple -- integer value of each operand (see parse_operand), None for labels
+    line:int -- number of the source line the instruction came from (starting at 1), or None if a pass inserted it
     '''
-    def __init__(self, value:int=0, cycle_last_written:int=0):
-        self.value = value
-        self.cycle_last_written = cycle_last_written
-    
-    def __str__(self):
-        return f"Value: {self.value}, Cycle last written: {self.cycle_last_written}"
+    __slots__ = ("label", "opcode_str", "opcode", "operands", "kinds", "values", "line")
+
+    def __init__(self, opcode_str:str, operands:tuple=(), label:str=None, line:int=None):
+        self.label = label
+        self.line = line
+        self.opcode_str = sys.intern(opcode_str)
+        self.opcode = Opcode[opcode_str] if opcode_str in OPCODES else -1
+        self.set_operands(operands)
+
+    @classmethod
+    def from_parts(cls, parts:list):
+        '''Creates an instruction from a list of strings in the form [label:, opcode, operand 1, operand 2, etc.], the label being optional.'''
+        if parts[0][:2] != "//" and len(parts[0]) > 0 and parts[0][-1] == ":":
+            return cls(parts[1] if len(parts) > 1 else "", parts[2:], parts[0][:-1])
+        return cls(parts[0], parts[1:])
+
+    def set_operands(self, operands) -> None:
+        '''Replaces all of the operands.'''
+        self.operands = tuple(sys.intern(operand) for operand in operands)
+        parsed = [parse_operand(operand) for operand in self.operands]
+        self.kinds = tuple(kind for kind, value in parsed)
+        self.values = tuple(value for kind, value in parsed)
+
+    def set_operand(self, operand_index:int, operand:str) -> None:
+        '''Replaces one operand.'''
+        kind, value = parse_operand(operand)
+        self.operands = self.operands[:operand_index] + (sys.intern(operand),) + self.operands[operand_index + 1:]
+        self.kinds = self.kinds[:operand_index] + (kind,) + self.kinds[operand_index + 1:]
+        self.values = self.values[:operand_index] + (value,) + self.values[operand_index + 1:]
+
+    def is_comment(self) -> bool:
+        '''Returns True if the line is a comment.'''
+        return self.opcode_str[:2] == "//"
+
+    def to_parts(self) -> list:
+        '''Returns the instruction as a list of strings, in the form taken by from_parts().'''
+        parts = [self.opcode_str] + list(self.operands)
+        return [self.label + ":"] + parts if self.label is not None else parts
+
+    def copy(self):
+        '''Returns a copy that can be changed without changing this instruction.'''
+        copied = Instruction.__new__(Instruction)
+        copied.label, copied.opcode_str, copied.opcode = self.label, self.opcode_str, self.opcode
+        copied.operands, copied.kinds, copied.values = self.operands, self.kinds, self.values
+        copied.line = self.line
+        return copied
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo:dict):
+        return self.copy()
+
+    def __eq__(self, other):
+        #assembler.py run as a script also has its Instruction class in __main__, so any object with the same fields is compared
+        if not hasattr(other, "opcode_str"):
+            return NotImplemented
+        return self.label == other.label and self.opcode_str == other.opcode_str and self.operands == other.operands
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_parts())
+
+def to_instruction(instruction) -> Instruction:
+    '''Returns an Instruction, creating one if instruction is a list of strings (see Instruction.from_parts()).'''
+    return Instruction.from_parts(instruction) if isinstance(instruction, list) else instruction
+
+def parse_source(source:str) -> list:
+    '''Splits the text of a program into list of Instruction, one per line that isn't empty, recording the line number of each.'''
+    results = []
+    for line_number, line in enumerate(source.split("\n"), start=1):
+        if len(line) > 0:
+            parts = re.split(" |, ", line)
+            instruction = Instruction.from_parts(parts)
+            instruction.line = line_number
+            results.append(instruction)
+    return results
 
 def read_file_into_list(filename:str) -> list:
-    '''Reads file into list of instruction lists, each in the form [opcode, operand 1, operand 2, etc.]'''
-    results = []
+    '''Reads a program in the programs folder into list of Instruction.'''
     with open("programs/" + filename + ".txt", 'r') as input_file:
-        for line in input_file:
-            line = line[:-1] if line[-1] == '\n' else line
-            if len(line) > 0:
-                parts = re.split(" |, ", line)
-                results.append(parts)
-    return results
+        return parse_source(input_file.read())
 
-def begins_with_label(instruction:list) -> bool:
+def begins_with_label(instruction:Instruction) -> bool:
     '''Returns True if instruction begins with label, False otherwise'''
-    if str(instruction[0])[-1] == ':':
-        return True
-    else:
-        return False
+    return instruction.label is not None
 
-def get_opcode_str(instruction:list) -> int:
+def get_opcode_str(instruction:Instruction) -> str:
     '''Returns string version of instruction opcode.'''
-    opcode_str = instruction[1] if begins_with_label(instruction) else instruction[0]
-    return opcode_str
+    return instruction.opcode_str
 
-def get_opcode(instruction:list) -> int:
+def get_opcode(instruction:Instruction) -> int:
     '''Returns instruction opcode in integer form. Returns -1 if it is not a known opcode.'''
-    opcode_str = get_opcode_str(instruction)
-    try:
-        return OPCODES[opcode_str]
-    except:
-        return -1
+    return instruction.opcode
 
-def is_branch_instruction(instruction:list) -> bool:
+def is_branch_instruction(instruction:Instruction) -> bool:
     '''Returns True if instruction is a branch, False otherwise.'''
-    opcode_str = get_opcode_str(instruction)
-    if opcode_str[:2] == "BR":
-        return True
-    else:
-        return False
-
-def get_operands_start_index(instruction:list) -> int:
-    '''Returns index in the instruction list in which the operands start.'''
-    start_index = 2 if begins_with_label(instruction) else 1
-    return start_index
-
-def get_operands(instruction:list) -> list:
-    '''Returns list of instruction operands.'''
-    start_index = get_operands_start_index(instruction)
-    operands = instruction[start_index:]
-    return operands
+    return instruction.opcode_str[:2] == "BR"
+
+def get_operands(instruction:Instruction) -> tuple:
+    '''Returns tuple of instruction operands.'''
+    return instruction.operands
 
 def is_operand_immediate(operand:str) -> bool:
     '''Returns True if operand is immediate, False otherwise.'''
-    if operand[0] == '#':
-        return True
-    else:
-        return False
+    return operand[0] == '#'
 
 def get_operand_value(operand:str) -> int:
     '''Returns operand integer value by removing the 'R' or the '#' from the beginning.'''
-    value_str = operand[1:]
-    try:
-        return int(value_str)
-    except:
+    value = parse_operand(operand)[1]
+    if value is None:
         raise Exception("Operand must consist of an R or #, followed only by an integer.")
-
-def get_cycle_of_first_branch_or_label(instructions:list) -> int:
-    '''Returns instruction cycle of the first branch or label in the program. Returns -1 if there are none.'''
-    for instruction_cycle in range(len(instructions)):
-        instruction = instructions[instruction_cycle]
-        if begins_with_label(instruction) or is_branch_instruction(instruction):
-            return instruction_cycle
-
-    return -1
-
-def scan_for_immediate_registers(instructions:list) -> None:
-    '''Scans instructions for registers which are suitable for the immediate_registers dict, adding them.'''
-    instruction_cycle = 0
-    while instruction_cycle < len(instructions):
-        instruction = instructions[instruction_cycle]
-        opcode = get_opcode(instruction)
-
-        #if instruction is a write-back instruction, remove from unused_registers
-        if opcode >= OPCODES["ADD"] and opcode <= OPCODES["LDI"]:
-            operands = get_operands(instruction)
-            write_back_operand = operands[0]
-            #write-back reg must be a register, not an immediate value
-            if is_operand_immediate(write_back_operand):
-                raise Exception(f"i {instruction_cycle}, operand 0: must be a register.")
-            
-            write_back_reg_number = get_operand_value(write_back_operand)
-
-            if write_back_reg_number in unused_registers:
-                unused_registers.remove(write_back_reg_number)
-
-            first_branch_cycle = get_cycle_of_first_branch_or_label(instructions)
-
-            value = get_operand_value(operands[1])
-            #if write-back register exists in the immediate registers list
-            if write_back_reg_number in immediate_registers.keys():
-                if opcode == OPCODES["LDI"]:
-                    #if instruction past the first branch, remove from immediate registers list
-                    if (first_branch_cycle > -1 and instruction_cycle >= first_branch_cycle):
-                        immediate_registers.pop(write_back_reg_number)
-                    #if instruction before first branch, or if there are no branches, update RegisterInfo
-                    else:
-                        reg_info = immediate_registers[write_back_reg_number]
-                        reg_info.value = value
-                        reg_info.cycle_last_written = instruction_cycle
-                #if instruction not an LDI, remove from immediate registers list
-                else:
-                    immediate_registers.pop(write_back_reg_number)
-            #if write-back register not in immediate registers list, and instruction is an LDI, add to list
-            elif opcode == OPCODES["LDI"]:
-                reg_info = RegisterInfo(value=value, cycle_last_written=instruction_cycle)
-                immediate_registers[write_back_reg_number] = reg_info
-            
-        instruction_cycle += 1
-
-def remove_zero_ldis(instructions:list) -> None:
-    '''Removes any redundant #0 LDIs, excluding multiple-write registers or instructions with a label.'''
-    instruction_cycle = 0
-    while instruction_cycle < len(instructions):
-        instruction = instructions[instruction_cycle]
-        opcode = get_opcode(instruction)
-        operands = get_operands(instruction)
-        
-        #remove any LDI #0 instructions that are in immediate_registers, as they are redundant
-        if opcode == OPCODES["LDI"] and not begins_with_label(instruction):
-            value = get_operand_value(operands[1])
-            if value == 0:
-                write_back_reg_number = get_operand_value(operands[0])
-                if write_back_reg_number in immediate_registers.keys():
-                    immediate_registers[write_back_reg_number].cycle_last_written = 0
-                    instructions.remove(instruction)
-                    instruction_cycle -= 1
-        
-        instruction_cycle += 1
-
-def find_existing_immediate_register(immediate_value:int, instruction_cycle:int) -> int:
-    '''Given immediate_value, returns register number of immediate register holding that value.
-    Register is only suitable if it was last written to before the given instruction cycle.
-    Returns -1 if no such register exists.
-    '''
-    for reg_num in immediate_registers.keys():
-        register_info = immediate_registers[reg_num]
-        if register_info.value == immediate_value:
-            if register_info.cycle_last_written < instruction_cycle:
-                return reg_num
-    return -1
+    return value
 
 def replace_operand(instructions:list, instr_cycle:int, op_index:int, new_value:str) -> None:
     '''Replaces operand at given location with new_value.'''
-    start_index = get_operands_start_index(instructions[instr_cycle])
-    instructions[instr_cycle][start_index+op_index] = new_value
-
-def increment_last_writtens() -> None:
-    '''Increments cycle_last_written values in all existing immediate_register objects.
-    Used for when a new LDI is added, incrementing all instruction indexes.
-    '''
-    for reg_num in immediate_registers.keys():
-        reg_info = immediate_registers[reg_num]
-        reg_info.cycle_last_written = reg_info.cycle_last_written + 1
-
-def create_new_ldi(instructions:list, immediate_value:int) -> int:
-    '''Adds a new LDI operation to the beginning of the instructions, loading in immediate_value.
-    Finds unused register for LDI, removes it from unused_registers and adds it to immediate_registers.
-    Returns register number used.
-    '''
-    if len(unused_registers) < 1:
-        raise Exception("Run out of registers to use.")
-    #get unused register, remove it from list
-    register = unused_registers[-1]
-    unused_registers.pop()
-
-    #define new RegisterInfo() instance for placing into immediate_registers
-    reg_info = RegisterInfo(value=immediate_value, cycle_last_written=0)
-    #an LDI is unnecessary for a #0
-    if immediate_value != 0:
-        #increment cycle_last_written values in immediate_registers
-        increment_last_writtens()
-        #create new instruction and add to beginning of instructions list
-        instruction = ["LDI", f"R{register}", f"#{immediate_value}"]
-        instructions.insert(0, instruction)
-    immediate_registers[register] = reg_info
-
-    return register
-
-def convert_immediate_operands(instructions:list) -> None:
-    '''Converts any immediate operands not in an LDI operation, by either using an existing immediate register, or creating a new LDI operation.'''
-    instruction_cycle = 0
-    while instruction_cycle < len(instructions):
-        instruction = instructions[instruction_cycle]
-        opcode = get_opcode(instruction)
-        operands = get_operands(instruction)
-
-        #if instruction is not allowed an immediate operand, convert it
-        if opcode != OPCODES["LDI"]:
-            for operand_index in range(len(operands)):
-                operand = operands[operand_index]
-                if is_operand_immediate(operand):
-                    operand_value = get_operand_value(operand)
-                    #if there is an existing suitable register with that value, replace with that
-                    register_num = find_existing_immediate_register(immediate_value=operand_value, instruction_cycle=instruction_cycle)
-                    #if no suitable register exists, create new LDI instruction
-                    if register_num == -1:
-                        register_num = create_new_ldi(instructions=instructions, immediate_value=operand_value)
-                        if operand_value != 0:
-                            instruction_cycle += 1
-                    
-                    #replace the operand with the relevant register number
-                    replace_operand(instructions=instructions, instr_cycle=instruction_cycle, op_index=operand_index, new_value=f"R{register_num}")
-
-        instruction_cycle += 1
+    instructions[instr_cycle].set_operand(op_index, new_value)
 
 def replace_instruction(instructions:list, instr_cycle:int, new_instruction:list) -> None:
     '''Replaces instruction at specified cycle.'''
@@ -277,23 +204,21 @@ def convert_custom_branches(instructions:list) -> None:
     '''
     for instruction_cycle in range(len(instructions)):
         instruction = instructions[instruction_cycle]
-        opcode_str = get_opcode_str(instruction)
-        operands = get_operands(instruction)
+        opcode_str = instruction.opcode_str
+        if opcode_str not in ("BRZ", "BRU", "BRGT"):
+            continue
+        operands = instruction.operands
 
         target_operand = operands[0]
         remaining_operands = operands[1:]
         
-        replacement_instr = []
         if opcode_str == "BRZ":
-            replacement_instr = ["BRE", target_operand, remaining_operands[0], "#0"]
+            replacement_instr = Instruction("BRE", (target_operand, remaining_operands[0], "#0"), instruction.label, instruction.line)
         elif opcode_str == "BRU":
-            replacement_instr = ["BRE", target_operand, "R1", "R1"]
-        elif opcode_str == "BRGT":
-            replacement_instr = ["BRLT", target_operand, remaining_operands[1], remaining_operands[0]]
-        if len(replacement_instr) > 0:
-            if begins_with_label(instruction):
-                replacement_instr.insert(0, instruction[0])
-            replace_instruction(instructions=instructions, instr_cycle=instruction_cycle, new_instruction=replacement_instr)
+            replacement_instr = Instruction("BRE", (target_operand, "R1", "R1"), instruction.label, instruction.line)
+        else:
+            replacement_instr = Instruction("BRLT", (target_operand, remaining_operands[1], remaining_operands[0]), instruction.label, instruction.line)
+        replace_instruction(instructions=instructions, instr_cycle=instruction_cycle, new_instruction=replacement_instr)
 
 def convert_cycle_to_custom_hex(instr_cycle:int) -> str:
     '''Takes instruction cycle integer and converts to custom hexadecimal, starting from 0x11 and omitting any 0's.'''
@@ -311,106 +236,384 @@ def convert_cycle_to_instruction_cell_int(instr_cycle:int) -> int:
     int_version = int(custom_hex, 16)
     return int_version
 
-def get_instruction_label(instruction:list) -> str:
+def get_instruction_label(instruction:Instruction) -> str:
     '''Returns label at the beginning of the instruction, without the :.'''
-    if begins_with_label(instruction):
-        label = instruction[0][:-1]
-        return label
-    else:
+    if instruction.label is None:
         raise Exception("Instruction must begin with a label to call get_instruction_label()")
-
-def calculate_branch_labels(instructions:list) -> None:
-    '''Calculates branch label values, adding them in integer form to int_branch_labels dict.'''
-    #find labels and assign them to dictionary
-    for instruction_cycle in range(len(instructions)):
-        instruction = instructions[instruction_cycle]
-        if begins_with_label(instruction):
-            label = get_instruction_label(instruction)
-            int_branch_labels[label] = instruction_cycle
-
-def increment_branch_labels(amount:int) -> None:
-    '''Increments all values in int_branch_labels by amount specified.'''
-    for label in int_branch_labels.keys():
-        int_branch_labels[label] = int_branch_labels[label] + amount
-
-def add_label_ldi_instructions(instructions:list) -> None:
-    '''Adds any necessary LDIs for the labels, incrementing the values in int_branch_labels.'''
-
-    increment_amount = 0
-    #first pass - if any values already exist, there is 1 less increment required, so decrement the amount variable
-    for label in int_branch_labels.keys():
-        instr_cycle = int_branch_labels[label]
-        mem_cell = convert_cycle_to_instruction_cell_int(instr_cycle=instr_cycle)
-        existing_register = find_existing_immediate_register(immediate_value=mem_cell, instruction_cycle=instr_cycle)
-        if existing_register == -1:
-            increment_amount += 1
-    #increment all labels by the number of LDIs needed
-    increment_branch_labels(increment_amount)
-
-    for label in int_branch_labels.keys():
-        instr_cycle = int_branch_labels[label]
-        mem_cell = convert_cycle_to_instruction_cell_int(instr_cycle=instr_cycle)
-        existing_register = find_existing_immediate_register(immediate_value=mem_cell, instruction_cycle=instr_cycle)
-        #if no existing register with the desired value, create an LDI and increment future branch labels
-        if existing_register == -1:
-            create_new_ldi(instructions=instructions, immediate_value=mem_cell)
+    return instruction.label
 
 def remove_label_declarations(instructions:list) -> None:
     '''Removes labels from the beginning of instructions.'''
-    for instruction_cycle in range(len(instructions)):
-        instruction = instructions[instruction_cycle]
-        if begins_with_label(instruction):
-            instructions[instruction_cycle].pop(0)
+    for instruction in instructions:
+        instruction.label = None
 
-def convert_branch_labels(instructions:list) -> None:
-    '''Replaces instances of branch labels with the register that points to it.'''
-    for instruction_cycle in range(len(instructions)):
-        instruction = instructions[instruction_cycle]
-        operands = get_operands(instruction)
-        for operand_index in range(len(operands)):
-            operand = operands[operand_index]
-            if operand in int_branch_labels.keys():
-                pointer_instr_cycle = int_branch_labels[operand]
-                mem_cell = convert_cycle_to_instruction_cell_int(instr_cycle=pointer_instr_cycle)
-                #there should be an existing register as all necessary LDIs have been created
-                existing_register = find_existing_immediate_register(immediate_value=mem_cell, instruction_cycle=instruction_cycle)
-                replace_operand(instructions, instr_cycle=instruction_cycle, op_index=operand_index, new_value=f"R{existing_register}")
+def run_pass(profiler, function, instructions:list, name:str=None, assembler=None):
+    '''Runs function(instructions), recording it in profiler (a pass_profiler.PassProfiler) if one is given. Returns what the function returns.'''
+    if profiler is None:
+        return function(instructions)
+    return profiler.run_pass(function, instructions, name=name, assembler=assembler)
+
+def profile_group(profiler, name:str):
+    '''Returns a context manager that records the passes run in it as the group name in profiler, or does nothing if there is no profiler.'''
+    return profiler.group(name) if profiler is not None else contextlib.nullcontext()
 
 def remove_comments(instructions:list) -> None:
     '''Removes any comment lines that begin with a //'''
-    instr_index = 0
-    while instr_index < len(instructions):
-        instruction = instructions[instr_index]
-        if instruction[0][0:2] == "//":
-            instructions.pop(instr_index)
-        else:
-            instr_index += 1
-
-def convert_syntax(instructions:list) -> None:
-    '''Converts instructions into correct syntax, on a 1-1 relationship with the machine code.'''
-    remove_comments(instructions)
-    scan_for_immediate_registers(instructions)
-    remove_zero_ldis(instructions)
-    convert_custom_branches(instructions)
-    convert_immediate_operands(instructions)
-    calculate_branch_labels(instructions)
-    add_label_ldi_instructions(instructions)
-    remove_label_declarations(instructions)
-    convert_branch_labels(instructions)
+    instructions[:] = [instruction for instruction in instructions if not instruction.is_comment()]
+
+class Assembler:
+    '''Assembler : Class
+    Converts programs into machine code. The labels and registers recorded during a conversion belong to the instance,
+    so any number of programs can be converted in the same process.
+
+    Attributes:
+    int_branch_labels:dict -- labels and their instruction cycle numbers
+    mem_cell_branch_labels:dict -- labels and their instruction memory cell number (integer)
+    unused_registers:list -- numbers of all registers the program doesn't use, which are free to hold constants
+    immediate_registers:dict -- registers given a constant by create_new_ldi(), which hold it for the whole program.
+        key:value pairs are in the form, register number : value
+    immediate_value_registers:dict -- index of immediate_registers by value, in the form value : list of register numbers (in the same order as immediate_registers)
+    label_value_registers:dict -- registers given a label address by add_label_ldi_instructions(), in the form address : register number
+    known_values:list -- for each instruction, dict of register operand : value known to be in it before the instruction runs on every path to it,
+        found by constant_analysis (None if the instruction can't be reached). Any register holding a value can be used in place of an immediate operand.
+    known_values_offset:int -- number of LDIs added to the beginning of the instructions since known_values was found
+    relocatable_labels:bool -- if True, label addresses are only held in registers loaded with them, so that the layout and peephole passes can move the labels
+    pending_ldis:list -- LDIs created by create_new_ldi() that are still to be added to the beginning of the instructions, newest last.
+        They are added all at once by flush_pending_ldis(), so that each pass only shifts the instructions once.
+    cost_model:CostModel -- costs that macros are expanded under, the defaults of cost_model if None
+    input_registers:set -- numbers of the registers whose starting values are given when the program is run (see batch_simulator),
+        so they aren't assumed to be 0 and aren't used in place of an immediate before the program writes them
+    module:bool -- if True, the program is a module to be linked with others (see linker): it may branch to labels declared in
+        other modules, and nothing is known about the registers when it is entered, so every constant is loaded, including #0
+    external_labels:list -- labels branched to that the module doesn't declare, in the order they are first used.
+        They are given instruction cycles past the end of the module, so their addresses are loaded like those of its own labels
+    profiler:PassProfiler -- records the statistics of each pass if given, see pass_profiler
+    '''
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.reset()
+
+    def reset(self) -> None:
+        '''Clears the labels and registers recorded by a previous conversion.'''
+        self.int_branch_labels = {}
+        self.mem_cell_branch_labels = {}
+        self.unused_registers = list(ALLOCATABLE_REGISTERS)
+        self.immediate_registers = {}
+        self.immediate_value_registers = {}
+        self.label_value_registers = {}
+        self.known_values = []
+        self.known_values_offset = 0
+        self.relocatable_labels = False
+        self.pending_ldis = []
+        self.cost_model = None
+        self.input_registers = set()
+        self.module = False
+        self.external_labels = []
+
+    def find_unused_registers(self, instructions:list) -> None:
+        '''Removes every register the program reads or writes from unused_registers.'''
+        used_registers = set()
+        for instruction_cycle in range(len(instructions)):
+            instruction = instructions[instruction_cycle]
+            opcode = instruction.opcode
+
+            #write-back reg must be a register, not an immediate value
+            if opcode >= Opcode.ADD and opcode <= Opcode.LDI and instruction.kinds[0] == IMMEDIATE_OPERAND:
+                raise Exception(f"i {instruction_cycle}, operand 0: must be a register.")
+
+            #the first operand of a branch is a label or a register
+            for kind, operand in zip(instruction.kinds, instruction.operands):
+                if kind == REGISTER_OPERAND:
+                    used_registers.add(get_operand_value(operand))
+        self.unused_registers = [register for register in self.unused_registers if register not in used_registers]
+
+    def find_known_values(self, instructions:list) -> None:
+        '''Finds the values known to be in each of the program's registers before each instruction, for the program in its current form.'''
+        self.known_values_offset = 0
+        if self.module:
+            self.known_values = [{} for instruction in instructions]
+            return
+        from constant_analysis import find_known_values
+        #unused registers are left out, as they are given other values by create_new_ldi()
+        unused_operands = {f"R{register}" for register in self.unused_registers}
+        self.known_values = []
+        for known_values in find_known_values(instructions, self.input_registers):
+            if known_values is not None and not unused_operands.isdisjoint(known_values):
+                known_values = {register: value for register, value in known_values.items() if register not in unused_operands}
+            self.known_values.append(known_values)
+
+    def get_known_values(self, instruction_cycle:int) -> dict:
+        '''Returns dict of register operand : value known to be in it before the given instruction cycle runs.'''
+        known_values = self.known_values[instruction_cycle - self.known_values_offset]
+        return known_values if known_values is not None else {}
+
+    def remove_redundant_ldis(self, instructions:list) -> None:
+        '''Removes LDIs of a value the register already holds on every path to them, excluding instructions with a label.
+        This includes the #0 LDIs of registers that haven't been written to yet, as registers start at 0.
+        '''
+        kept_instructions = []
+        kept_known_values = []
+        for instruction_cycle in range(len(instructions)):
+            instruction = instructions[instruction_cycle]
+
+            #removing an LDI that doesn't change its register doesn't change the values known anywhere else
+            if instruction.opcode == Opcode.LDI and instruction.label is None and instruction.kinds[1] == IMMEDIATE_OPERAND:
+                if self.get_known_values(instruction_cycle).get(instruction.operands[0]) == get_operand_value(instruction.operands[1]):
+                    continue
+
+            kept_instructions.append(instruction)
+            kept_known_values.append(self.known_values[instruction_cycle])
+        instructions[:] = kept_instructions
+        self.known_values = kept_known_values
+
+    def find_existing_immediate_register(self, immediate_value:int, instruction_cycle:int) -> int:
+        '''Given immediate_value, returns the number of a register holding that value when the given instruction cycle runs:
+        an immediate register, or the lowest numbered register known to hold it at that point.
+        Returns -1 if no such register exists.
+        '''
+        #immediate registers are loaded at the beginning, and never written to again
+        value_registers = self.immediate_value_registers.get(immediate_value, [])
+        if len(value_registers) > 0:
+            return value_registers[0]
+        known_registers = [get_operand_value(register) for register, value in self.get_known_values(instruction_cycle).items() if value == immediate_value]
+        if len(known_registers) > 0:
+            return min(known_registers)
+        return -1
+
+    def create_new_ldi(self, immediate_value:int) -> int:
+        '''Creates a new LDI operation loading in immediate_value, to be added to the beginning of the instructions by flush_pending_ldis().
+        Finds unused register for LDI, removes it from unused_registers and adds it to immediate_registers.
+        Returns register number used.
+        '''
+        if len(self.unused_registers) < 1:
+            raise Exception("Run out of registers to use.")
+        #get unused register, remove it from list
+        register = self.unused_registers[-1]
+        self.unused_registers.pop()
+
+        #an LDI is unnecessary for a #0, as unused registers start at 0, unless other modules may have used the register
+        if immediate_value != 0 or self.module:
+            #create new instruction, waiting to be added to beginning of instructions list
+            instruction = Instruction("LDI", (f"R{register}", f"#{immediate_value}"))
+            self.pending_ldis.append(instruction)
+        self.immediate_registers[register] = immediate_value
+        self.immediate_value_registers.setdefault(immediate_value, []).append(register)
+
+        return register
+
+    def flush_pending_ldis(self, instructions:list) -> None:
+        '''Adds the LDIs created since the last flush to the beginning of the instructions, newest first.'''
+        if len(self.pending_ldis) > 0:
+            instructions[:0] = reversed(self.pending_ldis)
+            self.known_values_offset += len(self.pending_ldis)
+            self.pending_ldis.clear()
+
+    def convert_immediate_operands(self, instructions:list) -> None:
+        '''Converts any immediate operands not in an LDI operation, by either using an existing register holding the value, or creating a new LDI operation.'''
+        for instruction_cycle in range(len(instructions)):
+            instruction = instructions[instruction_cycle]
+
+            #if instruction is not allowed an immediate operand, convert it
+            if instruction.opcode != Opcode.LDI and IMMEDIATE_OPERAND in instruction.kinds:
+                operands = list(instruction.operands)
+                for operand_index in range(len(operands)):
+                    if instruction.kinds[operand_index] == IMMEDIATE_OPERAND:
+                        operand_value = get_operand_value(operands[operand_index])
+                        #if there is an existing suitable register with that value, replace with that
+                        register_num = self.find_existing_immediate_register(immediate_value=operand_value, instruction_cycle=instruction_cycle)
+                        #if no suitable register exists, create new LDI instruction
+                        if register_num == -1:
+                            register_num = self.create_new_ldi(immediate_value=operand_value)
+                        
+                        #replace the operand with the relevant register number
+                        operands[operand_index] = f"R{register_num}"
+                instruction.set_operands(operands)
+
+        self.flush_pending_ldis(instructions)
+
+    def calculate_branch_labels(self, instructions:list) -> None:
+        '''Calculates branch label values, adding them in integer form to int_branch_labels dict.'''
+        #find labels and assign them to dictionary
+        for instruction_cycle in range(len(instructions)):
+            instruction = instructions[instruction_cycle]
+            if begins_with_label(instruction):
+                label = get_instruction_label(instruction)
+                self.int_branch_labels[label] = instruction_cycle
+
+    def add_external_labels(self, instructions:list) -> None:
+        '''Adds the labels branched to that the module doesn't declare to int_branch_labels and external_labels,
+        at instruction cycles past the end of the module.
+        '''
+        for instruction in instructions:
+            if is_branch_instruction(instruction) and instruction.kinds[0] == LABEL_OPERAND:
+                label = instruction.operands[0]
+                if label not in self.int_branch_labels:
+                    self.int_branch_labels[label] = len(instructions) + len(self.external_labels)
+                    self.external_labels.append(label)
+
+    def increment_branch_labels(self, amount:int) -> None:
+        '''Increments all values in int_branch_labels by amount specified.'''
+        for label in self.int_branch_labels.keys():
+            self.int_branch_labels[label] = self.int_branch_labels[label] + amount
+
+    def find_label_ldi_values(self, branch_cycles:dict, increment_amount:int) -> list:
+        '''Returns the label addresses that need an LDI if increment_amount LDIs are added before the instructions:
+        those with a branch that has no register holding the address.
+        branch_cycles is dict of label : list of the instruction cycles of the branches to it.
+        '''
+        ldi_values = []
+        for label in self.int_branch_labels.keys():
+            mem_cell = convert_cycle_to_instruction_cell_int(instr_cycle=self.int_branch_labels[label] + increment_amount)
+            if mem_cell in ldi_values:
+                continue
+            for branch_cycle in branch_cycles[label]:
+                if self.relocatable_labels:
+                    existing_register = -1
+                else:
+                    existing_register = self.find_existing_immediate_register(immediate_value=mem_cell, instruction_cycle=branch_cycle)
+                if existing_register == -1:
+                    ldi_values.append(mem_cell)
+                    break
+        return ldi_values
+
+    def add_label_ldi_instructions(self, instructions:list) -> None:
+        '''Adds any necessary LDIs for the labels, incrementing the values in int_branch_labels.'''
+        branch_cycles = {label: [] for label in self.int_branch_labels.keys()}
+        for instruction_cycle in range(len(instructions)):
+            instruction = instructions[instruction_cycle]
+            if is_branch_instruction(instruction):
+                target = get_operands(instruction)[0]
+                if target in branch_cycles:
+                    branch_cycles[target].append(instruction_cycle)
+
+        #the LDIs move the labels, which changes which addresses already have a register, so repeat until the number of LDIs agrees
+        increment_amount = 0
+        ldi_values = self.find_label_ldi_values(branch_cycles, increment_amount)
+        for attempt in range(len(self.int_branch_labels)):
+            if len(ldi_values) == increment_amount:
+                break
+            increment_amount = len(ldi_values)
+            ldi_values = self.find_label_ldi_values(branch_cycles, increment_amount)
+        #if it doesn't settle, give every label that is branched to an LDI of its own
+        if len(ldi_values) != increment_amount:
+            branched_cycles = {self.int_branch_labels[label] for label in branch_cycles.keys() if len(branch_cycles[label]) > 0}
+            increment_amount = len(branched_cycles)
+            ldi_values = [convert_cycle_to_instruction_cell_int(instr_cycle=instr_cycle + increment_amount) for instr_cycle in sorted(branched_cycles)]
+        #increment all labels by the number of LDIs needed
+        self.increment_branch_labels(increment_amount)
+
+        for mem_cell in ldi_values:
+            self.label_value_registers[mem_cell] = self.create_new_ldi(immediate_value=mem_cell)
+
+        self.flush_pending_ldis(instructions)
+
+    def convert_branch_labels(self, instructions:list) -> None:
+        '''Replaces instances of branch labels with the register that points to it.'''
+        #label addresses are only resolved once, rather than for every operand that uses them
+        for label in self.int_branch_labels.keys():
+            self.mem_cell_branch_labels[label] = convert_cycle_to_instruction_cell_int(instr_cycle=self.int_branch_labels[label])
+
+        for instruction_cycle in range(len(instructions)):
+            instruction = instructions[instruction_cycle]
+            operands = get_operands(instruction)
+            for operand_index in range(len(operands)):
+                operand = operands[operand_index]
+                if operand in self.mem_cell_branch_labels.keys():
+                    mem_cell = self.mem_cell_branch_labels[operand]
+                    #there should be an existing register as all necessary LDIs have been created
+                    if self.relocatable_labels:
+                        existing_register = self.label_value_registers[mem_cell]
+                    else:
+                        existing_register = self.find_existing_immediate_register(immediate_value=mem_cell, instruction_cycle=instruction_cycle)
+                    replace_operand(instructions, instr_cycle=instruction_cycle, op_index=operand_index, new_value=f"R{existing_register}")
+
+    def get_label_registers(self) -> dict:
+        '''Returns dict of register number : label whose address it holds, for a program converted with relocatable labels.'''
+        label_of_address = {}
+        for label, instr_cycle in self.int_branch_labels.items():
+            label_of_address.setdefault(convert_cycle_to_instruction_cell_int(instr_cycle=instr_cycle), label)
+        return {register: label_of_address[address] for address, register in self.label_value_registers.items()}
+
+    def run_register_allocator(self, instructions:list) -> None:
+        '''Chooses registers for immediate values and branch labels with register_allocator, recording the labels.'''
+        from register_allocator import allocate_registers as allocate
+        self.int_branch_labels = allocate(instructions)
+
+    def run_pass(self, function, instructions:list) -> None:
+        '''Runs a pass on the instructions, through the profiler if there is one.'''
+        run_pass(self.profiler, function, instructions, assembler=self)
+
+    def expand_macros(self, instructions:list) -> None:
+        '''Expands macros (MUL, DIV, etc.) into the CPU's instructions with macro_expander, taking their scratch registers from unused_registers.'''
+        if not any(instruction.opcode_str in MACRO_OPCODES for instruction in instructions):
+            return
+        from macro_expander import expand_macros
+        scratch_registers = expand_macros(instructions, self.unused_registers, self.cost_model)
+        self.unused_registers = [register for register in self.unused_registers if register not in scratch_registers]
+
+    def convert_syntax(self, instructions:list, allocate_registers:bool=False, relocatable_labels:bool=False, cost_model=None,
+                       module:bool=False, input_registers=()) -> None:
+        '''Converts instructions into correct syntax, on a 1-1 relationship with the machine code.
+        If allocate_registers is True, registers for immediate values and branch labels are chosen by register_allocator instead.
+        If relocatable_labels is True, each label address is held in a register of its own, for passes that move labels.
+        Macros are expanded in the way that is fastest under cost_model (a cost_model.CostModel), or the default costs if it isn't given.
+        If module is True, the program is converted as a module (see the module attribute), with relocatable labels.
+        input_registers are the numbers of registers whose starting values are given when the program is run.
+        '''
+        self.reset()
+        if module and allocate_registers:
+            raise Exception("Modules can't be assembled with the register allocator, as it needs every branch target to be declared.")
+        self.relocatable_labels = relocatable_labels or module
+        self.module = module
+        self.input_registers = set(input_registers)
+        self.cost_model = cost_model
+        #programs given as lists of strings are parsed here, so that every pass works on Instructions
+        instructions[:] = [to_instruction(instruction) for instruction in instructions]
+        if not allocate_registers and not module:
+            #constant_analysis imports from this module, so it can't be imported at the top of it. It is imported here rather than in
+            #find_known_values(), so that a profile doesn't count the time taken to import it as part of that pass
+            import constant_analysis
+        with profile_group(self.profiler, "convert_syntax"):
+            self.run_pass(remove_comments, instructions)
+            if allocate_registers:
+                self.run_pass(self.expand_macros, instructions)
+                self.run_pass(convert_custom_branches, instructions)
+                self.run_pass(self.run_register_allocator, instructions)
+                return
+            self.run_pass(self.find_unused_registers, instructions)
+            self.run_pass(self.expand_macros, instructions)
+            self.run_pass(convert_custom_branches, instructions)
+            self.run_pass(self.find_known_values, instructions)
+            self.run_pass(self.remove_redundant_ldis, instructions)
+            self.run_pass(self.convert_immediate_operands, instructions)
+            self.run_pass(self.calculate_branch_labels, instructions)
+            if module:
+                self.run_pass(self.add_external_labels, instructions)
+            self.run_pass(self.add_label_ldi_instructions, instructions)
+            self.run_pass(remove_label_declarations, instructions)
+            self.run_pass(self.convert_branch_labels, instructions)
+
+def convert_syntax(instructions:list, allocate_registers:bool=False, relocatable_labels:bool=False, profiler=None, cost_model=None,
+                   module:bool=False, input_registers=()) -> Assembler:
+    '''Converts instructions into correct syntax, on a 1-1 relationship with the machine code.
+    Returns the Assembler used, which holds the labels and registers of the program.
+    '''
+    assembler = Assembler(profiler)
+    assembler.convert_syntax(instructions, allocate_registers=allocate_registers, relocatable_labels=relocatable_labels, cost_model=cost_model,
+                             module=module, input_registers=input_registers)
+    return assembler
 
 def convert_opcodes(instructions:list) -> None:
-    '''Converts opcode strings into their numbers'''
+    '''Converts each Instruction into a list of its opcode number followed by its operand strings.'''
     for instruction_cycle in range(len(instructions)):
-        instruction = instructions[instruction_cycle]
-        opcode = get_opcode(instruction)
-        instructions[instruction_cycle][0] = opcode
+        instruction = to_instruction(instructions[instruction_cycle])
+        instructions[instruction_cycle] = [int(instruction.opcode)] + list(instruction.operands)
 
 def convert_operands(instructions:list) -> None:
     '''Removes the R or # from the start of operands. Splits LDI operands that are >15 over two operands.'''
     for instruction_cycle in range(len(instructions)):
         instruction = instructions[instruction_cycle]
-        start_offset = 2 if begins_with_label(instruction) else 1
-        for operand_index in range(start_offset, len(instruction)):
+        for operand_index in range(1, len(instruction)):
             operand_value = get_operand_value(instruction[operand_index])
             #if operand value fits into 1 bit, replace operand with the value
             if operand_value <= 15:
@@ -442,48 +645,323 @@ def pad_to_equal_width(instructions:list) -> None:
             for i in range(pad_number):
                 instructions[instruction_cycle].append(0)
 
-def convert_to_machine_code(instructions:list) -> None:
+def convert_to_machine_code(instructions:list, profiler=None) -> None:
     '''Converts given list of assembly instructions into machine code numbers.'''
-    convert_opcodes(instructions)
-    convert_operands(instructions)
-    pad_to_equal_width(instructions)
+    with profile_group(profiler, "convert_to_machine_code"):
+        run_pass(profiler, convert_opcodes, instructions)
+        run_pass(profiler, convert_operands, instructions)
+        run_pass(profiler, pad_to_equal_width, instructions)
 
-def write_to_file(instructions:list, filename:str) -> None:
-    with open("programs/machine code/" + filename + "_converted.txt", 'w') as output_file:
-        instrs_output = []
-        counter = 0
-        for instruction in instructions:
-            instruction_str = ""
-            for bit in instruction:
-                instruction_str = instruction_str + " " + str(bit)
-                
-            instr_hex = convert_cycle_to_custom_hex(counter)
-            bit_1 = int(instr_hex[2], 16)
-            bit_2 = int(instr_hex[3], 16)
-            new_instr_hex = f"{bit_1} {bit_2}"
+class MachineCode:
+    '''MachineCode : Class
+
+    Attributes:
+    instructions:list -- machine code instructions, each a list of 4 integers
+    assembly:list -- converted assembly instructions, on a 1-1 relationship with the machine code
+    branch_labels:dict -- labels and their instruction cycle numbers
+    reports:list -- reports of the optional passes that were run (OptimizationReport, LayoutReport)
+    relocations:list -- for a module, (instruction cycle, label) of each LDI of a label address, which the linker sets once the module
+        is placed. Labels that aren't in branch_labels are declared by other modules, and their LDIs load 0 until then
+    '''
+    def __init__(self, instructions:list, assembly:list, branch_labels:dict, reports:list=None, relocations:list=None):
+        self.instructions = instructions
+        self.assembly = assembly
+        self.branch_labels = branch_labels
+        self.reports = reports if reports is not None else []
+        self.relocations = relocations if relocations is not None else []
+
+    def __str__(self):
+        return format_machine_code(self.instructions)
+
+class AssemblerOptions:
+    '''AssemblerOptions : Class
+    Optional passes to run when assembling a program.
+
+    Attributes:
+    optimize_layout:bool -- run the layout pass from layout_optimizer on the converted assembly
+    allocate_registers:bool -- choose registers for immediate values and branch labels with register_allocator
+    optimization_level:int -- level of the peephole_optimizer pass run on the converted assembly, 0 to skip it
+    cost_model:CostModel -- redstone tick costs used to choose how macros are expanded, None for the defaults of cost_model
+    '''
+    def __init__(self, optimize_layout:bool=False, allocate_registers:bool=False, optimization_level:int=0, cost_model=None):
+        self.optimize_layout = optimize_layout
+        self.allocate_registers = allocate_registers
+        self.optimization_level = optimization_level
+        self.cost_model = cost_model
+
+    def cache_parts(self) -> list:
+        '''Returns the option values, in a form that can be included in a build cache key.'''
+        #the default cost model is left out, so that outputs built before there was one are still up to date
+        parts = {name: value for name, value in vars(self).items() if name != "cost_model"}
+        if self.cost_model is not None:
+            parts["cost_model"] = self.cost_model.to_dict()
+        return sorted(parts.items())
+
+def find_relocations(instructions:list, label_registers:dict) -> list:
+    '''Returns (instruction cycle, label) for each LDI into a register of label_registers (register number : label).'''
+    return [(instruction_cycle, label_registers[instruction.values[0]]) for instruction_cycle, instruction in enumerate(instructions)
+            if instruction.opcode == Opcode.LDI and instruction.values[0] in label_registers]
+
+def assemble(source:str, options:AssemblerOptions=None, profiler=None, module:bool=False, input_registers=()) -> MachineCode:
+    '''Converts the text of an assembly program into machine code, running the optional passes in options.
+    If a profiler (pass_profiler.PassProfiler) is given, the statistics of each pass are recorded in it.
+    If module is True, the program is assembled as a module to be linked with others, see Assembler.module and MachineCode.relocations.
+    input_registers are the numbers of registers whose starting values are given when the program is run, see Assembler.input_registers.
+    '''
+    if options is None:
+        options = AssemblerOptions()
+    reports = []
+    with profile_group(profiler, "assemble"):
+        instructions = parse_source(source)
+        if options.optimization_level > 0:
+            from peephole_optimizer import OptimizationReport, find_result_registers, optimize_program
+            result_registers = find_result_registers(instructions)
+        #the layout and peephole passes move labels, so label addresses mustn't share registers with other values
+        relocatable_labels = options.optimize_layout or options.optimization_level > 0
+        assembler = convert_syntax(instructions, allocate_registers=options.allocate_registers, relocatable_labels=relocatable_labels, profiler=profiler,
+                                   cost_model=options.cost_model, module=module, input_registers=input_registers)
+        if module:
+            label_registers = assembler.get_label_registers()
+            #labels of other modules have no instruction to move with, so the optional passes leave programs that branch to them unchanged
+            for label in assembler.external_labels:
+                del assembler.int_branch_labels[label]
+        if options.optimization_level > 0 and module:
+            #other modules can enter a module at any of its labels, with any values in its registers, so nothing about them can be assumed
+            report = OptimizationReport(options.optimization_level, instructions_before=len(instructions))
+            report.message = "Program unchanged: modules are entered with registers set by other modules, so they aren't optimized."
+            reports.append(report)
+        elif options.optimization_level > 0:
+            reports.append(run_pass(profiler, lambda instructions: optimize_program(instructions, assembler.int_branch_labels, options.optimization_level,
+                                                                                     result_registers, input_registers),
+                                    instructions, name="optimize_program"))
+        if options.optimize_layout:
+            from layout_optimizer import optimize_page_layout
+            reports.append(run_pass(profiler, lambda instructions: optimize_page_layout(instructions, assembler.int_branch_labels),
+                                    instructions, name="optimize_page_layout"))
+        relocations = []
+        if module:
+            relocations = find_relocations(instructions, label_registers)
+            for instruction_cycle, label in relocations:
+                if label in assembler.external_labels:
+                    instructions[instruction_cycle].set_operand(1, "#0")
+        assembly = copy.deepcopy(instructions)
+        convert_to_machine_code(instructions, profiler)
+    return MachineCode(instructions=instructions, assembly=assembly, branch_labels=assembler.int_branch_labels, reports=reports,
+                       relocations=relocations)
+
+def format_machine_code(instructions:list) -> str:
+    '''Returns the text of a machine code file: one line per instruction, in the form "instr 1 1: 9 11 1 12".'''
+    instrs_output = []
+    counter = 0
+    for instruction in instructions:
+        instruction_str = ""
+        for bit in instruction:
+            instruction_str = instruction_str + " " + str(bit)
             
-            joined = f"instr {new_instr_hex}:{instruction_str}"
-            if instruction != instructions[-1]:
-                joined = joined + "\n"
-            instrs_output.append(joined)
-            counter += 1
-        output_file.writelines(instrs_output)
+        instr_hex = convert_cycle_to_custom_hex(counter)
+        bit_1 = int(instr_hex[2], 16)
+        bit_2 = int(instr_hex[3], 16)
+        new_instr_hex = f"{bit_1} {bit_2}"
+        
+        instrs_output.append(f"instr {new_instr_hex}:{instruction_str}")
+        counter += 1
+    return "\n".join(instrs_output)
 
-instructions = read_file_into_list(sys.argv[1])
+def get_output_path(filename:str) -> str:
+    '''Returns the path of the machine code file for a program in the programs folder.'''
+    return "programs/machine code/" + filename + "_converted.txt"
 
-for instr in instructions:
-    print(instr)
+def write_to_file(instructions:list, filename:str) -> None:
+    with open(get_output_path(filename), 'w') as output_file:
+        output_file.write(format_machine_code(instructions))
 
-convert_syntax(instructions)
+def get_output_paths(output_path:str, write_text:bool=True) -> list:
+    '''Returns the files written for the text machine code path output_path: the binary machine code file, and the text file if write_text is True.'''
+    return [get_binary_path(output_path)] + ([output_path] if write_text else [])
 
-print("\n")
-for instr_index in range(len(instructions)):
-    print(f"{instr_index+1} {instructions[instr_index]}")
+def is_output_current(cache:BuildCache, output_paths:list, cache_key:str) -> bool:
+    '''Returns True if every file in output_paths exists and was built with cache_key.'''
+    return all(cache.is_current(path, cache_key, path) for path in output_paths)
 
-convert_to_machine_code(instructions)
+def get_cache_key(source:str, options:AssemblerOptions) -> str:
+    '''Returns the build cache key for assembling source with the given options.'''
+    return hash_key("assembly", ASSEMBLER_VERSION, options.cache_parts(), source)
 
-print("\n")
-for instr_index in range(len(instructions)):
-    print(f"{instr_index+1} {instructions[instr_index]}")
-    
-write_to_file(instructions, sys.argv[1])
\ No newline at end of file
+def assemble_file(source_path:str, output_path:str, options:AssemblerOptions=None, write_text:bool=True) -> int:
+    '''Assembles the program at source_path and writes its machine code to the binary file for output_path (see get_output_paths),
+    and to output_path as text if write_text is True. Returns the number of instructions.
+    '''
+    with open(source_path, 'r') as input_file:
+        machine_code = assemble(input_file.read(), options)
+    write_machine_code_file(get_binary_path(output_path), machine_code.instructions, machine_code.branch_labels)
+    if write_text:
+        with open(output_path, 'w') as output_file:
+            output_file.write(format_machine_code(machine_code.instructions))
+    return len(machine_code.instructions)
+
+def assemble_file_task(task:tuple) -> tuple:
+    '''Runs assemble_file() for a (name, source path, output path, AssemblerOptions, write text) task in a worker process.
+    Returns (name, number of instructions, error message), where the error message is empty on success.
+    '''
+    name, source_path, output_path, options, write_text = task
+    try:
+        return (name, assemble_file(source_path, output_path, options, write_text), "")
+    except Exception as e:
+        return (name, 0, str(e))
+
+def assemble_directory(directory:str, output_directory:str=None, workers:int=None, options:AssemblerOptions=None, cache:BuildCache=None, force:bool=False,
+                       write_text:bool=True) -> list:
+    '''Assembles every .txt program in directory, across a pool of worker processes.
+    Machine code is written to output_directory (directory/machine code by default) as name_converted.bin, and as name_converted.txt if write_text is True.
+    If a cache is given, programs whose machine code is already up to date are skipped (unless force is True), and the cache is updated but not saved.
+    Returns a list of (name, number of instructions, error message) tuples, sorted by name.
+    The number of instructions is None for skipped programs, and the error message is empty on success.
+    '''
+    if options is None:
+        options = AssemblerOptions()
+    if output_directory is None:
+        output_directory = os.path.join(directory, "machine code")
+    os.makedirs(output_directory, exist_ok=True)
+
+    results = []
+    tasks = []
+    keys = {}
+    for file_name in sorted(os.listdir(directory)):
+        source_path = os.path.join(directory, file_name)
+        if file_name.endswith(".txt") and os.path.isfile(source_path):
+            name = file_name[:-len(".txt")]
+            output_path = os.path.join(output_directory, name + "_converted.txt")
+            if cache is not None:
+                with open(source_path, 'r') as input_file:
+                    keys[name] = get_cache_key(input_file.read(), options)
+                if not force and is_output_current(cache, get_output_paths(output_path, write_text), keys[name]):
+                    results.append((name, None, ""))
+                    continue
+            tasks.append((name, source_path, output_path, options, write_text))
+
+    if len(tasks) > 0:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for task, result in zip(tasks, executor.map(assemble_file_task, tasks)):
+                name, instruction_count, error = result
+                if cache is not None and not error:
+                    for path in get_output_paths(task[2], write_text):
+                        cache.update(path, keys[name])
+                results.append(result)
+
+    results.sort(key=lambda result: result[0])
+    return results
+
+def assemble_program(filename:str, options:AssemblerOptions, cache:BuildCache, force:bool=False, write_text:bool=True, profiler=None) -> tuple:
+    '''Assembles programs/<filename>.txt and writes its machine code files, updating the cache but not saving it.
+    Returns (source, MachineCode), or (source, None) if the machine code was already up to date and neither force nor a profiler was given.
+    '''
+    with open("programs/" + filename + ".txt", 'r') as input_file:
+        source = input_file.read()
+    cache_key = get_cache_key(source, options)
+    output_paths = get_output_paths(get_output_path(filename), write_text=write_text)
+    #a profile needs the program to be assembled, even if it is up to date
+    if not force and profiler is None and is_output_current(cache, output_paths, cache_key):
+        return source, None
+
+    machine_code = assemble(source, options, profiler)
+    write_machine_code_file(output_paths[0], machine_code.instructions, machine_code.branch_labels)
+    if write_text:
+        write_to_file(machine_code.instructions, filename)
+    for path in output_paths:
+        cache.update(path, cache_key)
+    return source, machine_code
+
+def add_arguments(parser:argparse.ArgumentParser, batch:bool=True, output:bool=True, profile:bool=True) -> None:
+    '''Adds the assembler's command line options to parser. batch is False to leave out --batch and --workers,
+    output is False to leave out --force and --no-text, and profile is False to leave out --profile and --profile-format.
+    '''
+    parser.add_argument("--optimize-layout", action="store_true", help="lay out the program so hot loops need fewer page loads")
+    parser.add_argument("--allocate-registers", action="store_true", help="hoist constants out of loops and reuse registers once their values are dead")
+    parser.add_argument("-O", "--optimization-level", type=int, choices=[0, 1, 2], default=0,
+                        help="remove redundant instructions: 1 keeps the final register values, 2 only keeps data memory")
+    parser.add_argument("--costs", metavar="PATH", help="JSON file of the redstone ticks of each opcode and event (see cost_model.py), used to choose how macros are expanded")
+    if batch:
+        parser.add_argument("--batch", metavar="DIRECTORY", help="assemble every .txt program in DIRECTORY into DIRECTORY/machine code")
+        parser.add_argument("--workers", type=int, default=None, help="number of worker processes for --batch (default: one per core)")
+    if output:
+        parser.add_argument("--force", action="store_true", help="rebuild even if the machine code is up to date")
+        parser.add_argument("--no-text", action="store_true", help="only write the binary machine code, not the _converted.txt text export")
+    if profile:
+        parser.add_argument("--profile", metavar="PATH", help="record the time and changes of each pass, and write them to PATH")
+        parser.add_argument("--profile-format", choices=["json", "chrome", "folded"], default="json",
+                            help="json statistics, a Chrome trace (chrome://tracing, Perfetto, speedscope) or folded stacks for flamegraph.pl")
+
+def get_options(args:argparse.Namespace) -> AssemblerOptions:
+    '''Returns the AssemblerOptions given on the command line.'''
+    cost_model = None
+    if args.costs is not None:
+        from cost_model import read_cost_model
+        cost_model = read_cost_model(args.costs)
+    return AssemblerOptions(optimize_layout=args.optimize_layout, allocate_registers=args.allocate_registers,
+                            optimization_level=args.optimization_level, cost_model=cost_model)
+
+def run_command(args:argparse.Namespace, parser:argparse.ArgumentParser, cache:BuildCache=None) -> int:
+    '''Runs the assembler with the options parsed by a parser set up with add_arguments(). Returns the exit status.'''
+    if cache is None:
+        cache = BuildCache()
+    options = get_options(args)
+
+    if getattr(args, "batch", None) is not None:
+        failures = 0
+        for name, instruction_count, error in assemble_directory(args.batch, workers=args.workers, options=options, cache=cache, force=args.force,
+                                                                       write_text=not args.no_text):
+            if error:
+                failures += 1
+                print(f"{name}: failed - {error}")
+            elif instruction_count is None:
+                print(f"{name}: unchanged")
+            else:
+                print(f"{name}: {instruction_count} instructions")
+        cache.save()
+        return 1 if failures > 0 else 0
+
+    if args.filename is None:
+        parser.error("a program name or --batch is required")
+
+    profiler = None
+    if args.profile is not None:
+        from pass_profiler import PassProfiler
+        profiler = PassProfiler()
+
+    source, machine_code = assemble_program(args.filename, options, cache, force=args.force, write_text=not args.no_text, profiler=profiler)
+    if machine_code is None:
+        print(f"{get_output_paths(get_output_path(args.filename), write_text=not args.no_text)[0]} is up to date.")
+        return 0
+
+    for report in machine_code.reports:
+        print(report)
+        print("\n")
+
+    #printing every instruction takes longer than assembling large programs, so only do it when asked
+    if args.verbose:
+        for instr in parse_source(source):
+            print(instr)
+        print("\n")
+        for instr_index in range(len(machine_code.assembly)):
+            print(f"{instr_index+1} {machine_code.assembly[instr_index]}")
+        print("\n")
+        for instr_index in range(len(machine_code.instructions)):
+            print(f"{instr_index+1} {machine_code.instructions[instr_index]}")
+        print("\n")
+
+    if profiler is not None:
+        print(profiler)
+        profiler.write(args.profile, args.profile_format)
+        print(f"Wrote profile to {args.profile}")
+
+    print(f"{len(machine_code.instructions)} instructions")
+    cache.save()
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts an assembly program in the programs folder into machine code.")
+    parser.add_argument("filename", nargs="?", help="program name, reading programs/<filename>.txt")
+    add_arguments(parser)
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the source, converted assembly and machine code instructions")
+    sys.exit(run_command(parser.parse_args(), parser))
@@ -0,0 +1,293 @@
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+from assembler import OPCODES, AssemblerOptions, add_arguments, assemble, begins_with_label, get_operand_value, get_options, parse_source
+from simulator import DATA_CELL_OF_ADDRESS, DATA_MEMORY_CELLS, DEFAULT_MAX_CYCLES, INSTRUCTIONS_PER_BLOCK, NUMBER_OF_REGISTERS, decode_program
+
+'''Runs one machine code program over many independent starting states at once, using NumPy, so that a program can be checked
+across its whole input space: for example division over every pair of 8-bit operands.
+Each state (a lane) has its own registers, data memory, program counter, cycle count and page frames, held as rows of arrays:
+registers are an (N, 16) array of bytes, with column 0 unused so that register numbers index it directly, and memory an (N, 60) array.
+
+Lanes that take different branches end up at different instructions, so each lane has its own program counter: lanes are kept in
+groups by the instruction they are at. At each step the lowest instruction any lane is at is chosen, and it is run for the lanes
+at it while the rest wait. Running the lowest first lets lanes that are behind catch up, so lanes that branch back to the start
+of a loop join up with the others at its head and run together, and lanes that have left the loop wait without being looked at.
+A lane that does something the simulator would raise an exception for (a branch to an invalid address, memory access outside
+the 60 cells, or running for too long) is stopped, and its error is recorded instead of stopping every lane.
+The results are the same as running simulator.run() on each state in turn.
+'''
+
+DEFAULT_BATCH_MAX_CYCLES = 100_000
+'''Default limit for the command line: lanes that never finish (such as division by 0) run on their own, one step at a time.'''
+
+ADDRESS_CELLS = np.array(DATA_CELL_OF_ADDRESS, dtype=np.int64)
+'''Data memory cell of every byte value, -1 for addresses that have no cell.'''
+
+ADDRESS_INSTRUCTIONS = np.array([((address >> 4) - 1) * INSTRUCTIONS_PER_BLOCK + (address & 0xF) - 1
+                                 if address >> 4 > 0 and address & 0xF > 0 else -1 for address in range(256)], dtype=np.int64)
+'''Instruction index a branch to every byte value goes to, -1 for addresses that aren't valid branch targets.'''
+
+class BatchResult:
+    '''BatchResult : Class
+
+    Attributes:
+    registers:np.ndarray -- (N, 15) final register values, column 0 is R1
+    memory:np.ndarray -- (N, 60) final data memory values, column 0 is address 0x11
+    cycles:np.ndarray -- number of instructions each lane executed
+    page_loads:np.ndarray -- number of times each lane loaded a block into a page frame
+    execution_counts:np.ndarray -- number of times each instruction of the program was executed, over all lanes
+    errors:dict -- lane : message of the error that stopped it, for lanes that didn't finish the program
+    steps:int -- number of instructions run across the whole batch (each for every lane at it)
+    '''
+    def __init__(self, registers:np.ndarray, memory:np.ndarray, cycles:np.ndarray, page_loads:np.ndarray, execution_counts:np.ndarray,
+                 errors:dict, steps:int):
+        self.registers = registers
+        self.memory = memory
+        self.cycles = cycles
+        self.page_loads = page_loads
+        self.execution_counts = execution_counts
+        self.errors = errors
+        self.steps = steps
+
+    def register(self, register_number:int) -> np.ndarray:
+        '''Returns the final value of register Rx in each lane.'''
+        return self.registers[:, register_number - 1]
+
+    def read_memory(self, address:int) -> np.ndarray:
+        '''Returns the final value of the data memory cell at the given custom hex address in each lane.'''
+        cell = DATA_CELL_OF_ADDRESS[address]
+        if cell == -1:
+            raise Exception(f"{hex(address)} is not a data memory address.")
+        return self.memory[:, cell]
+
+    def finished(self) -> np.ndarray:
+        '''Returns a boolean array, True for the lanes that finished the program.'''
+        finished = np.ones(len(self.cycles), dtype=bool)
+        finished[list(self.errors.keys())] = False
+        return finished
+
+def remove_input_ldis(source:str, input_registers:list) -> str:
+    '''Returns the source of a program without the LDIs at the start of it that load input_registers (register numbers),
+    so that the input values can be given as starting register values. Only LDIs before the first label or other instruction are removed.
+    '''
+    removed_lines = set()
+    for instruction in parse_source(source):
+        if instruction.is_comment():
+            continue
+        if instruction.opcode_str != "LDI" or begins_with_label(instruction):
+            break
+        if get_operand_value(instruction.operands[0]) in input_registers:
+            removed_lines.add(instruction.line)
+    return "\n".join(line for line_number, line in enumerate(source.split("\n"), start=1) if line_number not in removed_lines)
+
+def assemble_with_inputs(source:str, input_registers:list, options:AssemblerOptions=None) -> list:
+    '''Assembles a program with the LDIs that hard-code input_registers removed (see remove_input_ldis()). Returns its machine code.
+    The input registers are treated as unknown by the assembler, so it doesn't read them in place of an immediate that equals the
+    hard-coded value, as it would if the inputs were patched into the finished machine code.
+    '''
+    return assemble(remove_input_ldis(source, input_registers), options, input_registers=input_registers).instructions
+
+def run_batch(machine_code:list, registers=None, memory=None, lanes:int=None, max_cycles:int=DEFAULT_MAX_CYCLES) -> BatchResult:
+    '''Runs machine code from the start of the first block for each lane until execution passes the end of the last block.
+    registers is an (N, 15) array of starting register values (R1-R15) and memory an (N, 60) array of starting memory, zeros if not given;
+    lanes gives N when neither is. Lanes that branch to an invalid address, access memory outside the 60 cells,
+    or run for more than max_cycles instructions are stopped and their error recorded in the result.
+    '''
+    program = decode_program(machine_code)
+    length = len(program)
+    if lanes is None:
+        if registers is not None:
+            lanes = len(registers)
+        elif memory is not None:
+            lanes = len(memory)
+        else:
+            raise Exception("Give starting registers, memory or the number of lanes.")
+
+    regs = np.zeros((lanes, NUMBER_OF_REGISTERS + 1), dtype=np.uint8)
+    if registers is not None:
+        registers = np.asarray(registers)
+        if registers.shape != (lanes, NUMBER_OF_REGISTERS):
+            raise Exception(f"registers must be an array of {lanes} rows of {NUMBER_OF_REGISTERS} values.")
+        regs[:, 1:] = registers & 0xFF
+    mem = np.zeros((lanes, DATA_MEMORY_CELLS), dtype=np.uint8)
+    if memory is not None:
+        memory = np.asarray(memory)
+        if memory.shape != (lanes, DATA_MEMORY_CELLS):
+            raise Exception(f"memory must be an array of {lanes} rows of {DATA_MEMORY_CELLS} values.")
+        mem[:] = memory & 0xFF
+
+    cycles = np.zeros(lanes, dtype=np.int64)
+    page_loads = np.zeros(lanes, dtype=np.int64)
+    #the block executing in each lane, and the block in the other page frame (-1 for an empty frame)
+    current_frame = np.full(lanes, -1, dtype=np.int64)
+    other_frame = np.full(lanes, -1, dtype=np.int64)
+    counts = np.zeros(length, dtype=np.int64)
+    errors = {}
+    steps = 0
+
+    ADD, SUB, NOT, AND, OR = OPCODES["ADD"], OPCODES["SUB"], OPCODES["NOT"], OPCODES["AND"], OPCODES["OR"]
+    LS, RS, LD, LDI, STR = OPCODES["LS"], OPCODES["RS"], OPCODES["LD"], OPCODES["LDI"], OPCODES["STR"]
+    BRE, BRLT = OPCODES["BRE"], OPCODES["BRLT"]
+
+    #the program counters of the lanes: instruction index : list of arrays of the lanes at it.
+    #Lanes that finish or are stopped are dropped, and lanes waiting at an instruction aren't looked at until it runs.
+    lanes_at = {0: [np.arange(lanes)]} if length > 0 else {}
+
+    def move_to(lanes_moving:np.ndarray, next_index:int) -> None:
+        if next_index < length and len(lanes_moving) > 0:
+            lanes_at.setdefault(next_index, []).append(lanes_moving)
+
+    def stop(stopped_lanes:np.ndarray, messages) -> None:
+        '''Records messages (one per lane, or one for all of them) as the errors of lanes that are stopped.'''
+        for lane_index, lane in enumerate(stopped_lanes.tolist()):
+            errors[lane] = messages if isinstance(messages, str) else messages[lane_index]
+
+    while len(lanes_at) > 0:
+        index = min(lanes_at)
+        waiting = lanes_at.pop(index)
+        at_index = waiting[0] if len(waiting) == 1 else np.concatenate(waiting)
+        over_limit = cycles[at_index] >= max_cycles
+        if over_limit.any():
+            stop(at_index[over_limit], f"Program did not finish within {max_cycles} cycles.")
+            at_index = at_index[~over_limit]
+            if len(at_index) == 0:
+                continue
+
+        #load the block into a page frame in lanes that have moved to it from another block
+        block = index // INSTRUCTIONS_PER_BLOCK
+        moved = at_index[current_frame[at_index] != block]
+        if len(moved) > 0:
+            page_loads[moved] += other_frame[moved] != block
+            other_frame[moved] = current_frame[moved]
+            current_frame[moved] = block
+
+        opcode, a, b, c = program[index]
+        counts[index] += len(at_index)
+        cycles[at_index] += 1
+        steps += 1
+
+        if opcode == BRE or opcode == BRLT:
+            if opcode == BRE:
+                taken = regs[at_index, b] == regs[at_index, c]
+            else:
+                taken = regs[at_index, b] < regs[at_index, c]
+            move_to(at_index[~taken], index + 1)
+            taken_lanes = at_index[taken]
+            targets = regs[taken_lanes, a]
+            target_indexes = ADDRESS_INSTRUCTIONS[targets]
+            invalid = target_indexes < 0
+            if invalid.any():
+                stop(taken_lanes[invalid], [f"Instruction {index + 1}: branch to invalid address {hex(target)}." for target in targets[invalid].tolist()])
+                taken_lanes, target_indexes = taken_lanes[~invalid], target_indexes[~invalid]
+            if len(taken_lanes) > 0 and (target_indexes == target_indexes[0]).all():
+                move_to(taken_lanes, int(target_indexes[0]))
+            else:
+                for target_index in np.unique(target_indexes).tolist():
+                    move_to(taken_lanes[target_indexes == target_index], target_index)
+            continue
+
+        if opcode == ADD:
+            regs[at_index, a] = regs[at_index, b] + regs[at_index, c]
+        elif opcode == LDI:
+            regs[at_index, a] = b << 4 | c
+        elif opcode == SUB:
+            regs[at_index, a] = regs[at_index, b] - regs[at_index, c]
+        elif opcode == STR or opcode == LD:
+            addresses = regs[at_index, b]
+            cells = ADDRESS_CELLS[addresses]
+            invalid = cells < 0
+            if invalid.any():
+                action = "store to" if opcode == STR else "load from"
+                stop(at_index[invalid], [f"Instruction {index + 1}: {action} invalid address {hex(address)}." for address in addresses[invalid].tolist()])
+                at_index, cells = at_index[~invalid], cells[~invalid]
+            if opcode == STR:
+                mem[at_index, cells] = regs[at_index, a]
+            else:
+                regs[at_index, a] = mem[at_index, cells]
+        elif opcode == AND:
+            regs[at_index, a] = regs[at_index, b] & regs[at_index, c]
+        elif opcode == OR:
+            regs[at_index, a] = regs[at_index, b] | regs[at_index, c]
+        elif opcode == LS:
+            regs[at_index, a] = regs[at_index, b] << 1
+        elif opcode == RS:
+            regs[at_index, a] = regs[at_index, b] >> 1
+        elif opcode == NOT:
+            regs[at_index, a] = ~regs[at_index, b]
+        move_to(at_index, index + 1)
+
+    return BatchResult(registers=regs[:, 1:], memory=mem, cycles=cycles, page_loads=page_loads, execution_counts=counts, errors=errors, steps=steps)
+
+def sweep_registers(source:str, input_registers:list, values=range(256), max_cycles:int=DEFAULT_MAX_CYCLES, options:AssemblerOptions=None) -> tuple:
+    '''Assembles a program without the LDIs that hard-code input_registers (register numbers), see assemble_with_inputs(),
+    and runs it once for every combination of their values. Returns (inputs, BatchResult), where inputs is an (N, len(input_registers)) array
+    of the values each lane started with.
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    grids = np.meshgrid(*([values] * len(input_registers)), indexing="ij")
+    inputs = np.stack([grid.ravel() for grid in grids], axis=1)
+    registers = np.zeros((len(inputs), NUMBER_OF_REGISTERS), dtype=np.int64)
+    for column, register_number in enumerate(input_registers):
+        registers[:, register_number - 1] = inputs[:, column]
+    return inputs, run_batch(assemble_with_inputs(source, input_registers, options), registers=registers, max_cycles=max_cycles)
+
+def parse_register(text:str) -> int:
+    '''Converts a register name such as R1 into its number.'''
+    if text[:1].upper() != "R" or not text[1:].isdigit() or not 1 <= int(text[1:]) <= NUMBER_OF_REGISTERS:
+        raise argparse.ArgumentTypeError(f"{text} is not a register, they are R1 to R{NUMBER_OF_REGISTERS}.")
+    return int(text[1:])
+
+def parse_expectation(text:str) -> tuple:
+    '''Converts an expectation such as 0x11=R1//R2 into (address, expression).'''
+    if "=" not in text:
+        raise argparse.ArgumentTypeError(f"{text} must be in the form ADDRESS=EXPRESSION.")
+    address, expression = text.split("=", 1)
+    try:
+        address = int(address, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{address} is not a data memory address.")
+    if DATA_CELL_OF_ADDRESS[address & 0xFF] == -1 or address > 0xFF:
+        raise argparse.ArgumentTypeError(f"{hex(address)} is not a data memory address.")
+    return address, expression
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assembles a program and runs it for every combination of values of its input registers.")
+    parser.add_argument("filename", help="program name, reading programs/<filename>.txt")
+    parser.add_argument("--sweep", type=parse_register, nargs="+", required=True, metavar="REGISTER",
+                        help="input registers (such as R1 R2) whose LDIs at the start of the program are removed, and that are given every value from 0 to 255")
+    parser.add_argument("--expect", type=parse_expectation, action="append", default=[], metavar="ADDRESS=EXPRESSION",
+                        help="check that a memory cell ends up as a Python expression of the inputs, e.g. 0x11=R1//R2 (may be repeated)")
+    parser.add_argument("--max-cycles", type=int, default=DEFAULT_BATCH_MAX_CYCLES, help="stop lanes that run for longer than this")
+    add_arguments(parser, batch=False, output=False, profile=False)
+    args = parser.parse_args()
+
+    with open("programs/" + args.filename + ".txt", 'r') as input_file:
+        source = input_file.read()
+    start = time.perf_counter()
+    inputs, result = sweep_registers(source, args.sweep, max_cycles=args.max_cycles, options=get_options(args))
+    seconds = time.perf_counter() - start
+    print(f"Ran {len(inputs)} lanes in {seconds:.2f} s ({result.steps} steps, {int(result.cycles.sum())} cycles, "
+          f"at most {int(result.cycles.max())} cycles and {int(result.page_loads.max())} page loads in one lane)")
+
+    def describe_inputs(lane:int) -> str:
+        return ", ".join(f"R{register_number}={int(value)}" for register_number, value in zip(args.sweep, inputs[lane]))
+
+    if len(result.errors) > 0:
+        print(f"{len(result.errors)} lane(s) stopped with an error, e.g.:")
+        for lane, message in itertools.islice(result.errors.items(), 5):
+            print(f"  {describe_inputs(lane)}: {message}")
+
+    finished = result.finished()
+    variables = {f"R{register_number}": inputs[:, column] for column, register_number in enumerate(args.sweep)}
+    for address, expression in args.expect:
+        #evaluated over the whole array of inputs at once; lanes that would divide by 0 are normally the ones that never finish
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = np.asarray(eval(expression, {"np": np}, dict(variables))) & 0xFF
+        mismatches = np.flatnonzero(finished & (result.read_memory(address) != np.broadcast_to(expected, finished.shape)))
+        print(f"{hex(address)} = {expression}: {int(finished.sum()) - len(mismatches)} of {int(finished.sum())} finished lanes match")
+        for lane in mismatches[:5].tolist():
+            print(f"  {describe_inputs(lane)}: expected {int(np.broadcast_to(expected, finished.shape)[lane])}, found {int(result.read_memory(address)[lane])}")
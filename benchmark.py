@@ -0,0 +1,291 @@
+import argparse
+import copy
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import assembler
+import schematic_generator
+import simulator
+
+'''This script measures the speed of the assembler and the quality of the code it produces, so that changes to either can be checked.
+It runs over the programs in the programs folder and synthetic programs of 100 to 10,000 lines, and for each one records:
+- the wall time (best of several runs) and peak memory of each pass: convert_syntax(), convert_to_machine_code() and generate_schematics()
+- the number of instructions produced, the number of LDIs the assembler added, the number of blocks, and for programs that fit in
+  the 15 blocks of instruction memory, the number of cycles the simulator takes to run them
+Each run is added to a JSON history file and compared against a stored baseline run. Any measurement that is worse than the baseline
+by more than its threshold is reported, and the script exits with status 1.
+
+With --scaling, it instead times convert_syntax() on synthetic programs of increasing size.
+A linear pass pipeline takes about twice as long when the program doubles in size, a quadratic one about four times as long.'''
+
+DEFAULT_SIZES = [1000, 2000, 4000, 8000, 16000]
+SUITE_SIZES = [100, 1000, 10000]
+PASSES = ["convert_syntax", "convert_to_machine_code", "generate_schematics"]
+QUALITY_METRICS = ["instructions", "ldis_added", "blocks", "cycles"]
+'''Measurements of the code produced, all of which are better when lower.'''
+
+DEFAULT_HISTORY_PATH = "benchmark_history.json"
+DEFAULT_BASELINE_PATH = "benchmark_baseline.json"
+DEFAULT_PERFORMANCE_THRESHOLD = 0.25
+'''Timings and memory use vary from run to run, so they may be up to 25% worse than the baseline.'''
+DEFAULT_QUALITY_THRESHOLD = 0.0
+'''The code produced is the same on every run, so any increase is a regression.'''
+MIN_SECONDS_DIFFERENCE = 0.001
+MIN_BYTES_DIFFERENCE = 64 * 1024
+'''Smaller differences in time and memory are within the noise of measuring short passes, so aren't regressions.'''
+
+MAX_SIMULATED_LENGTH = simulator.INSTRUCTIONS_PER_BLOCK * 15
+'''Instruction addresses only reach 15 blocks, so longer programs can't be run.'''
+
+def generate_synthetic_program(number_of_lines:int, seed:int=0) -> list:
+    '''Generates a program of roughly number_of_lines lines, in the form returned by read_file_into_list().
+    The program is mostly straight-line arithmetic with comments and redundant #0 LDIs, followed by a loop,
+    as produced by the compiler front end. Only a few registers and immediate values are used, so it always fits in the registers.
+    '''
+    rng = random.Random(seed)
+    program = [["//", "synthetic", "program"], ["LDI", "R1", "#0"], ["LDI", "R6", "#0"]]
+    operators = ["ADD", "SUB", "AND", "OR"]
+    body_lines = max(number_of_lines - 12, 0)
+    for line_index in range(body_lines):
+        choice = rng.random()
+        if choice < 0.1:
+            program.append(["//", "step", str(line_index)])
+        elif choice < 0.15:
+            program.append(["LDI", "R6", "#0"])
+        else:
+            destination = f"R{rng.randint(2, 5)}"
+            source = f"R{rng.randint(1, 5)}"
+            immediate = f"#{rng.randint(0, 2)}"
+            program.append([rng.choice(operators), destination, source, immediate])
+
+    program.extend([
+        ["//", "loop", "ten", "times"],
+        ["loop:", "ADD", "R1", "R1", "#1"],
+        ["BRZ", "skip", "R6"],
+        ["STR", "R2", "#17"],
+        ["skip:", "BRGT", "done", "R1", "#9"],
+        ["BRU", "loop"],
+        ["done:", "STR", "R1", "#17"],
+    ])
+    return [assembler.Instruction.from_parts(parts) for parts in program]
+
+def time_convert_syntax(program:list) -> float:
+    '''Returns the number of seconds convert_syntax() takes to convert a copy of the program.'''
+    instructions = copy.deepcopy(program)
+    start = time.perf_counter()
+    assembler.convert_syntax(instructions)
+    return time.perf_counter() - start
+
+def benchmark_scaling(sizes:list, repeats:int=3) -> list:
+    '''Times convert_syntax() on a synthetic program of each size, keeping the best of repeats runs.
+    Returns list of (lines, seconds) tuples.
+    '''
+    results = []
+    for size in sizes:
+        program = generate_synthetic_program(size)
+        seconds = min(time_convert_syntax(program) for i in range(repeats))
+        results.append((len(program), seconds))
+    return results
+
+def get_suite_programs(sizes:list) -> list:
+    '''Returns list of (name, program) for every program in the programs folder, followed by a synthetic program of each size.'''
+    programs = []
+    for filename in sorted(os.listdir("programs")):
+        name, extension = os.path.splitext(filename)
+        if extension == ".txt":
+            programs.append((name, assembler.read_file_into_list(name)))
+    for size in sizes:
+        programs.append((f"synthetic_{size}", generate_synthetic_program(size)))
+    return programs
+
+def measure_pass(run_pass, pass_input, repeats:int=3) -> tuple:
+    '''Runs run_pass on a fresh copy of pass_input repeats times, then once more while tracing memory.
+    Returns (best wall time in seconds, peak bytes allocated by the pass). Copying the input isn't included in either.
+    '''
+    best_seconds = None
+    for i in range(repeats):
+        pass_copy = copy.deepcopy(pass_input)
+        start = time.perf_counter()
+        run_pass(pass_copy)
+        seconds = time.perf_counter() - start
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+
+    pass_copy = copy.deepcopy(pass_input)
+    tracemalloc.start()
+    try:
+        run_pass(pass_copy)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best_seconds, peak_bytes
+
+def count_ldis(instructions:list) -> int:
+    '''Returns the number of LDIs in a program in source or converted form.'''
+    return sum(1 for instruction in instructions if assembler.get_opcode_str(instruction) == "LDI")
+
+def benchmark_program(program:list, repeats:int=3, workers:int=1) -> dict:
+    '''Runs the assembler passes and schematic generator on a program, returning its measurements as a dict.
+    Schematics are written to a temporary folder. With more than 1 worker, blocks are generated in other processes,
+    whose memory isn't included in the peak memory of generate_schematics().
+    '''
+    source = copy.deepcopy(program)
+    assembler.remove_comments(source)
+    converted = copy.deepcopy(source)
+    assembler.convert_syntax(converted)
+    machine_code = copy.deepcopy(converted)
+    assembler.convert_to_machine_code(machine_code)
+
+    passes = {}
+    passes["convert_syntax"] = measure_pass(assembler.convert_syntax, source, repeats)
+    passes["convert_to_machine_code"] = measure_pass(assembler.convert_to_machine_code, converted, repeats)
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as output_directory:
+        os.chdir(output_directory)
+        try:
+            passes["generate_schematics"] = measure_pass(lambda instructions: schematic_generator.generate_schematics(instructions, "benchmark", workers=workers),
+                                                         machine_code, repeats)
+        finally:
+            os.chdir(working_directory)
+
+    cycles = None
+    if len(machine_code) <= MAX_SIMULATED_LENGTH:
+        cycles = simulator.run(machine_code).cycles
+
+    return {
+        "source_lines": len(source),
+        "passes": {pass_name: {"seconds": seconds, "peak_bytes": peak_bytes} for pass_name, (seconds, peak_bytes) in passes.items()},
+        "instructions": len(machine_code),
+        "ldis_added": count_ldis(converted) - count_ldis(source),
+        "blocks": len(schematic_generator.split_into_blocks(machine_code)),
+        "cycles": cycles,
+    }
+
+def get_commit() -> str:
+    '''Returns the short hash of the checked out git commit, or None if it can't be found.'''
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(sizes:list, repeats:int=3, workers:int=1) -> dict:
+    '''Benchmarks every program of the suite. Returns the run as a dict, in the form stored in the history and baseline files.'''
+    results = {}
+    for name, program in get_suite_programs(sizes):
+        results[name] = benchmark_program(program, repeats, workers)
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "results": results,
+    }
+
+def load_json(path:str, default):
+    '''Returns the contents of a JSON file, or default if the file doesn't exist.'''
+    if not os.path.isfile(path):
+        return default
+    with open(path, 'r') as input_file:
+        return json.load(input_file)
+
+def save_json(path:str, contents) -> None:
+    with open(path, 'w') as output_file:
+        json.dump(contents, output_file, indent=1)
+
+def append_to_history(path:str, run:dict) -> None:
+    '''Adds a run to the end of the history file, creating it if needed.'''
+    history = load_json(path, [])
+    history.append(run)
+    save_json(path, history)
+
+def is_worse(value, baseline_value, threshold:float, minimum_difference:float=0) -> bool:
+    '''Returns True if value is more than threshold (a fraction) and more than minimum_difference higher than baseline_value.
+    Missing values are never worse.
+    '''
+    if value is None or baseline_value is None:
+        return False
+    return value > baseline_value * (1 + threshold) and value - baseline_value > minimum_difference
+
+def compare_to_baseline(run:dict, baseline:dict, performance_threshold:float=DEFAULT_PERFORMANCE_THRESHOLD,
+                        quality_threshold:float=DEFAULT_QUALITY_THRESHOLD) -> list:
+    '''Returns a list of messages, one for each measurement of run that is worse than in baseline by more than its threshold.
+    Programs that aren't in both runs are skipped.
+    '''
+    regressions = []
+    for name, result in run["results"].items():
+        baseline_result = baseline["results"].get(name)
+        if baseline_result is None:
+            continue
+        for metric in QUALITY_METRICS:
+            if is_worse(result[metric], baseline_result[metric], quality_threshold):
+                regressions.append(f"{name}: {metric} {baseline_result[metric]} -> {result[metric]}")
+        for pass_name in PASSES:
+            measurements = result["passes"][pass_name]
+            baseline_measurements = baseline_result["passes"].get(pass_name, {})
+            if is_worse(measurements["seconds"], baseline_measurements.get("seconds"), performance_threshold, MIN_SECONDS_DIFFERENCE):
+                regressions.append(f"{name}: {pass_name} took {baseline_measurements['seconds']*1000:.2f} -> {measurements['seconds']*1000:.2f} ms")
+            if is_worse(measurements["peak_bytes"], baseline_measurements.get("peak_bytes"), performance_threshold, MIN_BYTES_DIFFERENCE):
+                regressions.append(f"{name}: {pass_name} peak memory {baseline_measurements['peak_bytes']//1024} -> {measurements['peak_bytes']//1024} KiB")
+    return regressions
+
+def format_run(run:dict) -> str:
+    '''Returns a table of the measurements of a run, with the time (ms) and peak memory (KiB) of each pass.'''
+    header = f"{'program':<18} {'lines':>6} {'instrs':>6} {'LDIs+':>5} {'blocks':>6} {'cycles':>7}"
+    for pass_name in PASSES:
+        header += f" {pass_name[:23]:>23}"
+    lines = [header]
+    for name, result in run["results"].items():
+        cycles = result["cycles"] if result["cycles"] is not None else "-"
+        line = f"{name:<18} {result['source_lines']:>6} {result['instructions']:>6} {result['ldis_added']:>5} {result['blocks']:>6} {cycles:>7}"
+        for pass_name in PASSES:
+            measurements = result["passes"][pass_name]
+            line += f" {measurements['seconds']*1000:>10.2f} ms {measurements['peak_bytes']/1024:>7.0f} KiB"
+        lines.append(line)
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the assembler and the code it produces, comparing against a stored baseline.")
+    parser.add_argument("sizes", nargs="*", type=int, help="synthetic program lengths, 100 1000 10000 by default (1000 to 16000 with --scaling)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for generate_schematics(), 1 by default so that its memory is measured")
+    parser.add_argument("--history", default=DEFAULT_HISTORY_PATH, help="JSON file that each run is added to")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="JSON file of the run to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline instead of comparing against it")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_PERFORMANCE_THRESHOLD, help="fraction by which times and memory may be worse than the baseline")
+    parser.add_argument("--quality-threshold", type=float, default=DEFAULT_QUALITY_THRESHOLD, help="fraction by which instruction, LDI, block and cycle counts may be worse")
+    parser.add_argument("--scaling", action="store_true", help="only time convert_syntax() on synthetic programs of increasing size")
+    args = parser.parse_args()
+
+    if args.scaling:
+        previous_seconds = None
+        print(f"{'lines':>8} {'seconds':>10} {'us/line':>8} {'growth':>7}")
+        for lines, seconds in benchmark_scaling(args.sizes or DEFAULT_SIZES, args.repeats):
+            growth = f"{seconds/previous_seconds:7.2f}" if previous_seconds else f"{'-':>7}"
+            print(f"{lines:>8} {seconds:10.4f} {seconds/lines*1e6:8.2f} {growth}")
+            previous_seconds = seconds
+        sys.exit(0)
+
+    run = run_suite(args.sizes or SUITE_SIZES, args.repeats, args.workers)
+    print(format_run(run))
+    append_to_history(args.history, run)
+
+    if args.save_baseline:
+        save_json(args.baseline, run)
+        print(f"\nSaved baseline to {args.baseline}.")
+        sys.exit(0)
+    baseline = load_json(args.baseline, None)
+    if baseline is None:
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to store one.")
+        sys.exit(0)
+    regressions = compare_to_baseline(run, baseline, args.threshold, args.quality_threshold)
+    print(f"\nCompared with baseline from {baseline['time']} (commit {baseline['commit']}):")
+    if len(regressions) > 0:
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("  no regressions")
@@ -0,0 +1,329 @@
+import argparse
+import time
+
+from assembler import OPCODES
+from simulator import (DATA_CELL_OF_ADDRESS, DATA_MEMORY_CELLS, DEFAULT_MAX_CYCLES, INSTRUCTIONS_PER_BLOCK, NUMBER_OF_REGISTERS, PAGE_FRAMES,
+                       WORD_MASK, SimulationResult, decode_program, read_machine_code_file, get_machine_code_path, run)
+from machine_code_format import MachineCodeFile, is_binary_machine_code_file
+
+'''Second execution engine for the simulator, for long running loops and large sweeps. Rather than decoding every instruction
+each time it runs, each 15 instruction block is translated into a Python function that runs it:
+- the registers the block uses are local variables, loaded when the function starts and stored when it returns
+- the block is split into straight-line segments, and a branch to an entry point in the same block jumps straight there,
+  so a loop that fits in one block runs without leaving the function
+- execution counts are kept per segment rather than per instruction, and added up when the function returns,
+  as are the number of times each branch is taken
+Branch targets are only known at run time, so a block is first translated with the entry point it was reached at, and
+translated again whenever a branch enters it somewhere new. Leaving the block (a page fault, or running off its end) returns
+to the dispatcher, which models the page frames exactly as simulator.py does; the last few instructions before max_cycles are
+run by a single-step interpreter, so the cycle limit is exact. The results, including cycles, page loads, execution, taken and
+page load counts and exception messages, are the same as run() in simulator.py.
+
+Translations are cached by the contents of the block, so a block is only translated once however many programs or runs use it.
+Each page frame keeps the translation of the block loaded into it, which is dropped when the frame is swapped for another block.
+'''
+
+TRIP_LENGTH = INSTRUCTIONS_PER_BLOCK
+'''Most instructions a block function runs between jumps back to an entry point, used to stop it before max_cycles.'''
+
+ARITHMETIC_EXPRESSIONS = {
+    OPCODES["ADD"]: "(r{b} + r{c}) & 255",
+    OPCODES["SUB"]: "(r{b} - r{c}) & 255",
+    OPCODES["AND"]: "r{b} & r{c}",
+    OPCODES["OR"]: "r{b} | r{c}",
+    OPCODES["LS"]: "(r{b} << 1) & 255",
+    OPCODES["RS"]: "r{b} >> 1",
+    OPCODES["NOT"]: "~r{b} & 255",
+}
+'''Expression for the value each arithmetic opcode writes to register a.'''
+
+BRANCH_CONDITIONS = {OPCODES["BRE"]: "==", OPCODES["BRLT"]: "<"}
+
+class BlockTranslation:
+    '''BlockTranslation : Class
+    A block of machine code translated into a Python function.
+
+    Attributes:
+    block:tuple -- the (opcode, a, b, c) instructions of the block
+    base:int -- index of the first instruction of the block in the program
+    entries:frozenset -- offsets in the block that the function can start at or jump to
+    branch_count:int -- number of branches in the block, at least 1
+    function:function -- function(regs, mem, counts, taken_counts, pc, trips_left) that runs the block from offset pc, jumping back
+                         to an entry at most trips_left times, and returns (index of the next instruction, instructions executed)
+    source:str -- generated source of the function
+    '''
+    def __init__(self, block:tuple, base:int, entries:frozenset):
+        self.block = block
+        self.base = base
+        self.entries = entries
+        self.branch_count = max(1, sum(1 for instruction in block if is_branch(instruction[0])))
+        self.source = generate_block_source(block, base, entries)
+        namespace = {"cell_of": DATA_CELL_OF_ADDRESS}
+        exec(compile(self.source, f"<block at {base}>", "exec"), namespace)
+        self.function = namespace["run_block"]
+
+def is_branch(opcode:int) -> bool:
+    return opcode in BRANCH_CONDITIONS
+
+def get_segments(block:tuple, entries:frozenset) -> list:
+    '''Splits the reachable part of a block into straight-line segments, which start at an entry or after a branch,
+    and end at a branch or before an entry. Returns list of (start offset, end offset), end exclusive.
+    '''
+    segments = []
+    start = min(entries)
+    for offset in range(start, len(block)):
+        if offset > start and offset in entries:
+            segments.append((start, offset))
+            start = offset
+        if is_branch(block[offset][0]):
+            segments.append((start, offset + 1))
+            start = offset + 1
+    if start < len(block):
+        segments.append((start, len(block)))
+    return segments
+
+def generate_branch(lines:list, instruction:tuple, index:int, entry_addresses:list, counter:str, indent:str) -> None:
+    '''Adds the source lines that run a branch to lines. A branch to an entry of the block jumps straight there,
+    any other branch leaves the function.
+    '''
+    opcode, a, b, c = instruction
+    if b == c:
+        #BRE Rx, Ry, Ry is how the assembler writes an unconditional branch, and BRLT Rx, Ry, Ry is never taken
+        if opcode == OPCODES["BRLT"]:
+            return
+    else:
+        lines.append(f"{indent}if r{b} {BRANCH_CONDITIONS[opcode]} r{c}:")
+        indent += "    "
+    lines.append(f"{indent}t{index} += 1")
+    for entry, address in entry_addresses:
+        lines.append(f"{indent}if r{a} == {address} and {counter} <= trips_left:")
+        lines.append(f"{indent}    pc = {entry}")
+        lines.append(f"{indent}    continue")
+    lines.append(f"{indent}target = r{a}")
+    lines.append(f"{indent}if target < 16 or not target & 15:")
+    lines.append(f"{indent}    raise Exception(f\"Instruction {index + 1}: branch to invalid address {{hex(target)}}.\")")
+    lines.append(f"{indent}nxt = ((target >> 4) - 1) * {INSTRUCTIONS_PER_BLOCK} + (target & 15) - 1")
+    lines.append(f"{indent}break")
+
+def generate_instruction(lines:list, instruction:tuple, index:int, indent:str) -> None:
+    '''Adds the source lines that run an instruction other than a branch to lines.'''
+    opcode, a, b, c = instruction
+    if opcode in ARITHMETIC_EXPRESSIONS:
+        lines.append(f"{indent}r{a} = {ARITHMETIC_EXPRESSIONS[opcode].format(b=b, c=c)}")
+    elif opcode == OPCODES["LDI"]:
+        lines.append(f"{indent}r{a} = {b << 4 | c}")
+    else:
+        access = "load from" if opcode == OPCODES["LD"] else "store to"
+        lines.append(f"{indent}cell = cell_of[r{b}]")
+        lines.append(f"{indent}if cell < 0:")
+        lines.append(f"{indent}    raise Exception(f\"Instruction {index + 1}: {access} invalid address {{hex(r{b})}}.\")")
+        lines.append(f"{indent}r{a} = mem[cell]" if opcode == OPCODES["LD"] else f"{indent}mem[cell] = r{a}")
+
+def generate_block_source(block:tuple, base:int, entries:frozenset) -> str:
+    '''Generates the source of a function that runs a block from any of its entries, see BlockTranslation.'''
+    segments = get_segments(block, entries)
+    used = sorted({register for instruction in block for register in instruction[1:4]})
+    written = sorted({instruction[1] for instruction in block if instruction[0] in ARITHMETIC_EXPRESSIONS
+                      or instruction[0] in (OPCODES["LDI"], OPCODES["LD"])})
+    #branches usually go back to the start of the loop they close, so the nearest entry before a branch is checked first
+    entry_addresses = [(entry, convert_index_to_address(base + entry)) for entry in sorted(entries, reverse=True)]
+
+    #branches that can be taken, as BRLT Rx, Ry, Ry never is
+    branches = [base + offset for offset in range(min(entries), len(block))
+                if is_branch(block[offset][0]) and not (block[offset][0] == OPCODES["BRLT"] and block[offset][2] == block[offset][3])]
+
+    lines = ["def run_block(regs, mem, counts, taken_counts, pc, trips_left):"]
+    lines += [f"    r{register} = regs[{register}]" for register in used]
+    lines += [f"    n{number} = 0" for number in range(len(segments))]
+    lines += [f"    t{index} = 0" for index in branches]
+    lines.append("    while True:")
+    for number, (start, end) in enumerate(segments):
+        if start in entries:
+            lines.append(f"        if pc <= {start}:")
+        lines.append(f"            n{number} += 1")
+        for offset in range(start, end):
+            if is_branch(block[offset][0]):
+                #a segment runs once for each jump back made by the branch that ends it, so its count limits the jumps
+                ordered = sorted(entry_addresses, key=lambda entry_address: entry_address[0] > offset)
+                generate_branch(lines, block[offset], base + offset, ordered, f"n{number}", "            ")
+            else:
+                generate_instruction(lines, block[offset], base + offset, "            ")
+    lines.append(f"        nxt = {base + len(block)}")
+    lines.append("        break")
+    lines += [f"    regs[{register}] = r{register}" for register in written]
+    for number, (start, end) in enumerate(segments):
+        for offset in range(start, end):
+            lines.append(f"    counts[{base + offset}] += n{number}")
+    lines += [f"    taken_counts[{index}] += t{index}" for index in branches]
+    executed = " + ".join(f"n{number} * {end - start}" for number, (start, end) in enumerate(segments))
+    lines.append(f"    return nxt, {executed}")
+    return "\n".join(lines) + "\n"
+
+def convert_index_to_address(index:int) -> int:
+    '''Converts an instruction index into the custom hex address that branches use to reach it.'''
+    return ((index // INSTRUCTIONS_PER_BLOCK) + 1) << 4 | ((index % INSTRUCTIONS_PER_BLOCK) + 1)
+
+class TranslationCache:
+    '''TranslationCache : Class
+    Translations of blocks, keyed by the position and contents of the block.
+
+    Attributes:
+    translations:dict -- (index of the first instruction, block contents) : BlockTranslation with every entry seen so far
+    translated:int -- number of times a block was translated (including again, for a new entry)
+    '''
+    def __init__(self):
+        self.translations = {}
+        self.translated = 0
+
+    def get(self, block:tuple, base:int, entry:int) -> BlockTranslation:
+        '''Returns the translation of a block that can start at entry, translating it if needed.'''
+        translation = self.translations.get((base, block))
+        if translation is not None and entry in translation.entries:
+            return translation
+        entries = frozenset([entry]) if translation is None else translation.entries | {entry}
+        translation = BlockTranslation(block, base, entries)
+        self.translations[(base, block)] = translation
+        self.translated += 1
+        return translation
+
+DEFAULT_CACHE = TranslationCache()
+'''Cache shared by every run that doesn't pass its own.'''
+
+def step(program:list, index:int, regs:list, mem:list, taken_counts:list=None) -> int:
+    '''Runs the single instruction at index, as run() in simulator.py does. Returns the index of the next instruction.
+    If taken_counts is given, a branch that is taken is counted in it.
+    '''
+    opcode, a, b, c = program[index]
+    index += 1
+    if opcode == OPCODES["ADD"]:
+        regs[a] = (regs[b] + regs[c]) & WORD_MASK
+    elif opcode == OPCODES["SUB"]:
+        regs[a] = (regs[b] - regs[c]) & WORD_MASK
+    elif opcode == OPCODES["AND"]:
+        regs[a] = regs[b] & regs[c]
+    elif opcode == OPCODES["OR"]:
+        regs[a] = regs[b] | regs[c]
+    elif opcode == OPCODES["LS"]:
+        regs[a] = (regs[b] << 1) & WORD_MASK
+    elif opcode == OPCODES["RS"]:
+        regs[a] = regs[b] >> 1
+    elif opcode == OPCODES["NOT"]:
+        regs[a] = ~regs[b] & WORD_MASK
+    elif opcode == OPCODES["LDI"]:
+        regs[a] = b << 4 | c
+    elif opcode == OPCODES["LD"] or opcode == OPCODES["STR"]:
+        cell = DATA_CELL_OF_ADDRESS[regs[b]]
+        if cell < 0:
+            access = "load from" if opcode == OPCODES["LD"] else "store to"
+            raise Exception(f"Instruction {index}: {access} invalid address {hex(regs[b])}.")
+        if opcode == OPCODES["LD"]:
+            regs[a] = mem[cell]
+        else:
+            mem[cell] = regs[a]
+    elif regs[b] == regs[c] if opcode == OPCODES["BRE"] else regs[b] < regs[c]:
+        if taken_counts is not None:
+            taken_counts[index - 1] += 1
+        target = regs[a]
+        if target >> 4 < 1 or target & 0xF < 1:
+            raise Exception(f"Instruction {index}: branch to invalid address {hex(target)}.")
+        index = ((target >> 4) - 1) * INSTRUCTIONS_PER_BLOCK + (target & 0xF) - 1
+    return index
+
+def run_compiled(machine_code:list, registers:list=None, memory:list=None, max_cycles:int=DEFAULT_MAX_CYCLES,
+                 cache:TranslationCache=None) -> SimulationResult:
+    '''Runs machine code like run() in simulator.py, with the same arguments and results, translating each block into a function.'''
+    program = decode_program(machine_code)
+    length = len(program)
+    cache = cache if cache is not None else DEFAULT_CACHE
+
+    regs = [0] * (NUMBER_OF_REGISTERS + 1)
+    if registers is not None:
+        if len(registers) != NUMBER_OF_REGISTERS:
+            raise Exception(f"registers must contain {NUMBER_OF_REGISTERS} values.")
+        regs[1:] = [value & WORD_MASK for value in registers]
+    mem = [0] * DATA_MEMORY_CELLS
+    if memory is not None:
+        if len(memory) != DATA_MEMORY_CELLS:
+            raise Exception(f"memory must contain {DATA_MEMORY_CELLS} values.")
+        mem[:] = [value & WORD_MASK for value in memory]
+
+    counts = [0] * length
+    taken_counts = [0] * length
+    page_load_counts = [0] * length
+    blocks = [tuple(program[start:start + INSTRUCTIONS_PER_BLOCK]) for start in range(0, length, INSTRUCTIONS_PER_BLOCK)]
+    #page frames hold [block number, translation of the block or None], the block executed most recently is last
+    frames = []
+    page_loads = 0
+    index = 0
+    cycles = 0
+
+    while index < length:
+        block = index // INSTRUCTIONS_PER_BLOCK
+        if len(frames) == 0 or frames[-1][0] != block:
+            frame = next((frame for frame in frames if frame[0] == block), None)
+            if frame is None:
+                page_loads += 1
+                page_load_counts[index] += 1
+                if len(frames) == PAGE_FRAMES:
+                    #the frame that isn't currently executing is swapped, dropping the translation of its old block
+                    frames.pop(0)
+                frame = [block, None]
+            else:
+                frames.remove(frame)
+            frames.append(frame)
+        frame = frames[-1]
+
+        remaining = max_cycles - cycles
+        if remaining < 2 * TRIP_LENGTH:
+            #close to the cycle limit, run one instruction at a time so that the limit is exact
+            if remaining <= 0:
+                raise Exception(f"Program did not finish within {max_cycles} cycles.")
+            counts[index] += 1
+            cycles += 1
+            index = step(program, index, regs, mem, taken_counts)
+            continue
+
+        base = block * INSTRUCTIONS_PER_BLOCK
+        offset = index - base
+        if frame[1] is None or offset not in frame[1].entries:
+            frame[1] = cache.get(blocks[block], base, offset)
+        #each jump back to an entry is followed by at most TRIP_LENGTH instructions, and each branch can jump back
+        #trips_left times, so the function can't pass the cycle limit
+        trips_left = (remaining // TRIP_LENGTH - 1) // frame[1].branch_count
+        index, executed = frame[1].function(regs, mem, counts, taken_counts, offset, trips_left)
+        cycles += executed
+
+    return SimulationResult(registers=regs[1:], memory=mem, cycles=cycles, page_loads=page_loads, execution_counts=counts,
+                            taken_counts=taken_counts, page_load_counts=page_load_counts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a machine code program by translating its blocks into Python functions, "
+                                                 "and prints the final register and memory state.")
+    parser.add_argument("filename", help="program name, reading programs/machine code/<filename>_converted.bin, or .txt if there is no .bin")
+    parser.add_argument("--max-cycles", type=int, default=DEFAULT_MAX_CYCLES)
+    parser.add_argument("--compare", action="store_true", help="also run the program with simulator.py, checking the results match and timing both")
+    args = parser.parse_args()
+
+    path = get_machine_code_path(args.filename)
+    if is_binary_machine_code_file(path):
+        with MachineCodeFile(path) as machine_code_file:
+            machine_code = machine_code_file.to_list()
+    else:
+        machine_code = read_machine_code_file(path)
+    start = time.perf_counter()
+    result = run_compiled(machine_code, max_cycles=args.max_cycles)
+    first_seconds = time.perf_counter() - start
+    print(result)
+    if args.compare:
+        start = time.perf_counter()
+        run_compiled(machine_code, max_cycles=args.max_cycles)
+        cached_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = run(machine_code, max_cycles=args.max_cycles)
+        interpreted_seconds = time.perf_counter() - start
+        same = vars(result) == vars(expected)
+        print(f"Translated: {first_seconds*1000:.2f} ms, {cached_seconds*1000:.2f} ms with the blocks already translated "
+              f"({DEFAULT_CACHE.translated} translations), interpreted: {interpreted_seconds*1000:.2f} ms "
+              f"(speedup {interpreted_seconds / cached_seconds:.1f}x), results {'match' if same else 'differ'}")
+        if not same:
+            raise SystemExit(1)
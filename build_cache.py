@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+
+'''Content-addressed cache of build outputs, shared by assembler.py and schematic_generator.py.
+Each output is recorded with a key: a hash of everything it was built from (the program text or block contents,
+the version of the tool that built it, and any options). An output only needs rebuilding if its key has changed
+or the file is missing. The keys are stored as JSON in .build_cache.json, in the folder the tools are run from.
+'''
+
+DEFAULT_CACHE_PATH = ".build_cache.json"
+
+def hash_key(*parts) -> str:
+    '''Returns a hex SHA-256 hash of the given parts, which must be serialisable as JSON.'''
+    text = json.dumps(parts, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class BuildCache:
+    '''BuildCache : Class
+
+    Attributes:
+    path:str -- file the cache is loaded from and saved to
+    entries:dict -- output name : key it was last built with
+    '''
+    def __init__(self, path:str=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as cache_file:
+                    self.entries = json.load(cache_file)
+            except (OSError, ValueError):
+                #a damaged cache only means everything is rebuilt
+                self.entries = {}
+
+    def is_current(self, output_name:str, key:str, output_path:str=None) -> bool:
+        '''Returns True if output_name was last built with key, and output_path (if given) still exists.'''
+        if self.entries.get(output_name) != key:
+            return False
+        return output_path is None or os.path.isfile(output_path)
+
+    def update(self, output_name:str, key:str) -> None:
+        '''Records that output_name has been built with key.'''
+        self.entries[output_name] = key
+
+    def remove(self, output_name:str) -> None:
+        '''Forgets output_name, if it is recorded.'''
+        self.entries.pop(output_name, None)
+
+    def names_with_prefix(self, prefix:str) -> list:
+        '''Returns the recorded output names that begin with prefix.'''
+        return [name for name in self.entries.keys() if name.startswith(prefix)]
+
+    def save(self) -> None:
+        '''Writes the cache to its file, replacing it in one step so that an interrupted save can't damage it.'''
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
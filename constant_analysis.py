@@ -0,0 +1,111 @@
+from assembler import ALLOCATABLE_REGISTERS, IMMEDIATE_OPERAND, Instruction, get_operand_value, get_operands, is_operand_immediate
+from register_allocator import get_label_positions, get_reads_and_writes, get_successors, is_branch
+
+'''Constant propagation over the control-flow graph of a program, used by the assembler to find the registers that hold a
+known value at each instruction, and by the peephole optimizer to fold constants.
+The analysis follows every path through the program: a register holds a known value before an instruction if it holds that
+same value on every path that reaches it. R1 to R14 start at 0 (R15 is never assumed to hold a value), and an instruction whose operands are all known gives a
+known result, so values carry through loops and past branches as long as no path changes them.
+'''
+
+def get_source_value(operand:str, values:dict):
+    '''Returns the value of an operand: the value of an immediate, or the known value of a register from values (None if unknown).'''
+    if is_operand_immediate(operand):
+        return get_operand_value(operand)
+    return values.get(operand)
+
+def evaluate(instruction:Instruction, values:dict):
+    '''Returns the value an instruction writes, given dict of register operand : known value. Returns None if it isn't known.'''
+    opcode_str = instruction.opcode_str
+    operands = instruction.operands
+    if opcode_str == "LDI":
+        #a label address is kept as the label name, which is only equal to itself
+        return get_operand_value(operands[1]) if instruction.kinds[1] == IMMEDIATE_OPERAND else operands[1]
+    sources = [value if kind == IMMEDIATE_OPERAND else values.get(operand)
+               for operand, kind, value in zip(operands[1:], instruction.kinds[1:], instruction.values[1:])]
+    if opcode_str == "LD" or any(not isinstance(source, int) for source in sources):
+        return None
+    if opcode_str == "ADD":
+        return (sources[0] + sources[1]) & 0xFF
+    if opcode_str == "SUB":
+        return (sources[0] - sources[1]) & 0xFF
+    if opcode_str == "AND":
+        return sources[0] & sources[1]
+    if opcode_str == "OR":
+        return sources[0] | sources[1]
+    if opcode_str == "LS":
+        return (sources[0] << 1) & 0xFF
+    if opcode_str == "RS":
+        return sources[0] >> 1
+    if opcode_str == "NOT":
+        return ~sources[0] & 0xFF
+    return None
+
+def evaluate_branch(instruction:Instruction, values:dict):
+    '''Returns True if a branch is always taken, False if it is never taken, or None if it depends on unknown values.'''
+    opcode_str = instruction.opcode_str
+    operands = instruction.operands
+    if operands[1] == operands[2]:
+        return opcode_str == "BRE"
+    first, second = get_source_value(operands[1], values), get_source_value(operands[2], values)
+    if not isinstance(first, int) or not isinstance(second, int):
+        return None
+    return first == second if opcode_str == "BRE" else first < second
+
+def run_forward_dataflow(instruction_count:int, successors:list, entry_state:dict, transfer) -> list:
+    '''Returns, for each instruction, the dict holding before it runs on every path to it, or None if it can't be reached.
+    transfer(instruction_index, state) returns the dict after the instruction. Entries that differ between paths are dropped.
+    '''
+    states = [None] * instruction_count
+    if len(states) == 0:
+        return states
+    states[0] = dict(entry_state)
+    worklist = [0]
+    while worklist:
+        instruction_index = worklist.pop()
+        state_after = transfer(instruction_index, states[instruction_index])
+        for following in successors[instruction_index]:
+            if following >= len(states):
+                continue
+            if states[following] is None:
+                merged = dict(state_after)
+            else:
+                merged = {key: value for key, value in states[following].items() if state_after.get(key, None) == value}
+            if merged != states[following]:
+                states[following] = merged
+                worklist.append(following)
+    return states
+
+def find_constant_values(instructions:list, successors:list, input_registers=()) -> list:
+    '''Returns, for each instruction, dict of register operand : value known to be in it before the instruction runs
+    (None for unreachable instructions). R1 to R14 start at 0, apart from input_registers (register numbers),
+    whose starting values are given when the program is run. Label addresses are represented by the label name.
+    '''
+    def transfer(instruction_index:int, state:dict) -> dict:
+        instruction = instructions[instruction_index]
+        reads, writes = get_reads_and_writes(instruction)
+        if len(writes) == 0:
+            return state
+        state_after = dict(state)
+        value = evaluate(instruction, state)
+        if value is None:
+            state_after.pop(writes[0], None)
+        else:
+            state_after[writes[0]] = value
+        return state_after
+
+    entry_state = {f"R{register}": 0 for register in ALLOCATABLE_REGISTERS if register not in input_registers}
+    return run_forward_dataflow(len(instructions), successors, entry_state, transfer)
+
+def find_known_values(instructions:list, input_registers=()) -> list:
+    '''Returns, for each instruction of a program in source form (labels declared, custom branches converted),
+    dict of register operand : value known to be in it before the instruction runs, or None if it can't be reached.
+    Nothing is assumed about the starting values of input_registers (register numbers).
+    If a branch target isn't a label, the instructions it can reach aren't known, so nothing is known about any instruction.
+    '''
+    label_positions = get_label_positions(instructions)
+    for instruction in instructions:
+        if is_branch(instruction) and get_operands(instruction)[0] not in label_positions:
+            return [{} for instruction in instructions]
+    successors = get_successors(instructions, label_positions)
+    return find_constant_values(instructions, successors, input_registers)
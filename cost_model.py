@@ -0,0 +1,102 @@
+import json
+
+from assembler import OPCODES
+
+'''Estimates how long programs take to run in the world, in redstone ticks, rather than in instructions.
+Each opcode takes its own number of ticks (an ADD waits on the carry chain, an LD or STR on data memory), and two events add to that:
+- taken_branch: extra ticks when a BRE or BRLT is taken, for the program counter to be loaded with the target address
+- page_load: ticks to copy a block of 15 instructions from secondary storage into a page frame
+The default costs are estimates, so measure the CPU in the world and pass a JSON file of the real costs (see read_cost_model)
+to get accurate times. A redstone tick is 0.1 seconds when the game runs at full speed.
+'''
+
+TICK_SECONDS = 0.1
+'''Seconds per redstone tick, at 20 game ticks per second.'''
+
+DEFAULT_OPCODE_TICKS = {
+    "ADD":10,
+    "SUB":10,
+    "NOT":6,
+    "AND":6,
+    "OR":6,
+
+    "LS":6,
+    "RS":6,
+
+    "LD":12,
+    "LDI":6,
+    "STR":12,
+
+    "BRE":8,
+    "BRLT":10
+}
+'''Dict of opcode : redstone ticks to fetch, decode and execute one instruction with that opcode.'''
+
+DEFAULT_EVENT_TICKS = {
+    "taken_branch":6,
+    "page_load":150
+}
+'''Dict of event : redstone ticks it adds on top of the instruction that causes it.'''
+
+if set(DEFAULT_OPCODE_TICKS) != set(OPCODES):
+    raise Exception("DEFAULT_OPCODE_TICKS must have a cost for every opcode in OPCODES.")
+
+class CostModel:
+    '''CostModel : Class
+    Number of redstone ticks each opcode and event takes.
+
+    Attributes:
+    opcode_ticks:dict -- ticks of each opcode, in the form "ADD":ticks, with an entry for every opcode in OPCODES
+    event_ticks:dict -- ticks of each event in DEFAULT_EVENT_TICKS, in the form "page_load":ticks
+    ticks_of_opcode:list -- ticks of each opcode indexed by opcode number, for costing machine code
+    '''
+    def __init__(self, opcode_ticks:dict=None, event_ticks:dict=None):
+        '''Costs not given in opcode_ticks or event_ticks keep their default values.'''
+        self.opcode_ticks = dict(DEFAULT_OPCODE_TICKS)
+        self.event_ticks = dict(DEFAULT_EVENT_TICKS)
+        for costs, defaults, name in ((opcode_ticks, self.opcode_ticks, "opcode"), (event_ticks, self.event_ticks, "event")):
+            for key, ticks in (costs or {}).items():
+                if key not in defaults:
+                    raise Exception(f"Unknown {name} {key} in cost model.")
+                if not isinstance(ticks, (int, float)) or ticks < 0:
+                    raise Exception(f"Cost of {key} must be a number of ticks that isn't negative.")
+                defaults[key] = ticks
+        self.ticks_of_opcode = [0] * (max(OPCODES.values()) + 1)
+        for opcode_str, opcode in OPCODES.items():
+            self.ticks_of_opcode[opcode] = self.opcode_ticks[opcode_str]
+
+    def instruction_ticks(self, opcode_str:str) -> float:
+        '''Returns the ticks an instruction with the given opcode takes, not including any events it causes.'''
+        return self.opcode_ticks[opcode_str]
+
+    def get_instruction_ticks(self, machine_code:list, result) -> list:
+        '''Returns the ticks spent on each instruction of the machine code during the run that gave result (a simulator.SimulationResult):
+        its executions, the times it was a taken branch, and the page loads made to run it.
+        '''
+        if result.taken_counts is None or result.page_load_counts is None:
+            raise Exception("The simulation result must record taken branches and page loads (use simulator.run).")
+        taken_branch, page_load = self.event_ticks["taken_branch"], self.event_ticks["page_load"]
+        return [result.execution_counts[index]*self.ticks_of_opcode[int(instruction[0])] + result.taken_counts[index]*taken_branch
+                + result.page_load_counts[index]*page_load for index, instruction in enumerate(machine_code)]
+
+    def estimate_ticks(self, machine_code:list, result) -> float:
+        '''Returns the total ticks of the run that gave result.'''
+        return sum(self.get_instruction_ticks(machine_code, result))
+
+    def to_dict(self) -> dict:
+        return {"opcodes": dict(self.opcode_ticks), "events": dict(self.event_ticks)}
+
+def ticks_to_seconds(ticks:float) -> float:
+    '''Converts redstone ticks into seconds of game time.'''
+    return ticks * TICK_SECONDS
+
+def read_cost_model(path:str) -> CostModel:
+    '''Reads a cost model from a JSON file in the form {"opcodes": {"ADD": 10, ...}, "events": {"page_load": 150, ...}}.
+    Either part, and any cost within it, can be left out to keep the default.
+    '''
+    with open(path, 'r') as input_file:
+        costs = json.load(input_file)
+    unknown_keys = set(costs) - {"opcodes", "events"}
+    if len(unknown_keys) > 0:
+        raise Exception(f"Unknown cost model sections: {', '.join(sorted(unknown_keys))}.")
+    return CostModel(costs.get("opcodes"), costs.get("events"))
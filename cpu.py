@@ -0,0 +1,108 @@
+import argparse
+import sys
+
+'''Single entry point for the build tools, with a subcommand for each step:
+- assemble: converts programs/<name>.txt into machine code, as assembler.py does
+- schematic: generates the schematics of a program from its machine code file, as schematic_generator.py does
+- build: assembles programs and generates their schematics in one process, passing the machine code straight from the assembler
+  to the schematic generator rather than reading it back from a file, and loading the build cache once for every program
+- link: assembles modules into object files and links them into one program, as linker.py does
+Only the modules a subcommand needs are imported, so starting it takes as little time as possible when it is run many times by scripts.
+'''
+
+COMMANDS = {
+    "assemble": "convert programs/<name>.txt into machine code",
+    "schematic": "generate WorldEdit schematics from a program's machine code file",
+    "build": "assemble programs and generate their schematics in one step",
+    "link": "assemble modules into object files and link them into one program",
+}
+'''Dict of subcommand : description.'''
+
+def add_command_arguments(command:str, parser:argparse.ArgumentParser) -> None:
+    '''Adds the options of a subcommand to its parser, importing the modules that define them.'''
+    if command == "assemble":
+        import assembler
+        parser.add_argument("filename", nargs="?", help="program name, reading programs/<filename>.txt")
+        assembler.add_arguments(parser)
+        parser.add_argument("-v", "--verbose", action="store_true", help="print the source, converted assembly and machine code instructions")
+    elif command == "schematic":
+        import schematic_generator
+        parser.add_argument("filename", help="program name, reading programs/machine code/<filename>_converted.bin, or .txt if there is no .bin")
+        schematic_generator.add_arguments(parser)
+        parser.add_argument("-v", "--verbose", action="store_true", help="print the machine code instructions")
+    elif command == "build":
+        import assembler
+        import schematic_generator
+        parser.add_argument("filenames", nargs="+", metavar="filename", help="program names, reading programs/<filename>.txt")
+        assembler.add_arguments(parser, batch=False, profile=False)
+        schematic_generator.add_arguments(parser)
+        #both steps have a --force option, replaced by one that applies to both
+        parser.add_argument("--force", action="store_true", help="rebuild the machine code and every block schematic, even if they are up to date")
+    elif command == "link":
+        import linker
+        linker.add_arguments(parser)
+
+def create_parser(command:str) -> argparse.ArgumentParser:
+    '''Returns the command line parser. Only the options of the given subcommand are added, so only its modules are imported.'''
+    parser = argparse.ArgumentParser(description="Assembles programs for the CPU and generates their WorldEdit schematics.")
+    subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for name, description in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=description, description=description, conflict_handler="resolve")
+        if name == command:
+            add_command_arguments(name, subparser)
+    return parser
+
+def build(args:argparse.Namespace) -> int:
+    '''Assembles each program in args.filenames and generates its schematics. Returns the exit status.'''
+    import assembler
+    import schematic_generator
+    from build_cache import BuildCache
+    from machine_code_format import get_binary_path, read_machine_code
+
+    cache = BuildCache()
+    options = assembler.get_options(args)
+    failures = 0
+    for filename in args.filenames:
+        try:
+            source, machine_code = assembler.assemble_program(filename, options, cache, force=args.force, write_text=not args.no_text)
+            if machine_code is None:
+                #up to date machine code is mapped from the binary file rather than parsed from text
+                instructions = read_machine_code(get_binary_path(assembler.get_output_path(filename)))
+                print(f"{filename}: machine code is up to date")
+            else:
+                for report in machine_code.reports:
+                    print(report)
+                instructions = machine_code.instructions
+                print(f"{filename}: {len(instructions)} instructions")
+
+            generated_blocks = schematic_generator.generate_schematics(instructions, filename, cache, force=args.force, workers=args.workers,
+                                                                       compression_level=args.compression_level)
+            print(f"{filename}: generated {len(generated_blocks)} block schematic(s): {generated_blocks}")
+            if args.combined and schematic_generator.generate_combined_schematic(instructions, filename, cache, force=args.force,
+                                                                                 compression_level=args.compression_level,
+                                                                                 block_spacing=args.block_spacing):
+                print(f"{filename}: generated {schematic_generator.get_combined_schematic_path(filename)}")
+        except Exception as e:
+            failures += 1
+            print(f"{filename}: failed - {e}")
+    cache.save()
+    return 1 if failures > 0 else 0
+
+def main(argv:list) -> int:
+    '''Runs the subcommand given in argv (the command line arguments, without the script name). Returns the exit status.'''
+    command = argv[0] if len(argv) > 0 else None
+    parser = create_parser(command)
+    args = parser.parse_args(argv)
+    if args.command == "assemble":
+        import assembler
+        return assembler.run_command(args, parser)
+    if args.command == "schematic":
+        import schematic_generator
+        return schematic_generator.run_command(args)
+    if args.command == "link":
+        import linker
+        return linker.run_command(args)
+    return build(args)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,424 @@
+import argparse
+import concurrent.futures
+import random
+import time
+
+from assembler import (MACRO_OPCODES, AssemblerOptions, assemble, begins_with_label, get_opcode_str, get_operand_value, get_operands,
+                       is_operand_immediate, parse_source)
+from macro_expander import evaluate_macro
+from peephole_optimizer import find_result_registers
+from simulator import DATA_CELL_OF_ADDRESS, DATA_MEMORY_CELLS, NUMBER_OF_REGISTERS, SimulationResult, data_cell_to_address, run
+
+'''Differential fuzzer for the assembler. It generates random programs in the assembly language accepted by the assembler
+(labels, immediates, macros and the BRU/BRZ/BRGT branches that have to be converted), assembles each one with several sets of options,
+and runs both the source program, by interpreting the assembly language directly, and the machine code, on the simulator.
+Any difference in the final data memory, or in the registers the source program writes to, is a bug in a pass of the assembler.
+
+The generated programs always finish: branches only go forwards, except for loops that count down a register that nothing else
+in the loop writes to. Programs use R1-R5 and a few immediate values and labels, so that nearly all of them fit in the registers;
+the few that the assembler runs out of registers for are skipped, as that is a limit of the CPU rather than a bug.
+Programs are checked in parallel across a pool of processes, and each program that fails is shrunk, by removing instructions
+and simplifying immediates for as long as it still fails the same way, to give a short program that reproduces the bug.
+'''
+
+DEFAULT_MAX_CYCLES = 20_000
+DATA_REGISTERS = ["R1", "R2", "R3", "R4"]
+LOOP_COUNTER_REGISTER = "R5"
+ARITHMETIC_OPCODES = ["ADD", "SUB", "AND", "OR"]
+UNARY_OPCODES = ["LS", "RS", "NOT"]
+CONDITIONAL_BRANCH_OPCODES = ["BRE", "BRLT", "BRGT", "BRZ"]
+MAX_IMMEDIATES = 5
+MAX_LABELS = 4
+OUT_OF_REGISTERS_MESSAGE = "Run out of registers to use."
+
+OPTION_SETS = {
+    "default": AssemblerOptions(),
+    "allocate-registers": AssemblerOptions(allocate_registers=True),
+    "optimize-layout": AssemblerOptions(optimize_layout=True),
+    "O1": AssemblerOptions(optimization_level=1),
+    "O2": AssemblerOptions(optimization_level=2),
+    "O2-allocate-registers-optimize-layout": AssemblerOptions(optimize_layout=True, allocate_registers=True, optimization_level=2),
+}
+'''Option sets each program is assembled with, by name.'''
+
+MODULE_OPTION_SETS = {
+    "module": AssemblerOptions(),
+    "module-O1": AssemblerOptions(optimization_level=1),
+    "module-O2-optimize-layout": AssemblerOptions(optimize_layout=True, optimization_level=2),
+}
+'''Option sets each program is assembled with as a module (see linker), by name. Modules are run from random starting registers,
+as a module's registers are set by the modules that run before it.'''
+
+def get_source_value(operand:str, registers:list) -> int:
+    '''Returns the value of an operand: an immediate, or the value of a register in registers (index 0 unused).'''
+    if is_operand_immediate(operand):
+        return get_operand_value(operand) & 0xFF
+    return registers[get_operand_value(operand)]
+
+def get_data_cell(address:int, instruction_number:int) -> int:
+    cell = DATA_CELL_OF_ADDRESS[address]
+    if cell < 0:
+        raise Exception(f"Line {instruction_number}: access to invalid address {hex(address)}.")
+    return cell
+
+def run_source(instructions:list, max_cycles:int=DEFAULT_MAX_CYCLES, registers:list=None) -> SimulationResult:
+    '''Runs a program in the assembly language accepted by the assembler (as returned by parse_source), without assembling it:
+    immediates are used directly and branches go straight to their labels. Optional registers (R1-R15) give the starting values
+    of the registers, and otherwise they start at 0 like the memory, as on the CPU.
+    Raises an exception if the program accesses memory outside the 60 cells or runs for more than max_cycles instructions.
+    '''
+    program = [instruction for instruction in instructions if not instruction.is_comment()]
+    labels = {instruction.label: index for index, instruction in enumerate(program) if begins_with_label(instruction)}
+    registers = [0] + (list(registers) if registers is not None else [0] * NUMBER_OF_REGISTERS)
+    memory = [0] * DATA_MEMORY_CELLS
+    counts = [0] * len(program)
+    index = 0
+    cycles = 0
+    while index < len(program):
+        if cycles >= max_cycles:
+            raise Exception(f"Program did not finish within {max_cycles} cycles.")
+        instruction = program[index]
+        opcode_str = get_opcode_str(instruction)
+        operands = get_operands(instruction)
+        counts[index] += 1
+        cycles += 1
+        index += 1
+
+        if opcode_str in ("BRU", "BRE", "BRLT", "BRGT", "BRZ"):
+            if operands[0] not in labels:
+                raise Exception(f"Line {index}: label {operands[0]} is not declared.")
+            sources = [get_source_value(operand, registers) for operand in operands[1:]]
+            if opcode_str == "BRU":
+                taken = True
+            elif opcode_str == "BRZ":
+                taken = sources[0] == 0
+            elif opcode_str == "BRE":
+                taken = sources[0] == sources[1]
+            elif opcode_str == "BRLT":
+                taken = sources[0] < sources[1]
+            else:
+                taken = sources[0] > sources[1]
+            if taken:
+                index = labels[operands[0]]
+        elif opcode_str == "STR":
+            memory[get_data_cell(get_source_value(operands[1], registers), index)] = get_source_value(operands[0], registers)
+        else:
+            sources = [get_source_value(operand, registers) for operand in operands[1:]]
+            if opcode_str == "LDI":
+                value = sources[0]
+            elif opcode_str == "LD":
+                value = memory[get_data_cell(sources[0], index)]
+            elif opcode_str == "ADD":
+                value = sources[0] + sources[1]
+            elif opcode_str == "SUB":
+                value = sources[0] - sources[1]
+            elif opcode_str == "AND":
+                value = sources[0] & sources[1]
+            elif opcode_str == "OR":
+                value = sources[0] | sources[1]
+            elif opcode_str == "LS":
+                value = sources[0] << 1
+            elif opcode_str == "RS":
+                value = sources[0] >> 1
+            elif opcode_str == "NOT":
+                value = ~sources[0]
+            elif opcode_str in MACRO_OPCODES:
+                value = evaluate_macro(opcode_str, sources)
+            else:
+                raise Exception(f"Line {index}: unknown opcode {opcode_str}.")
+            registers[get_operand_value(operands[0])] = value & 0xFF
+    return SimulationResult(registers=registers[1:], memory=memory, cycles=cycles, page_loads=0, execution_counts=counts)
+
+class ProgramGenerator:
+    '''ProgramGenerator : Class
+    Generates random programs that always finish, as lists of source lines.
+
+    Attributes:
+    rng:random.Random -- source of randomness
+    immediates:list -- immediate values the program uses, including some data memory addresses
+    lines:list -- source lines generated so far, without labels
+    labels:dict -- line index : label declared at it
+    pending_label:list -- [label, number of instructions until it is declared] for a forward branch that hasn't reached its label, or None
+    label_count:int -- number of labels used
+    '''
+    def __init__(self, rng:random.Random):
+        self.rng = rng
+        addresses = [data_cell_to_address(cell) for cell in rng.sample(range(DATA_MEMORY_CELLS), 2)]
+        self.immediates = addresses + [rng.randrange(256) for i in range(rng.randint(1, MAX_IMMEDIATES - 3))] + [0]
+        self.lines = []
+        self.labels = {}
+        self.pending_label = None
+        self.label_count = 0
+
+    def operand(self, registers:list=DATA_REGISTERS) -> str:
+        if self.rng.random() < 0.35:
+            return f"#{self.rng.choice(self.immediates)}"
+        return self.rng.choice(registers)
+
+    def new_label(self) -> str:
+        self.label_count += 1
+        return f"label{self.label_count}"
+
+    def emit(self, line:str) -> None:
+        '''Adds a line, declaring the pending label at it if its forward branch has reached it.'''
+        if self.pending_label is not None:
+            self.pending_label[1] -= 1
+            if self.pending_label[1] <= 0:
+                self.labels[len(self.lines)] = self.pending_label[0]
+                self.pending_label = None
+        self.lines.append(line)
+
+    def straight_line_instruction(self) -> str:
+        rng = self.rng
+        choice = rng.random()
+        destination = rng.choice(DATA_REGISTERS)
+        if choice < 0.4:
+            return f"{rng.choice(ARITHMETIC_OPCODES)} {destination}, {self.operand()}, {self.operand()}"
+        if choice < 0.55:
+            return f"{rng.choice(UNARY_OPCODES)} {destination}, {self.operand()}"
+        if choice < 0.7:
+            return f"LDI {destination}, #{rng.choice(self.immediates)}"
+        address = f"#{rng.choice(self.immediates[:2])}"
+        if choice < 0.85:
+            return f"STR {self.operand()}, {address}" if rng.random() < 0.5 else f"STR {destination}, {address}"
+        if choice < 0.93:
+            return f"LD {destination}, {address}"
+        return self.macro_instruction(destination)
+
+    def macro_instruction(self, destination:str) -> str:
+        opcode = self.rng.choice(MACRO_OPCODES)
+        if opcode == "MOVE":
+            return f"MOVE {destination}, {self.operand()}"
+        second = self.operand()
+        #dividing by a register that holds 0 is defined, but dividing by #0 is rejected by the assembler
+        if opcode in ("DIV", "MOD") and second == "#0":
+            second = "#1"
+        return f"{opcode} {destination}, {self.operand()}, {second}"
+
+    def forward_branch(self) -> str:
+        label = self.new_label()
+        self.pending_label = [label, self.rng.randint(1, 8)]
+        opcode = self.rng.choice(CONDITIONAL_BRANCH_OPCODES + ["BRU"])
+        if opcode == "BRU":
+            return f"BRU {label}"
+        if opcode == "BRZ":
+            return f"BRZ {label}, {self.operand()}"
+        return f"{opcode} {label}, {self.operand()}, {self.operand()}"
+
+    def counted_loop(self, body_length:int) -> None:
+        '''Adds a loop that runs its body a small number of times, counting down the loop counter register.'''
+        label = self.new_label()
+        self.emit(f"LDI {LOOP_COUNTER_REGISTER}, #{self.rng.randint(1, 4)}")
+        start = len(self.lines)
+        self.emit(self.straight_line_instruction())
+        self.labels[start] = label
+        for i in range(body_length - 1):
+            self.emit(self.straight_line_instruction())
+        self.emit(f"SUB {LOOP_COUNTER_REGISTER}, {LOOP_COUNTER_REGISTER}, #1")
+        if self.rng.random() < 0.5:
+            self.emit(f"BRGT {label}, {LOOP_COUNTER_REGISTER}, #0")
+        else:
+            self.emit(f"BRZ {label}_end, {LOOP_COUNTER_REGISTER}")
+            self.emit(f"BRU {label}")
+            self.label_count += 1
+            self.pending_label = [f"{label}_end", 1]
+
+    def generate(self, length:int) -> list:
+        '''Returns the lines of a program of about length instructions.'''
+        while len(self.lines) < length:
+            choice = self.rng.random()
+            can_add_label = self.label_count < MAX_LABELS and self.pending_label is None
+            if choice < 0.12 and can_add_label:
+                self.emit(self.forward_branch())
+            elif choice < 0.18 and can_add_label and self.label_count + 2 <= MAX_LABELS and \
+                    not any(line.startswith(f"LDI {LOOP_COUNTER_REGISTER}") for line in self.lines):
+                self.counted_loop(self.rng.randint(1, 5))
+            else:
+                self.emit(self.straight_line_instruction())
+        while self.pending_label is not None:
+            self.emit(self.straight_line_instruction())
+        return [f"{self.labels[index]}: {line}" if index in self.labels else line for index, line in enumerate(self.lines)]
+
+def generate_program(seed:int, max_length:int=40) -> str:
+    '''Returns the source of a random program that always finishes, the same for the same seed.'''
+    rng = random.Random(seed)
+    return "\n".join(ProgramGenerator(rng).generate(rng.randint(1, max_length)))
+
+def get_module_registers(source:str) -> list:
+    '''Returns the random starting values of R1-R15 that a program is run from when it is checked as a module, the same for the same source.'''
+    rng = random.Random(source)
+    return [rng.randrange(256) for register in range(NUMBER_OF_REGISTERS)]
+
+def get_option_set(name:str) -> tuple:
+    '''Returns (AssemblerOptions, True if the program is assembled as a module) of the option set with the given name.'''
+    if name in MODULE_OPTION_SETS:
+        return MODULE_OPTION_SETS[name], True
+    return OPTION_SETS[name], False
+
+def check_program(source:str, options:AssemblerOptions, max_cycles:int=DEFAULT_MAX_CYCLES, module:bool=False) -> str:
+    '''Assembles a program and compares the final state of its machine code with that of the source program.
+    If module is True, the program is assembled as a module and both are run from the registers given by get_module_registers().
+    Returns a description of the first difference, or an empty string if there is none (or the source program doesn't finish).
+    '''
+    instructions = parse_source(source)
+    registers = get_module_registers(source) if module else None
+    try:
+        expected = run_source(instructions, max_cycles, registers)
+    except Exception:
+        return ""
+    try:
+        machine_code = assemble(source, options, module=module)
+    except Exception as e:
+        #running out of registers for immediates and labels is a limit of the CPU, not a bug
+        if str(e) == OUT_OF_REGISTERS_MESSAGE:
+            return ""
+        return f"assembler raised: {e}"
+    try:
+        result = run(machine_code.instructions, registers=registers, max_cycles=max_cycles * 4)
+    except Exception as e:
+        return f"simulator raised: {e}"
+    if result.memory != expected.memory:
+        cell = next(cell for cell in range(DATA_MEMORY_CELLS) if result.memory[cell] != expected.memory[cell])
+        return f"memory differs: {hex(data_cell_to_address(cell))} is {result.memory[cell]}, expected {expected.memory[cell]}"
+    if options.optimization_level < 2:
+        for register in sorted(find_result_registers(instructions)):
+            if result.register(register) != expected.register(register):
+                return f"registers differ: R{register} is {result.register(register)}, expected {expected.register(register)}"
+    return ""
+
+def get_failure_kind(description:str) -> str:
+    '''Returns the kind of a failure (such as "memory differs"), which a shrunk program must keep failing with.'''
+    return description.split(":")[0]
+
+def check_seed(seed:int, max_length:int=40, max_cycles:int=DEFAULT_MAX_CYCLES) -> list:
+    '''Generates the program for a seed and checks it with every option set. Returns list of (seed, option set name, source, description) failures.'''
+    source = generate_program(seed, max_length)
+    failures = []
+    for name in list(OPTION_SETS) + list(MODULE_OPTION_SETS):
+        options, module = get_option_set(name)
+        description = check_program(source, options, max_cycles, module)
+        if description:
+            failures.append((seed, name, source, description))
+    return failures
+
+def check_seed_task(task:tuple) -> list:
+    '''Runs check_seed() for a (seed, max length, max cycles) task in a worker process.'''
+    return check_seed(*task)
+
+def is_valid_program(lines:list) -> bool:
+    '''Returns True if every label a program branches to is declared exactly once.'''
+    instructions = parse_source("\n".join(lines))
+    declared = [instruction.label for instruction in instructions if begins_with_label(instruction)]
+    if len(declared) != len(set(declared)):
+        return False
+    for instruction in instructions:
+        if get_opcode_str(instruction).startswith("BR") and get_operands(instruction)[0] not in declared:
+            return False
+    return True
+
+def remove_lines(lines:list, start:int, end:int) -> list:
+    '''Returns the program without lines start to end, moving a label declared on them to the next line that is kept.
+    Returns None if that isn't possible: more than one label is declared on them, or the next line already has a label.
+    '''
+    labels = [line.split(" ")[0] for line in lines[start:end] if line.split(" ")[0][-1:] == ":"]
+    remaining = lines[:start] + lines[end:]
+    if len(labels) == 0:
+        return remaining
+    if len(labels) > 1 or start >= len(remaining) or remaining[start].split(" ")[0][-1:] == ":":
+        return None
+    remaining[start] = labels[0] + " " + remaining[start]
+    return remaining
+
+def simplify_immediates(lines:list) -> list:
+    '''Returns list of programs with one immediate replaced by a smaller one that the program already uses, the smallest first,
+    so that simplifying never needs more registers for immediates.
+    '''
+    used = sorted({int(part.rstrip(",")[1:]) for line in lines for part in line.split(" ") if part.startswith("#")})
+    candidates = []
+    for line_index, line in enumerate(lines):
+        parts = line.split(" ")
+        for part_index, part in enumerate(parts):
+            immediate = part.rstrip(",")
+            if immediate.startswith("#"):
+                for smaller in [value for value in used if value < int(immediate[1:])]:
+                    new_parts = list(parts)
+                    new_parts[part_index] = part.replace(immediate, f"#{smaller}")
+                    candidates.append(lines[:line_index] + [" ".join(new_parts)] + lines[line_index + 1:])
+    return candidates
+
+def shrink_failure(source:str, options:AssemblerOptions, description:str, max_cycles:int=DEFAULT_MAX_CYCLES, module:bool=False) -> tuple:
+    '''Shrinks a failing program to a short one that fails the same way: removes runs of lines, from large to single lines,
+    then simplifies immediates, repeating until nothing more can be removed. Returns (source, description) of the shrunk program.
+    '''
+    kind = get_failure_kind(description)
+    lines = source.split("\n")
+
+    def still_fails(candidate:list) -> str:
+        if candidate is None or len(candidate) == 0 or not is_valid_program(candidate):
+            return ""
+        candidate_description = check_program("\n".join(candidate), options, max_cycles, module)
+        return candidate_description if get_failure_kind(candidate_description) == kind else ""
+
+    changed = True
+    while changed:
+        changed = False
+        run_length = len(lines) // 2
+        while run_length >= 1:
+            start = 0
+            while start < len(lines):
+                candidate = remove_lines(lines, start, start + run_length)
+                candidate_description = still_fails(candidate)
+                if candidate_description:
+                    lines, description, changed = candidate, candidate_description, True
+                else:
+                    start += run_length
+            run_length //= 2
+        for candidate in simplify_immediates(lines):
+            candidate_description = still_fails(candidate)
+            if candidate_description:
+                lines, description, changed = candidate, candidate_description, True
+                break
+    return "\n".join(lines), description
+
+def shrink_failure_task(task:tuple) -> tuple:
+    '''Runs shrink_failure() for a (seed, option set name, source, description, max cycles) task in a worker process.
+    Returns (seed, option set name, shrunk source, description).
+    '''
+    seed, name, source, description, max_cycles = task
+    options, module = get_option_set(name)
+    return (seed, name) + shrink_failure(source, options, description, max_cycles, module)
+
+def fuzz(seeds:range, max_length:int=40, max_cycles:int=DEFAULT_MAX_CYCLES, workers:int=None, max_failures:int=5) -> list:
+    '''Checks the programs of every seed, across a pool of worker processes, and shrinks up to max_failures of the failures,
+    one per option set and kind of failure. Returns list of (seed, option set name, shrunk source, description).
+    '''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = [(seed, max_length, max_cycles) for seed in seeds]
+        failures = [failure for failures in executor.map(check_seed_task, tasks, chunksize=64) for failure in failures]
+        distinct = {}
+        for seed, name, source, description in failures:
+            distinct.setdefault((name, get_failure_kind(description)), (seed, name, source, description, max_cycles))
+        return list(executor.map(shrink_failure_task, list(distinct.values())[:max_failures]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assembles random programs and checks that their machine code does the same as the source.")
+    parser.add_argument("--programs", type=int, default=2000, help="number of programs to generate")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first program; program n uses seed + n")
+    parser.add_argument("--max-length", type=int, default=40, help="most instructions in a generated program")
+    parser.add_argument("--max-cycles", type=int, default=DEFAULT_MAX_CYCLES, help="longest a source program may run")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--max-failures", type=int, default=5, help="most failures to shrink and print")
+    parser.add_argument("--show", type=int, metavar="SEED", help="print the program generated for a seed and exit")
+    args = parser.parse_args()
+
+    if args.show is not None:
+        print(generate_program(args.show, args.max_length))
+    else:
+        start = time.perf_counter()
+        failures = fuzz(range(args.seed, args.seed + args.programs), args.max_length, args.max_cycles, args.workers, args.max_failures)
+        print(f"Checked {args.programs} programs with {len(OPTION_SETS) + len(MODULE_OPTION_SETS)} option sets in {time.perf_counter() - start:.1f} s, "
+              f"{len(failures)} distinct failure(s)")
+        for seed, name, source, description in failures:
+            print(f"\nSeed {seed}, options {name}: {description}\n{source}")
+        if len(failures) > 0:
+            raise SystemExit(1)
@@ -0,0 +1,157 @@
+import argparse
+
+from assembler import AssemblerOptions, add_arguments, assemble, get_options, parse_source
+from cost_model import CostModel, ticks_to_seconds
+from register_allocator import get_reads_and_writes
+from simulator import DEFAULT_MAX_CYCLES, run
+
+'''Runs a program and shows where its time goes, in estimated redstone ticks (see cost_model), against each line of its source.
+The program is assembled in memory so that each machine code instruction can be traced back to the source line it came from.
+Instructions the assembler inserts, such as the LDIs that load constants and label addresses into unused registers at the start
+of the program, have no source line, so they are listed on their own along with the lines that use the register they load.
+The ticks of each line include the page loads made to run it and the times it was a taken branch, and the ticks of each label
+are those of the lines from the label up to the next one, so the cost of a loop can be read off its label.
+'''
+
+DEFAULT_TOP_LINES = 5
+
+class LineProfile:
+    '''LineProfile : Class
+    Time spent on one source line, or on one instruction a pass inserted.
+
+    Attributes:
+    line:int -- source line number, starting at 1, or None for an inserted instruction
+    text:str -- the source line, or the inserted instruction
+    instructions:list -- indexes of the machine code instructions that came from the line
+    executions:int -- number of times the first of those instructions ran, 0 if there are none
+    ticks:float -- estimated ticks spent on those instructions
+    used_by:list -- for an inserted LDI, the source lines that read the register it loads
+    '''
+    def __init__(self, line:int, text:str):
+        self.line = line
+        self.text = text
+        self.instructions = []
+        self.executions = 0
+        self.ticks = 0
+        self.used_by = []
+
+class HotspotProfile:
+    '''HotspotProfile : Class
+
+    Attributes:
+    lines:list -- LineProfile of each source line, index 0 is line 1
+    inserted:list -- LineProfile of each instruction that doesn't come from a source line, in program order
+    label_ticks:dict -- estimated ticks of the lines from each label to the next, in the form label : ticks, in source order.
+        Lines before the first label are under "(start)", and the inserted instructions under "(inserted)"
+    result:SimulationResult -- the result of running the program
+    total_ticks:float -- estimated ticks of the whole run
+    cost_model:CostModel -- costs the estimates were made with
+    '''
+    def __init__(self, lines:list, inserted:list, label_ticks:dict, result, total_ticks:float, cost_model:CostModel):
+        self.lines = lines
+        self.inserted = inserted
+        self.label_ticks = label_ticks
+        self.result = result
+        self.total_ticks = total_ticks
+        self.cost_model = cost_model
+
+    def get_hottest_lines(self, count:int) -> list:
+        '''Returns the LineProfiles of the count source lines and inserted instructions with the most ticks, most first.'''
+        profiles = [profile for profile in self.lines + self.inserted if profile.ticks > 0]
+        return sorted(profiles, key=lambda profile: profile.ticks, reverse=True)[:count]
+
+    def format_listing(self) -> str:
+        '''Returns the source annotated with the executions, ticks and share of the total ticks of each line.
+        Lines with no instructions (comments, or lines removed by the optimizer) only show the source.
+        '''
+        output = [f"{'line':>5} {'runs':>9} {'ticks':>11} {'%':>6}  source"]
+        for profile in self.inserted:
+            used_by = ", ".join(str(line) for line in profile.used_by)
+            output.append(f"{'+':>5} {profile.executions:>9} {profile.ticks:>11} {self.format_share(profile.ticks)}  "
+                          f"{profile.text}" + (f"  (inserted, used by line {used_by})" if len(used_by) > 0 else "  (inserted)"))
+        for profile in self.lines:
+            if len(profile.instructions) == 0:
+                output.append(f"{profile.line:>5} {'':>9} {'':>11} {'':>6}  {profile.text}".rstrip())
+            else:
+                output.append(f"{profile.line:>5} {profile.executions:>9} {profile.ticks:>11} {self.format_share(profile.ticks)}  {profile.text}")
+        return "\n".join(output)
+
+    def format_share(self, ticks:float) -> str:
+        '''Returns ticks as a percentage of the total, padded to the width of the listing column.'''
+        share = 100 * ticks / self.total_ticks if self.total_ticks > 0 else 0
+        return f"{share:>5.1f}%"
+
+    def format_totals(self, top_lines:int=DEFAULT_TOP_LINES) -> str:
+        '''Returns the ticks of each label, the hottest lines, and the totals of the run.'''
+        output = ["Labels:"]
+        for label, ticks in self.label_ticks.items():
+            output.append(f"  {label:<16} {ticks:>11} {self.format_share(ticks)}")
+        output.append("Hottest lines:")
+        for profile in self.get_hottest_lines(top_lines):
+            line = profile.line if profile.line is not None else "+"
+            output.append(f"  {line:>5} {profile.ticks:>11} {self.format_share(profile.ticks)}  {profile.text}")
+        taken_branches = sum(self.result.taken_counts)
+        output.append(f"Cycles: {self.result.cycles}, Taken branches: {taken_branches}, Page loads: {self.result.page_loads}")
+        output.append(f"Estimated time: {self.total_ticks} redstone ticks ({ticks_to_seconds(self.total_ticks):.1f} s)")
+        return "\n".join(output)
+
+    def __str__(self):
+        return self.format_listing() + "\n\n" + self.format_totals()
+
+def profile_program(source:str, options:AssemblerOptions=None, cost_model:CostModel=None, registers:list=None, memory:list=None,
+                    max_cycles:int=DEFAULT_MAX_CYCLES) -> HotspotProfile:
+    '''Assembles the text of a program, runs it from the given starting state, and returns the estimated ticks of each of its lines.
+    If cost_model isn't given, the one in options is used, or else the defaults.
+    '''
+    if cost_model is None:
+        cost_model = options.cost_model if options is not None and options.cost_model is not None else CostModel()
+    machine_code = assemble(source, options)
+    result = run(machine_code.instructions, registers=registers, memory=memory, max_cycles=max_cycles)
+    instruction_ticks = cost_model.get_instruction_ticks(machine_code.instructions, result)
+
+    lines = [LineProfile(line_number, text) for line_number, text in enumerate(source.split("\n"), start=1)]
+    inserted = []
+    for index, instruction in enumerate(machine_code.assembly):
+        if instruction.line is None:
+            profile = LineProfile(None, f"{instruction.opcode_str} {', '.join(instruction.operands)}")
+            inserted.append(profile)
+        else:
+            profile = lines[instruction.line - 1]
+        if len(profile.instructions) == 0:
+            profile.executions = result.execution_counts[index]
+        profile.instructions.append(index)
+        profile.ticks += instruction_ticks[index]
+
+    #an inserted LDI is only there because of the lines that read the register it loads
+    for profile in inserted:
+        ldi = machine_code.assembly[profile.instructions[0]]
+        if ldi.opcode_str != "LDI":
+            continue
+        register = ldi.operands[0]
+        used_by = {instruction.line for instruction in machine_code.assembly
+                   if instruction.line is not None and register in get_reads_and_writes(instruction)[0]}
+        profile.used_by = sorted(used_by)
+
+    label_of_line = {instruction.line: instruction.label for instruction in parse_source(source) if instruction.label is not None}
+    label_ticks = {"(inserted)": sum(profile.ticks for profile in inserted)} if len(inserted) > 0 else {}
+    label = "(start)"
+    for profile in lines:
+        label = label_of_line.get(profile.line, label)
+        label_ticks[label] = label_ticks.get(label, 0) + profile.ticks
+    return HotspotProfile(lines, inserted, label_ticks, result, sum(instruction_ticks), cost_model)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a program and estimates the redstone ticks spent on each line of its source.")
+    parser.add_argument("filename", help="program name, reading programs/<filename>.txt")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP_LINES, help="number of the hottest lines to list")
+    parser.add_argument("--max-cycles", type=int, default=DEFAULT_MAX_CYCLES)
+    add_arguments(parser, batch=False, output=False, profile=False)
+    args = parser.parse_args()
+
+    with open("programs/" + args.filename + ".txt", 'r') as input_file:
+        source = input_file.read()
+    options = get_options(args)
+    profile = profile_program(source, options, options.cost_model, max_cycles=args.max_cycles)
+    print(profile.format_listing())
+    print()
+    print(profile.format_totals(args.top))
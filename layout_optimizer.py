@@ -0,0 +1,303 @@
+from assembler import OPCODES, Instruction, convert_cycle_to_instruction_cell_int, convert_to_machine_code, get_opcode_str, get_operand_value, get_operands
+import simulator
+
+'''Optional assembler pass that lays out a converted program so hot loops don't thrash the 2 page frames.
+It runs after convert_syntax(), when every branch target is a register loaded by an LDI of a label address.
+Those LDIs are relocated, so instructions can be moved and filler added without re-assembling the program.
+
+The program is split into chunks after every unconditional branch (BRE with the same register twice).
+A chunk can only be entered by a branch, except for the first chunk, so any chunk other than the first can be moved,
+as long as the chunk that runs off the end of the program stays last. Unreachable instructions get a chunk of their own. Filler placed between chunks is never executed.
+Filler placed inside a chunk, in front of a loop, is executed whenever the loop is entered from above.
+Every candidate layout is simulated, and only kept if it needs fewer page loads and gives the same final state.
+'''
+
+FILLER_INSTRUCTION = Instruction("OR", ("R1", "R1", "R1"))
+'''Instruction used as filler: R1 OR R1 leaves R1 unchanged.'''
+
+MAX_PROGRAM_LENGTH = simulator.INSTRUCTIONS_PER_BLOCK * 15
+'''Instruction addresses have 15 possible block numbers, so a program can have at most 15 blocks.'''
+
+class LayoutReport:
+    '''LayoutReport : Class
+
+    Attributes:
+    page_loads_before:int, page_loads_after:int -- page loads when running the program before and after the pass
+    cycles_before:int, cycles_after:int -- instructions executed before and after the pass
+    fillers_added:int -- number of filler instructions added
+    chunks_moved:int -- number of chunks placed somewhere other than their original position
+    message:str -- why the layout was left unchanged, if it was
+    '''
+    def __init__(self, page_loads_before:int=0, page_loads_after:int=0, cycles_before:int=0, cycles_after:int=0,
+                 fillers_added:int=0, chunks_moved:int=0, message:str=""):
+        self.page_loads_before = page_loads_before
+        self.page_loads_after = page_loads_after
+        self.cycles_before = cycles_before
+        self.cycles_after = cycles_after
+        self.fillers_added = fillers_added
+        self.chunks_moved = chunks_moved
+        self.message = message
+
+    def __str__(self):
+        report = (f"Page loads: {self.page_loads_before} -> {self.page_loads_after}, "
+                  f"cycles: {self.cycles_before} -> {self.cycles_after}, "
+                  f"fillers added: {self.fillers_added}, chunks moved: {self.chunks_moved}")
+        if self.message:
+            report = report + f"\n{self.message}"
+        return report
+
+class Layout:
+    '''Layout : Class
+
+    Attributes:
+    order:list -- chunk numbers in the order they are placed
+    chunk_gaps:dict -- chunk number : filler instructions placed before the chunk
+    inline_fillers:dict -- (chunk number, instruction index in chunk) : filler instructions placed before that instruction
+    '''
+    def __init__(self, order:list, chunk_gaps:dict=None, inline_fillers:dict=None):
+        self.order = order
+        self.chunk_gaps = chunk_gaps if chunk_gaps is not None else {}
+        self.inline_fillers = inline_fillers if inline_fillers is not None else {}
+
+    def copy(self):
+        return Layout(list(self.order), dict(self.chunk_gaps), dict(self.inline_fillers))
+
+def is_unconditional_branch(instruction:list) -> bool:
+    '''Returns True if instruction is a BRE comparing a register with itself.'''
+    if get_opcode_str(instruction) != "BRE":
+        return False
+    operands = get_operands(instruction)
+    return operands[1] == operands[2]
+
+def find_label_registers(instructions:list, branch_labels:dict) -> dict:
+    '''Returns dict of register number : label, for the registers that hold label addresses.
+    Raises an exception if a branch target can't be relocated: the register is written more than once,
+    doesn't hold a label address, or is also used as a value by other instructions.
+    '''
+    label_of_address = {}
+    for label, instr_cycle in branch_labels.items():
+        label_of_address[convert_cycle_to_instruction_cell_int(instr_cycle)] = label
+
+    writes = {}
+    ldi_values = {}
+    for instruction in instructions:
+        opcode_str = get_opcode_str(instruction)
+        operands = get_operands(instruction)
+        if OPCODES[opcode_str] <= OPCODES["LDI"]:
+            register = get_operand_value(operands[0])
+            writes[register] = writes.get(register, 0) + 1
+            if opcode_str == "LDI":
+                ldi_values[register] = get_operand_value(operands[1])
+
+    label_registers = {}
+    for instruction in instructions:
+        if get_opcode_str(instruction) in ("BRE", "BRLT"):
+            register = get_operand_value(get_operands(instruction)[0])
+            if writes.get(register, 0) != 1 or ldi_values.get(register) not in label_of_address:
+                raise Exception(f"Branch target R{register} does not hold a single label address.")
+            label_registers[register] = label_of_address[ldi_values[register]]
+
+    #label registers must only be read as branch targets, or moving the label would change a value
+    for instruction in instructions:
+        opcode_str = get_opcode_str(instruction)
+        operands = get_operands(instruction)
+        if opcode_str in ("BRE", "BRLT"):
+            read_operands = operands[1:]
+        elif opcode_str == "STR":
+            read_operands = operands
+        elif opcode_str == "LDI":
+            read_operands = []
+        else:
+            read_operands = operands[1:]
+        for operand in read_operands:
+            if get_operand_value(operand) in label_registers:
+                raise Exception(f"R{get_operand_value(operand)} holds a label address and is also used as a value.")
+    return label_registers
+
+def split_into_chunks(instructions:list, branch_labels:dict, label_registers:dict) -> list:
+    '''Splits instructions after each unconditional branch, and at the first label after unreachable instructions.
+    Returns list of chunks, each a list of (labels declared at the instruction, instruction) pairs.
+    Label LDIs have their value replaced by the label name so they can be relocated.
+    '''
+    labels_at = {}
+    for label, instr_cycle in branch_labels.items():
+        labels_at.setdefault(instr_cycle, []).append(label)
+
+    chunks = [[]]
+    for instr_cycle, instruction in enumerate(instructions):
+        instruction = instruction.copy()
+        if get_opcode_str(instruction) == "LDI":
+            register = get_operand_value(instruction.operands[0])
+            if register in label_registers:
+                instruction.set_operand(1, label_registers[register])
+        labels = labels_at.get(instr_cycle, [])
+        #a chunk that isn't the first and doesn't start with a label can't be reached, so it ends at the next label
+        is_unreachable = len(chunks) > 1 and len(chunks[-1]) > 0 and len(chunks[-1][0][0]) == 0
+        if is_unreachable and len(labels) > 0:
+            chunks.append([])
+        chunks[-1].append((labels, instruction))
+        if is_unconditional_branch(instruction) and instr_cycle < len(instructions) - 1:
+            chunks.append([])
+    return chunks
+
+def emit_layout(chunks:list, layout:Layout) -> tuple:
+    '''Places chunks in the given layout.
+    Returns (instructions, dict of label : instruction cycle, list of (chunk number, instruction index in chunk) for each instruction).
+    Filler instructions have None in the last list.
+    '''
+    instructions = []
+    label_cycles = {}
+    origins = []
+    for chunk_number in layout.order:
+        for i in range(layout.chunk_gaps.get(chunk_number, 0)):
+            instructions.append(FILLER_INSTRUCTION.copy())
+            origins.append(None)
+        for instruction_index, (labels, instruction) in enumerate(chunks[chunk_number]):
+            for i in range(layout.inline_fillers.get((chunk_number, instruction_index), 0)):
+                instructions.append(FILLER_INSTRUCTION.copy())
+                origins.append(None)
+            for label in labels:
+                label_cycles[label] = len(instructions)
+            instructions.append(instruction.copy())
+            origins.append((chunk_number, instruction_index))
+
+    #relocate label LDIs now that label positions are known
+    for instruction in instructions:
+        if get_opcode_str(instruction) == "LDI" and instruction.operands[1] in label_cycles:
+            instruction.set_operand(1, f"#{convert_cycle_to_instruction_cell_int(label_cycles[instruction.operands[1]])}")
+    return instructions, label_cycles, origins
+
+def simulate(instructions:list) -> simulator.SimulationResult:
+    '''Runs a converted program in the simulator.'''
+    machine_code = list(instructions)
+    convert_to_machine_code(machine_code)
+    return simulator.run(machine_code)
+
+def has_same_final_state(result:simulator.SimulationResult, original_result:simulator.SimulationResult, label_registers:dict) -> bool:
+    '''Returns True if both runs end with the same memory, and the same registers apart from those holding label addresses.'''
+    if result.memory != original_result.memory:
+        return False
+    for register_number in range(1, simulator.NUMBER_OF_REGISTERS + 1):
+        if register_number not in label_registers and result.register(register_number) != original_result.register(register_number):
+            return False
+    return True
+
+def find_hot_loops(instructions:list, label_cycles:dict, result:simulator.SimulationResult) -> list:
+    '''Returns loops as (instruction cycle of the loop head, instruction cycle of the branch back to it, times the branch ran),
+    hottest first. Only loops short enough to fit in one block are returned.
+    '''
+    label_of_register = {}
+    address_labels = {convert_cycle_to_instruction_cell_int(instr_cycle): label for label, instr_cycle in label_cycles.items()}
+    for instruction in instructions:
+        if get_opcode_str(instruction) == "LDI":
+            value = get_operand_value(instruction.operands[1])
+            if value in address_labels:
+                label_of_register[instruction.operands[0]] = address_labels[value]
+
+    loops = []
+    for instr_cycle, instruction in enumerate(instructions):
+        count = result.execution_counts[instr_cycle]
+        if get_opcode_str(instruction) in ("BRE", "BRLT") and count > 1:
+            head_cycle = label_cycles[label_of_register[get_operands(instruction)[0]]]
+            if head_cycle <= instr_cycle and instr_cycle - head_cycle < simulator.INSTRUCTIONS_PER_BLOCK:
+                loops.append((head_cycle, instr_cycle, count))
+    loops.sort(key=lambda loop: -loop[2])
+    return loops
+
+def candidate_layouts(layout:Layout, loops:list, origins:list, last_chunk_is_fixed:bool) -> list:
+    '''Returns layouts that differ from the given one by a single move of a chunk, or by filler in front of a loop.'''
+    candidates = []
+    block_size = simulator.INSTRUCTIONS_PER_BLOCK
+
+    #align each loop that straddles a block boundary to the start of a block
+    for head_cycle, end_cycle, count in loops:
+        if head_cycle // block_size == end_cycle // block_size:
+            continue
+        needed = block_size - head_cycle % block_size
+        chunk_number, head_index = origins[head_cycle]
+        candidate = layout.copy()
+        if head_index == 0 and layout.order[0] != chunk_number:
+            candidate.chunk_gaps[chunk_number] = candidate.chunk_gaps.get(chunk_number, 0) + needed
+        else:
+            key = (chunk_number, head_index)
+            candidate.inline_fillers[key] = candidate.inline_fillers.get(key, 0) + needed
+        candidates.append(candidate)
+
+    #move each movable chunk to every other position
+    movable_end = len(layout.order) - 1 if last_chunk_is_fixed else len(layout.order)
+    orders = set()
+    for from_position in range(1, movable_end):
+        for to_position in range(1, movable_end):
+            order = list(layout.order)
+            order.insert(to_position, order.pop(from_position))
+            if order != layout.order and tuple(order) not in orders:
+                orders.add(tuple(order))
+                candidate = layout.copy()
+                candidate.order = order
+                candidates.append(candidate)
+    return candidates
+
+def optimize_page_layout(instructions:list, branch_labels:dict, max_evaluations:int=500) -> LayoutReport:
+    '''Lays out a program (after convert_syntax) so that hot loops and their branch targets share a page where possible.
+    Modifies instructions and branch_labels (label : instruction cycle) in place, and returns a LayoutReport.
+    The program is left unchanged if it can't be relocated or simulated, or if no layout needs fewer page loads.
+    '''
+    if len(instructions) == 0:
+        return LayoutReport(message="Layout unchanged: the program has no instructions.")
+    try:
+        label_registers = find_label_registers(instructions, branch_labels)
+        original_result = simulate(instructions)
+    except Exception as e:
+        return LayoutReport(message=f"Layout unchanged: {e}")
+
+    report = LayoutReport(page_loads_before=original_result.page_loads, page_loads_after=original_result.page_loads,
+                          cycles_before=original_result.cycles, cycles_after=original_result.cycles)
+
+    chunks = split_into_chunks(instructions, branch_labels, label_registers)
+    #the chunk that runs off the end of the program has to stay last
+    last_chunk_is_fixed = not is_unconditional_branch(chunks[-1][-1][1])
+    best_layout = Layout(order=list(range(len(chunks))))
+    best_instructions, best_label_cycles, best_origins = emit_layout(chunks, best_layout)
+    best_result = original_result
+    best_score = (original_result.page_loads, original_result.cycles, len(instructions))
+
+    evaluations = 0
+    improved = True
+    while improved and evaluations < max_evaluations:
+        improved = False
+        loops = find_hot_loops(best_instructions, best_label_cycles, best_result)
+        for candidate in candidate_layouts(best_layout, loops, best_origins, last_chunk_is_fixed):
+            if evaluations >= max_evaluations:
+                break
+            evaluations += 1
+            candidate_instructions, candidate_label_cycles, candidate_origins = emit_layout(chunks, candidate)
+            if len(candidate_instructions) > MAX_PROGRAM_LENGTH:
+                continue
+            try:
+                result = simulate(candidate_instructions)
+            except Exception:
+                continue
+            if not has_same_final_state(result, original_result, label_registers):
+                continue
+            #only layouts needing fewer page loads than the original are kept; cycles and length break ties between them
+            if result.page_loads >= original_result.page_loads:
+                continue
+            score = (result.page_loads, result.cycles, len(candidate_instructions))
+            if score < best_score:
+                best_layout, best_instructions = candidate, candidate_instructions
+                best_label_cycles, best_origins = candidate_label_cycles, candidate_origins
+                best_result, best_score = result, score
+                improved = True
+
+    if best_result is original_result:
+        report.message = "Layout unchanged: no layout needed fewer page loads."
+        return report
+
+    instructions[:] = best_instructions
+    branch_labels.clear()
+    branch_labels.update(best_label_cycles)
+    report.page_loads_after = best_result.page_loads
+    report.cycles_after = best_result.cycles
+    report.fillers_added = len(best_instructions) - sum(len(chunk) for chunk in chunks)
+    report.chunks_moved = sum(1 for position, chunk_number in enumerate(best_layout.order) if position != chunk_number)
+    return report
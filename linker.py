@@ -0,0 +1,349 @@
+import argparse
+import os
+import sys
+
+from assembler import (ALLOCATABLE_REGISTERS, OPCODES, AssemblerOptions, add_arguments as add_assembler_arguments, convert_cycle_to_instruction_cell_int,
+                       format_machine_code, get_options, get_output_path)
+from build_cache import BuildCache, hash_key
+from machine_code_format import MachineCodeFile, decode_instructions, get_binary_path, is_binary_machine_code_file, write_machine_code_file
+from object_file import REGISTER_PARTS, ObjectFile, assemble_module
+
+'''Links modules, each assembled once into a relocatable object file (see object_file), into one program.
+- Modules are placed one after another, each starting at the beginning of a page (a 15 instruction block), so an instruction keeps
+  its place within its page and an address only changes by its page number, the first digit of the custom hexadecimal.
+- The first module is the one that runs when the program starts. If other modules follow it and it doesn't end with a branch,
+  a branch to the end of the program is added to it, so it doesn't run on into them.
+- A branch to a label a module doesn't declare goes to the module of that name, at its first instruction, so that the LDIs at its
+  start are run, or otherwise to the one module that declares the label. A module should only be branched into at a label other than
+  its first instruction after it has run its start, e.g. to return to the program that branched to a routine.
+- Registers named in a module's source are shared by all modules, to pass values between them. The other registers a module uses
+  (for its constants, label addresses and macro scratch values) are private to it, and are renamed so that they don't clash with
+  any shared register, or with the private registers of modules that are branched into at a label other than their first instruction.
+  The private registers of other modules are reloaded each time they are entered, so they can share registers with each other.
+The linked program is written like the assembler's output, so it can be simulated or turned into schematics in the same way.
+Only modules whose source has changed are reassembled, and only pages whose contents have changed are relinked: the others are
+read from the previous output, as recorded in the build cache.
+'''
+
+LINKER_VERSION = 1
+'''Increase whenever a change to the linker changes the programs it produces, so that cached pages are relinked.'''
+
+INSTRUCTIONS_PER_PAGE = 15
+MAX_PAGES = 15
+'''The first digit of an instruction address is its page, from 1 to 15.'''
+
+FILLER = [OPCODES["OR"], 1, 1, 1]
+'''Machine code used to fill the rest of a module's last page: R1 OR R1, as in layout_optimizer. It is never run.'''
+
+class Module:
+    '''Module : Class
+    A module placed in a linked program.
+
+    Attributes:
+    name:str -- module name, reading programs/<name>.txt
+    symbol:str -- label of the first instruction of the module, its name without any folders
+    object_file:ObjectFile -- the assembled module
+    assembled:bool -- True if the object file was assembled for this link, False if it was up to date
+    instructions:list -- machine code of the module, including any branch to the end of the program, before it is linked
+    relocations:list -- (instruction cycle, label) of each LDI the linker sets, including any branch to the end of the program
+    first_page:int -- number of the page the module starts at, from 1
+    register_map:dict -- number of each private register : number of the register it is renamed to
+    '''
+    def __init__(self, name:str, object_file:ObjectFile, assembled:bool=False):
+        self.name = name
+        self.symbol = os.path.basename(name)
+        self.object_file = object_file
+        self.assembled = assembled
+        self.instructions = object_file.instructions
+        self.relocations = object_file.relocations
+        self.first_page = 1
+        self.register_map = {}
+
+    def page_count(self) -> int:
+        return max(1, (len(self.instructions) + INSTRUCTIONS_PER_PAGE - 1) // INSTRUCTIONS_PER_PAGE)
+
+    def first_cycle(self) -> int:
+        '''Returns the instruction cycle of the first instruction of the module in the linked program.'''
+        return (self.first_page - 1) * INSTRUCTIONS_PER_PAGE
+
+    def get_used_registers(self) -> set:
+        '''Returns the numbers of the registers the module uses in the linked program.'''
+        return {self.register_map.get(register, register) for register in self.object_file.get_used_registers()}
+
+class LinkReport:
+    '''LinkReport : Class
+
+    Attributes:
+    modules:list -- the linked Modules, in program order
+    page_count:int -- number of pages in the linked program
+    instruction_count:int -- number of instructions in the linked program
+    relinked_pages:list -- numbers of the pages that were relinked, the others being unchanged from the previous output
+    warnings:list -- problems with the program that don't stop it being linked
+    '''
+    def __init__(self, modules:list, page_count:int, instruction_count:int, relinked_pages:list, warnings:list):
+        self.modules = modules
+        self.page_count = page_count
+        self.instruction_count = instruction_count
+        self.relinked_pages = relinked_pages
+        self.warnings = warnings
+
+    def __str__(self):
+        names = [module.name + (" (assembled)" if module.assembled else "") for module in self.modules]
+        width = max(len(name) for name in names + ["module"])
+        output = [f"{'module':<{width}} {'pages':<7} {'address':<8} private registers"]
+        for name, module in zip(names, self.modules):
+            last_page = module.first_page + module.page_count() - 1
+            registers = ", ".join(f"R{register}->R{renamed}" if renamed != register else f"R{register}"
+                                  for register, renamed in sorted(module.register_map.items()))
+            output.append(f"{name:<{width}} {f'{module.first_page}-{last_page}':<7} {hex(convert_cycle_to_instruction_cell_int(module.first_cycle())):<8} "
+                          f"{registers}".rstrip())
+        for warning in self.warnings:
+            output.append(f"Warning: {warning}")
+        output.append(f"Relinked {len(self.relinked_pages)} of {self.page_count} page(s): {self.relinked_pages}, {self.instruction_count} instructions")
+        return "\n".join(output)
+
+def is_unconditional_branch(instruction:list) -> bool:
+    '''Returns True if a machine code instruction is a BRE comparing a register with itself.'''
+    return instruction[0] == OPCODES["BRE"] and instruction[2] == instruction[3]
+
+def find_label(modules:list, module:Module, label:str) -> tuple:
+    '''Returns (Module, instruction cycle within it) of a label branched to from module: its own label, the first instruction of the
+    module with that name, or the label of the one module that declares it.
+    '''
+    if label in module.object_file.symbols:
+        return module, module.object_file.symbols[label]
+    for other in modules:
+        if other.symbol == label:
+            return other, 0
+    declaring_modules = [other for other in modules if label in other.object_file.symbols]
+    if len(declaring_modules) == 0:
+        raise Exception(f"{module.name}: label {label} is not declared by any module.")
+    if len(declaring_modules) > 1:
+        raise Exception(f"{module.name}: label {label} is declared by more than one module ({', '.join(other.name for other in declaring_modules)}).")
+    return declaring_modules[0], declaring_modules[0].object_file.symbols[label]
+
+def find_resident_modules(modules:list) -> set:
+    '''Returns the names of the modules that other modules branch into at a label other than their first instruction,
+    whose private registers have to keep their values while other modules run.
+    '''
+    resident = set()
+    for module in modules:
+        for instr_cycle, label in module.object_file.relocations:
+            target, target_cycle = find_label(modules, module, label)
+            if target is not module and target_cycle != 0:
+                resident.add(target.name)
+    return resident
+
+def rename_private_registers(modules:list) -> None:
+    '''Sets the register_map of each module, keeping each private register where it can and otherwise renaming it to the
+    highest numbered register that is free.
+    '''
+    shared = set()
+    for module in modules:
+        shared.update(module.object_file.public_registers)
+    resident = find_resident_modules(modules)
+    exclusive = set()
+    #resident modules are given their registers first, as no other module can use them
+    for module in sorted(modules, key=lambda module: module.name not in resident):
+        taken = shared | exclusive
+        free = [register for register in ALLOCATABLE_REGISTERS if register not in taken]
+        private_registers = module.object_file.get_private_registers()
+        if len(private_registers) > len(free):
+            raise Exception(f"Run out of registers to link {module.name}: it needs {len(private_registers)} private registers, "
+                            f"but only {len(free)} aren't used by other modules.")
+        kept = [register for register in private_registers if register in free]
+        module.register_map = {register: register for register in kept}
+        free = [register for register in free if register not in kept]
+        for register in reversed(private_registers):
+            if register not in module.register_map:
+                module.register_map[register] = free.pop()
+        if module.name in resident:
+            exclusive.update(module.register_map.values())
+
+def add_exit_branch(modules:list) -> None:
+    '''Adds a branch to the end of the program to the end of the first module, if other modules follow it and it doesn't end with a branch.
+    The address of the end of the program is loaded into a register that no module uses, and set by the linker like a label.
+    '''
+    entry = modules[0]
+    if len(modules) == 1 or (len(entry.instructions) > 0 and is_unconditional_branch(entry.instructions[-1])):
+        return
+    used_registers = set()
+    for module in modules:
+        used_registers.update(module.get_used_registers())
+    free = [register for register in ALLOCATABLE_REGISTERS if register not in used_registers]
+    if len(free) == 0:
+        raise Exception(f"No register is free for a branch from the end of {entry.name} to the end of the program, so {entry.name} must end with a branch.")
+    register = free[-1]
+    entry.instructions = entry.instructions + [[OPCODES["LDI"], register, 0, 0], [OPCODES["BRE"], register, register, register]]
+    entry.relocations = entry.relocations + [(len(entry.instructions) - 2, None)]
+    #the register belongs to the first module, so isn't renamed
+    entry.register_map[register] = register
+
+def place_modules(modules:list) -> int:
+    '''Sets the first page of each module, one after another. Returns the number of instructions in the linked program.'''
+    page = 1
+    for module in modules:
+        module.first_page = page
+        page += module.page_count()
+    if page - 1 > MAX_PAGES:
+        raise Exception(f"The linked program needs {page - 1} pages, but instruction addresses only reach {MAX_PAGES}.")
+    return modules[-1].first_cycle() + len(modules[-1].instructions)
+
+def get_relocated_addresses(modules:list, module:Module, instruction_count:int) -> dict:
+    '''Returns dict of instruction cycle within module : address its LDI loads in the linked program.
+    The branch to the end of the program (label None) loads the address after the last instruction.
+    '''
+    addresses = {}
+    for instr_cycle, label in module.relocations:
+        if label is None:
+            target_cycle = instruction_count
+        else:
+            target, target_cycle = find_label(modules, module, label)
+            target_cycle += target.first_cycle()
+        addresses[instr_cycle] = convert_cycle_to_instruction_cell_int(instr_cycle=target_cycle)
+    return addresses
+
+def get_page_instructions(module:Module, page_index:int, is_last_module:bool) -> list:
+    '''Returns the machine code of a page of a module (page_index 0 is its first), before it is linked.
+    The last page of every module but the last is filled up to the next page.
+    '''
+    instructions = module.instructions[page_index*INSTRUCTIONS_PER_PAGE:(page_index + 1)*INSTRUCTIONS_PER_PAGE]
+    if not is_last_module:
+        instructions = instructions + [FILLER] * (INSTRUCTIONS_PER_PAGE - len(instructions))
+    return instructions
+
+def link_page(instructions:list, register_map:dict, addresses:dict, first_cycle:int) -> list:
+    '''Returns the machine code of a page with its registers renamed by register_map, and its LDIs of label addresses set from
+    addresses (instruction cycle within the module : address). first_cycle is the cycle within the module of the first instruction of the page.
+    '''
+    linked = []
+    for instr_cycle, instruction in enumerate(instructions, start=first_cycle):
+        instruction = list(instruction)
+        for part in REGISTER_PARTS[instruction[0]]:
+            instruction[part] = register_map.get(instruction[part], instruction[part])
+        if instr_cycle in addresses:
+            if instruction[0] != OPCODES["LDI"]:
+                raise Exception(f"Instruction {instr_cycle+1} of the module is relocated, but isn't an LDI.")
+            instruction[2], instruction[3] = addresses[instr_cycle] >> 4, addresses[instr_cycle] & 0xF
+        linked.append(instruction)
+    return linked
+
+def get_page_cache_key(instructions:list, register_map:dict, addresses:dict) -> str:
+    '''Returns the build cache key of a linked page, from everything it is linked from.'''
+    return hash_key("link page", LINKER_VERSION, instructions, sorted(register_map.items()), sorted(addresses.items()))
+
+def get_symbols(modules:list) -> dict:
+    '''Returns the labels of the linked program and their instruction cycles: the name of each module at its first instruction,
+    and each label as module.label.
+    '''
+    symbols = {}
+    for module in modules:
+        symbols[module.symbol] = module.first_cycle()
+        for label, instr_cycle in module.object_file.symbols.items():
+            symbols[f"{module.symbol}.{label}"] = module.first_cycle() + instr_cycle
+    return symbols
+
+def get_warnings(modules:list) -> list:
+    warnings = []
+    for module in modules[:-1]:
+        if len(module.instructions) == 0 or not is_unconditional_branch(module.instructions[-1]):
+            warnings.append(f"{module.name} doesn't end with a branch, so it runs on into the next module.")
+    return warnings
+
+def link(modules:list) -> int:
+    '''Places modules, renames their private registers and adds any branch to the end of the program. Returns the number of instructions.'''
+    if len(modules) == 0:
+        raise Exception("There are no modules to link.")
+    for module in modules:
+        module.instructions = module.object_file.instructions
+        module.relocations = module.object_file.relocations
+    rename_private_registers(modules)
+    add_exit_branch(modules)
+    return place_modules(modules)
+
+def read_previous_pages(cache:BuildCache, binary_path:str) -> list:
+    '''Returns the pages of the previous linked program at binary_path, each a list of machine code instructions,
+    if it was written by the linker and hasn't changed since. Returns an empty list otherwise.
+    '''
+    if not os.path.isfile(binary_path) or not is_binary_machine_code_file(binary_path):
+        return []
+    with MachineCodeFile(binary_path) as machine_code_file:
+        page_keys = [cache.entries.get(f"{binary_path}:page{page}") for page in range(1, machine_code_file.block_count + 1)]
+        if not cache.is_current(binary_path, hash_key("linked program", LINKER_VERSION, page_keys), binary_path):
+            return []
+        return [decode_instructions(machine_code_file.block(page)) for page in range(1, machine_code_file.block_count + 1)]
+
+def link_program(output_name:str, module_names:list, options:AssemblerOptions=None, cache:BuildCache=None, force:bool=False,
+                 write_text:bool=True) -> LinkReport:
+    '''Assembles any module programs/<name>.txt of module_names whose object file is out of date, and links them in order into the
+    program output_name, written like the output of the assembler. Pages are only relinked if their contents have changed, unless force
+    is True. The cache is updated but not saved.
+    '''
+    if cache is None:
+        cache = BuildCache()
+    modules = [Module(name, *assemble_module(name, options, cache, force)) for name in module_names]
+    instruction_count = link(modules)
+
+    text_path = get_output_path(output_name)
+    binary_path = get_binary_path(text_path)
+    previous_pages = [] if force else read_previous_pages(cache, binary_path)
+    instructions = []
+    page_keys = []
+    relinked_pages = []
+    for module_index, module in enumerate(modules):
+        addresses = get_relocated_addresses(modules, module, instruction_count)
+        for page_index in range(module.page_count()):
+            page = module.first_page + page_index
+            page_instructions = get_page_instructions(module, page_index, module_index == len(modules) - 1)
+            first_cycle = page_index * INSTRUCTIONS_PER_PAGE
+            page_addresses = {instr_cycle: address for instr_cycle, address in addresses.items()
+                              if first_cycle <= instr_cycle < first_cycle + INSTRUCTIONS_PER_PAGE}
+            page_key = get_page_cache_key(page_instructions, module.register_map, page_addresses)
+            if page <= len(previous_pages) and cache.entries.get(f"{binary_path}:page{page}") == page_key:
+                instructions.extend(previous_pages[page - 1])
+            else:
+                instructions.extend(link_page(page_instructions, module.register_map, page_addresses, first_cycle))
+                relinked_pages.append(page)
+            page_keys.append(page_key)
+
+    report = LinkReport(modules, len(page_keys), instruction_count, relinked_pages, get_warnings(modules))
+    if len(relinked_pages) == 0 and len(page_keys) == len(previous_pages) and (not write_text or os.path.isfile(text_path)):
+        return report
+
+    os.makedirs(os.path.dirname(text_path), exist_ok=True)
+    write_machine_code_file(binary_path, instructions, get_symbols(modules))
+    if write_text:
+        with open(text_path, 'w') as output_file:
+            output_file.write(format_machine_code(instructions))
+    for page, page_key in enumerate(page_keys, start=1):
+        cache.update(f"{binary_path}:page{page}", page_key)
+    for output_name in cache.names_with_prefix(f"{binary_path}:page"):
+        if int(output_name[len(f"{binary_path}:page"):]) > len(page_keys):
+            cache.remove(output_name)
+    cache.update(binary_path, hash_key("linked program", LINKER_VERSION, page_keys))
+    return report
+
+def add_arguments(parser:argparse.ArgumentParser) -> None:
+    '''Adds the linker's command line options to parser.'''
+    parser.add_argument("output", help="name of the linked program, writing programs/machine code/<output>_converted.bin")
+    parser.add_argument("modules", nargs="+", metavar="module", help="module names, reading programs/<module>.txt. The first one runs when the program starts")
+    add_assembler_arguments(parser, batch=False, profile=False)
+
+def run_command(args:argparse.Namespace, cache:BuildCache=None) -> int:
+    '''Links the modules given by a parser set up with add_arguments(), saving the cache. Returns the exit status.'''
+    if cache is None:
+        cache = BuildCache()
+    try:
+        report = link_program(args.output, args.modules, get_options(args), cache, force=args.force, write_text=not args.no_text)
+    except Exception as e:
+        print(f"{args.output}: failed - {e}")
+        return 1
+    finally:
+        cache.save()
+    print(report)
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Links modules in the programs folder, each assembled into an object file, into one program.")
+    add_arguments(parser)
+    sys.exit(run_command(parser.parse_args()))
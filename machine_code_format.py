@@ -0,0 +1,186 @@
+import argparse
+import mmap
+import os
+import struct
+
+'''Binary machine code files, written by the assembler next to the text machine code and read by the schematic generator and simulator.
+Each instruction takes 2 bytes, the same as an instruction cell in the CPU: opcode and operand 1 in the first byte, operands 2 and 3 in the second,
+each as one hexadecimal digit (a nibble). The file is laid out as:
+- header: the magic bytes MCPU, the format version, the number of blocks, the number of instructions and the number of symbols
+- the instructions, 2 bytes each
+- the symbol table: for each label, its instruction cycle (2 bytes), the length of its name (1 byte) and its name in UTF-8
+All numbers are big-endian. The reader maps the file into memory and decodes instructions straight from the mapped bytes, without copying or parsing the whole file.
+'''
+
+MAGIC = b"MCPU"
+FORMAT_VERSION = 1
+HEADER = struct.Struct(">4sBBHH")
+SYMBOL_HEADER = struct.Struct(">HB")
+INSTRUCTIONS_PER_BLOCK = 15
+BINARY_EXTENSION = ".bin"
+
+NIBBLES_OF_BYTE = [(byte >> 4, byte & 0xF) for byte in range(256)]
+'''Lookup table from each byte to its (high, low) hexadecimal digits.'''
+
+def get_binary_path(text_path:str) -> str:
+    '''Returns the path of the binary machine code file that goes with a _converted.txt machine code file.'''
+    return os.path.splitext(text_path)[0] + BINARY_EXTENSION
+
+def encode_instructions(instructions:list) -> bytes:
+    '''Returns machine code instructions (each a list of 4 integers from 0 to 15) as 2 bytes each.'''
+    code = bytearray(2 * len(instructions))
+    for instruction_index, instruction in enumerate(instructions):
+        if len(instruction) != 4 or any(part < 0 or part > 15 for part in instruction):
+            raise Exception(f"Instruction {instruction_index+1} must be 4 integers between 0 and 15.")
+        code[2*instruction_index] = instruction[0] << 4 | instruction[1]
+        code[2*instruction_index + 1] = instruction[2] << 4 | instruction[3]
+    return bytes(code)
+
+def decode_instructions(code) -> list:
+    '''Returns 2 byte instructions (bytes or a memoryview) as a list of lists of 4 integers.'''
+    return [list(NIBBLES_OF_BYTE[code[byte_index]] + NIBBLES_OF_BYTE[code[byte_index + 1]]) for byte_index in range(0, len(code), 2)]
+
+def encode_symbol_table(entries:list) -> bytes:
+    '''Returns a list of (label, instruction cycle) as a symbol table.'''
+    symbols = []
+    for label, instr_cycle in entries:
+        name = label.encode("utf-8")
+        if len(name) > 0xFF:
+            raise Exception(f"Label {label} is too long for the binary machine code format.")
+        symbols.append(SYMBOL_HEADER.pack(instr_cycle, len(name)) + name)
+    return b"".join(symbols)
+
+def decode_symbol_table(data, offset:int, count:int) -> tuple:
+    '''Reads count entries of a symbol table starting at offset in data (bytes or a memoryview).
+    Returns (list of (label, instruction cycle), offset of the end of the table).
+    '''
+    entries = []
+    for i in range(count):
+        instr_cycle, name_length = SYMBOL_HEADER.unpack_from(data, offset)
+        offset += SYMBOL_HEADER.size
+        entries.append((bytes(data[offset:offset + name_length]).decode("utf-8"), instr_cycle))
+        offset += name_length
+    return entries, offset
+
+def encode_machine_code(instructions:list, branch_labels:dict=None) -> bytes:
+    '''Returns the binary file contents for machine code instructions (each a list of 4 integers from 0 to 15),
+    with branch_labels (label : instruction cycle) as the symbol table.
+    '''
+    branch_labels = branch_labels if branch_labels is not None else {}
+    number_of_blocks = (len(instructions) + INSTRUCTIONS_PER_BLOCK - 1) // INSTRUCTIONS_PER_BLOCK
+    if number_of_blocks > 0xFF or len(branch_labels) > 0xFFFF:
+        raise Exception("Program is too large for the binary machine code format.")
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, number_of_blocks, len(instructions), len(branch_labels))
+    return header + encode_instructions(instructions) + encode_symbol_table(branch_labels.items())
+
+def write_machine_code_file(path:str, instructions:list, branch_labels:dict=None) -> None:
+    '''Writes machine code instructions and their labels to a binary machine code file.'''
+    with open(path, 'wb') as output_file:
+        output_file.write(encode_machine_code(instructions, branch_labels))
+
+def is_binary_machine_code_file(path:str) -> bool:
+    '''Returns True if the file at path begins with the magic bytes of a binary machine code file.'''
+    with open(path, 'rb') as input_file:
+        return input_file.read(len(MAGIC)) == MAGIC
+
+class MachineCodeFile:
+    '''MachineCodeFile : Class
+    A binary machine code file mapped into memory. Instructions are decoded from the mapping when they are accessed.
+    Use as a context manager, or call close() when finished with it.
+
+    Attributes:
+    path:str -- file that is mapped
+    block_count:int -- number of 15 instruction blocks in the program
+    code:memoryview -- the 2 byte instructions, a view of the mapped file
+    symbols:dict -- labels and their instruction cycle numbers
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as input_file:
+            self.mapping = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+        try:
+            if len(self.view) < HEADER.size:
+                raise Exception(f"{path} is too short to be a binary machine code file.")
+            magic, version, self.block_count, instruction_count, symbol_count = HEADER.unpack_from(self.view)
+            if magic != MAGIC:
+                raise Exception(f"{path} is not a binary machine code file.")
+            if version != FORMAT_VERSION:
+                raise Exception(f"{path} has format version {version}, only version {FORMAT_VERSION} can be read.")
+            code_end = HEADER.size + 2*instruction_count
+            if len(self.view) < code_end:
+                raise Exception(f"{path} is shorter than its header says.")
+            self.code = self.view[HEADER.size:code_end]
+
+            self.symbols = dict(decode_symbol_table(self.view, code_end, symbol_count)[0])
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.code) // 2
+
+    def __getitem__(self, instruction_index:int) -> tuple:
+        '''Returns the instruction at instruction_index as a tuple of 4 integers.'''
+        if instruction_index < 0:
+            instruction_index += len(self)
+        if instruction_index < 0 or instruction_index >= len(self):
+            raise IndexError("instruction index out of range")
+        high = NIBBLES_OF_BYTE[self.code[2*instruction_index]]
+        low = NIBBLES_OF_BYTE[self.code[2*instruction_index + 1]]
+        return high + low
+
+    def __iter__(self):
+        nibbles = NIBBLES_OF_BYTE
+        code = self.code
+        for byte_index in range(0, len(code), 2):
+            yield nibbles[code[byte_index]] + nibbles[code[byte_index + 1]]
+
+    def block(self, block_index:int) -> memoryview:
+        '''Returns the 2 byte instructions of a block (numbered from 1), as a view of the mapped file.'''
+        start = (block_index - 1) * INSTRUCTIONS_PER_BLOCK * 2
+        return self.code[start:start + INSTRUCTIONS_PER_BLOCK * 2]
+
+    def to_list(self) -> list:
+        '''Returns the instructions as a list of lists of 4 integers, the form used by the assembler.'''
+        return [list(instruction) for instruction in self]
+
+    def close(self) -> None:
+        '''Releases the views of the file and unmaps it.'''
+        if hasattr(self, "code"):
+            self.code.release()
+        self.view.release()
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_machine_code(path:str) -> list:
+    '''Reads a binary machine code file into a list of instructions, each a list of 4 integers.'''
+    with MachineCodeFile(path) as machine_code_file:
+        return machine_code_file.to_list()
+
+def export_text(path:str) -> str:
+    '''Returns the text machine code (as written by the assembler) for a binary machine code file.'''
+    from assembler import format_machine_code
+    return format_machine_code(read_machine_code(path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows or exports a binary machine code file.")
+    parser.add_argument("filename", help="program name, reading programs/machine code/<filename>_converted.bin")
+    parser.add_argument("--export-text", action="store_true", help="write the text machine code to programs/machine code/<filename>_converted.txt")
+    args = parser.parse_args()
+
+    path = "programs/machine code/" + args.filename + "_converted" + BINARY_EXTENSION
+    if args.export_text:
+        with open(os.path.splitext(path)[0] + ".txt", 'w') as output_file:
+            output_file.write(export_text(path))
+    else:
+        with MachineCodeFile(path) as machine_code_file:
+            print(f"Blocks: {machine_code_file.block_count}, instructions: {len(machine_code_file)}")
+            for label, instr_cycle in machine_code_file.symbols.items():
+                print(f"{label}: {instr_cycle}")
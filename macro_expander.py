@@ -0,0 +1,433 @@
+import functools
+import itertools
+
+from assembler import IMMEDIATE_OPERAND, MACRO_OPCODES, REGISTER_OPERAND, Instruction
+from constant_analysis import evaluate, evaluate_branch
+from cost_model import CostModel
+
+'''Expands the macros accepted by the assembler into sequences of the CPU's instructions. Each macro writes its first operand,
+and its other operands are registers or immediates:
+- MOVE R1, op1          - copies op1 into R1
+- MUL R1, op1, op2      - R1 = op1 * op2, keeping the low 8 bits
+- DIV R1, op1, op2      - R1 = op1 / op2, rounded down. Dividing by a register holding 0 gives 255
+- MOD R1, op1, op2      - R1 = the remainder of op1 / op2. Dividing by a register holding 0 gives op1
+- LSN R1, op1, op2      - R1 = op1 shifted left op2 times
+- RSN R1, op1, op2      - R1 = op1 shifted right op2 times
+
+There are several ways to expand most macros, e.g. multiplying by a constant with a chain of shifts and adds (strength reduction),
+with a loop that adds a shifted copy of op1 for each set bit of op2 (shift-and-add), or by repeated addition. Every way that suits
+the operands is run over a set of sample operand values, and the one that takes the fewest redstone ticks on average (see cost_model)
+is used. Expansions are run before custom branches are converted, so they can use BRU. The loops branch to fresh labels, and values
+being worked on are kept in scratch registers taken from the registers the program doesn't use. The scratch registers are shared
+by every macro in the program, as their values aren't needed once a macro has finished.
+'''
+
+SAMPLE_VALUES = (0, 1, 2, 3, 7, 10, 25, 64, 100, 127, 128, 200, 255)
+'''Values each register operand of a macro is given when estimating the ticks an expansion takes.'''
+
+COST_OPCODES = {"BRU": "BRE"}
+'''Custom branches used in expansions, and the opcode whose cost they have once converted.'''
+
+def evaluate_macro(opcode_str:str, sources:list) -> int:
+    '''Returns the value a macro writes, given the values of its source operands.'''
+    first = sources[0]
+    second = sources[1] if len(sources) > 1 else 0
+    if opcode_str == "MOVE":
+        return first
+    if opcode_str == "MUL":
+        return (first * second) & 0xFF
+    if opcode_str == "DIV":
+        return first // second if second != 0 else 0xFF
+    if opcode_str == "MOD":
+        return first % second if second != 0 else first
+    if opcode_str == "LSN":
+        return (first << second) & 0xFF if second < 8 else 0
+    if opcode_str == "RSN":
+        return first >> second
+    raise Exception(f"{opcode_str} is not a macro.")
+
+class MacroExpansion:
+    '''MacroExpansion : Class
+    Instructions a macro is expanded into, built up by one of the expansion functions.
+
+    Attributes:
+    destination:str -- register the macro writes
+    sources:tuple -- the macro's source operands
+    values:tuple -- the value of each immediate source operand, None for registers
+    get_scratch -- function that returns the register operand of scratch register n (counting from 0) of the program
+    label_prefix:str -- start of the name of each label the expansion declares
+    scratch:dict -- name the expansion gives a scratch register : its register operand
+    instructions:list -- the expansion so far, list of Instruction
+    '''
+    def __init__(self, operands:tuple, values:tuple, get_scratch, label_prefix:str):
+        self.destination = operands[0]
+        self.sources = operands[1:]
+        self.values = values[1:]
+        self.get_scratch = get_scratch
+        self.label_prefix = label_prefix
+        self.scratch = {}
+        self.instructions = []
+
+    def scratch_register(self, name:str) -> str:
+        '''Returns the scratch register given a name, the next of the program's scratch registers if it is a new name.'''
+        if name not in self.scratch:
+            self.scratch[name] = self.get_scratch(len(self.scratch))
+        return self.scratch[name]
+
+    def label(self, name:str) -> str:
+        return self.label_prefix + name
+
+    def emit(self, opcode_str:str, *operands, label:str=None) -> None:
+        self.instructions.append(Instruction(opcode_str, operands, label))
+
+    def emit_move(self, destination:str, source:str) -> None:
+        '''Copies source into destination, unless they are the same register.'''
+        if destination == source:
+            return
+        if source[0] == "#":
+            self.emit("LDI", destination, source)
+        else:
+            self.emit("OR", destination, source, source)
+
+    def emit_shifts(self, opcode_str:str, source:str, count:int) -> None:
+        '''Shifts source count times with LS or RS, into the destination.'''
+        current = source
+        for i in range(count):
+            self.emit(opcode_str, self.destination, current)
+            current = self.destination
+
+def load_constant(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''Loads the result of a macro whose operands are all immediates.'''
+    expansion.emit("LDI", expansion.destination, f"#{evaluate_macro(opcode_str, expansion.values)}")
+
+def copy_with_or(expansion:MacroExpansion, opcode_str:str) -> None:
+    source = expansion.sources[0]
+    expansion.emit("OR", expansion.destination, source, source)
+
+def copy_with_and(expansion:MacroExpansion, opcode_str:str) -> None:
+    source = expansion.sources[0]
+    expansion.emit("AND", expansion.destination, source, source)
+
+def copy_with_add(expansion:MacroExpansion, opcode_str:str) -> None:
+    expansion.emit("ADD", expansion.destination, expansion.sources[0], "#0")
+
+def shift_by_constant(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''LSN or RSN by an immediate, or DIV by a power of 2: a chain of shifts.'''
+    if opcode_str == "DIV":
+        expansion.emit_shifts("RS", expansion.sources[0], expansion.values[1].bit_length() - 1)
+    else:
+        expansion.emit_shifts(opcode_str[:2], expansion.sources[0], expansion.values[1])
+
+def shift_by_register(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''LSN or RSN by a register: shifts in a loop, counting down a copy of the register.'''
+    destination, source, count = expansion.destination, expansion.sources[0], expansion.sources[1]
+    #the count is copied first, so the destination can be written even if it is the count register
+    counter = expansion.scratch_register("count")
+    expansion.emit_move(counter, count)
+    expansion.emit_move(destination, source)
+    expansion.emit("BRU", expansion.label("test"))
+    expansion.emit(opcode_str[:2], destination, destination, label=expansion.label("loop"))
+    expansion.emit("SUB", counter, counter, "#1")
+    expansion.emit("BRLT", expansion.label("loop"), "#0", counter, label=expansion.label("test"))
+
+def mask_low_bits(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''MOD by a power of 2: an AND with the bits below it.'''
+    expansion.emit("AND", expansion.destination, expansion.sources[0], f"#{expansion.values[1] - 1}")
+
+def emit_multiply_chain(expansion:MacroExpansion, digits:list) -> None:
+    '''Multiplies the first source by a constant, given as its digits from the most significant, each 1, 0 or -1 (Horner's method):
+    after the leading 1, each digit shifts the product left, then adds or subtracts the first source for a 1 or -1.
+    '''
+    destination, source = expansion.destination, expansion.sources[0]
+    multiplicand = source
+    if destination == source and any(digit != 0 for digit in digits[1:]):
+        multiplicand = expansion.scratch_register("multiplicand")
+        expansion.emit_move(multiplicand, source)
+    current = source
+    for digit in digits[1:]:
+        expansion.emit("LS", destination, current)
+        current = destination
+        if digit != 0:
+            expansion.emit("ADD" if digit == 1 else "SUB", destination, destination, multiplicand)
+
+def multiply_binary(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''MUL by an immediate: a shift for each bit after the highest set bit, and an add for each of those bits that is set.'''
+    emit_multiply_chain(expansion, [int(bit) for bit in bin(expansion.values[1])[2:]])
+
+def multiply_signed_digits(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''MUL by an immediate, written with the digits 1, 0 and -1 so that runs of set bits take one subtract instead of several adds
+    (the non-adjacent form, e.g. 15 is 16 - 1).
+    '''
+    value = expansion.values[1]
+    digits = []
+    while value > 0:
+        digit = 2 - (value % 4) if value % 2 == 1 else 0
+        digits.append(digit)
+        value = (value - digit) // 2
+    emit_multiply_chain(expansion, digits[::-1])
+
+def multiply_shift_add(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''MUL: a loop that adds the first source to the product for each set bit of the second, shifting one left and the other right,
+    until no set bits are left.
+    '''
+    destination, first, second = expansion.destination, expansion.sources[0], expansion.sources[1]
+    multiplicand = expansion.scratch_register("multiplicand")
+    multiplier = expansion.scratch_register("multiplier")
+    bit = expansion.scratch_register("bit")
+    #both sources are copied before the product is cleared, so the destination can be either of them
+    expansion.emit_move(multiplicand, first)
+    expansion.emit_move(multiplier, second)
+    expansion.emit("LDI", destination, "#0")
+    expansion.emit("BRU", expansion.label("test"))
+    expansion.emit("AND", bit, multiplier, "#1", label=expansion.label("loop"))
+    expansion.emit("BRE", expansion.label("skip"), bit, "#0")
+    expansion.emit("ADD", destination, destination, multiplicand)
+    expansion.emit("LS", multiplicand, multiplicand, label=expansion.label("skip"))
+    expansion.emit("RS", multiplier, multiplier)
+    expansion.emit("BRLT", expansion.label("loop"), "#0", multiplier, label=expansion.label("test"))
+
+def multiply_repeated_addition(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''MUL: adds the first source to the product, the second source times.'''
+    destination, first, second = expansion.destination, expansion.sources[0], expansion.sources[1]
+    #the first source is read on every pass, so the product can't be kept in it
+    product = destination if destination != first else expansion.scratch_register("product")
+    counter = expansion.scratch_register("count")
+    expansion.emit_move(counter, second)
+    expansion.emit("LDI", product, "#0")
+    expansion.emit("BRU", expansion.label("test"))
+    expansion.emit("ADD", product, product, first, label=expansion.label("loop"))
+    expansion.emit("SUB", counter, counter, "#1")
+    expansion.emit("BRLT", expansion.label("loop"), "#0", counter, label=expansion.label("test"))
+    expansion.emit_move(destination, product)
+
+def divide_repeated_subtraction(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''DIV or MOD by an immediate: subtracts it from the dividend until what is left is smaller, counting the subtractions for DIV.'''
+    destination, dividend, divisor = expansion.destination, expansion.sources[0], expansion.values[1]
+    remainder = destination if opcode_str == "MOD" else expansion.scratch_register("remainder")
+    expansion.emit_move(remainder, dividend)
+    if opcode_str == "DIV":
+        expansion.emit("LDI", destination, "#0")
+    expansion.emit("BRU", expansion.label("test"))
+    expansion.emit("SUB", remainder, remainder, f"#{divisor}", label=expansion.label("loop"))
+    if opcode_str == "DIV":
+        expansion.emit("ADD", destination, destination, "#1")
+    #loops while remainder >= divisor
+    expansion.emit("BRLT", expansion.label("loop"), f"#{divisor - 1}", remainder, label=expansion.label("test"))
+
+def divide_restoring(expansion:MacroExpansion, opcode_str:str) -> None:
+    '''DIV or MOD: restoring division, one quotient bit per pass of a loop that runs 8 times. Each pass shifts the top bit of the
+    dividend into the remainder, and subtracts the divisor from the remainder if it is big enough, shifting a 1 into the quotient.
+    The quotient is built up in the bits of the dividend that have been shifted out.
+    '''
+    destination, dividend, divisor = expansion.destination, expansion.sources[0], expansion.sources[1]
+    #the divisor is read on every pass, so the destination can only hold a result during the loop if it isn't the divisor
+    if opcode_str == "DIV":
+        quotient = destination if destination != divisor else expansion.scratch_register("quotient")
+        remainder = expansion.scratch_register("remainder")
+    else:
+        quotient = expansion.scratch_register("quotient")
+        remainder = destination if destination != divisor else expansion.scratch_register("remainder")
+    counter = expansion.scratch_register("count")
+    expansion.emit_move(quotient, dividend)
+    expansion.emit("LDI", remainder, "#0")
+    expansion.emit("LDI", counter, "#8")
+
+    #a remainder of 128 or more would overflow when shifted, which can only happen when dividing by 128 or more,
+    #but then the quotient is 0 or 1, so it is found with one comparison and the loop is only run to its end
+    if expansion.values[1] is None or expansion.values[1] >= 128:
+        expansion.emit("BRLT", expansion.label("loop"), divisor, "#128")
+        expansion.emit("OR", remainder, quotient, quotient)
+        expansion.emit("LDI", quotient, "#0")
+        expansion.emit("LDI", counter, "#1")
+        expansion.emit("BRLT", expansion.label("next"), remainder, divisor)
+        expansion.emit("SUB", remainder, remainder, divisor)
+        expansion.emit("LDI", quotient, "#1")
+        expansion.emit("BRU", expansion.label("next"))
+    expansion.emit("LS", remainder, remainder, label=expansion.label("loop"))
+    expansion.emit("BRLT", expansion.label("shift"), quotient, "#128")
+    expansion.emit("OR", remainder, remainder, "#1")
+    expansion.emit("LS", quotient, quotient, label=expansion.label("shift"))
+    expansion.emit("BRLT", expansion.label("next"), remainder, divisor)
+    expansion.emit("SUB", remainder, remainder, divisor)
+    expansion.emit("OR", quotient, quotient, "#1")
+    expansion.emit("SUB", counter, counter, "#1", label=expansion.label("next"))
+    expansion.emit("BRLT", expansion.label("loop"), "#0", counter)
+    expansion.emit_move(destination, quotient if opcode_str == "DIV" else remainder)
+
+def load_zero(expansion:MacroExpansion, opcode_str:str) -> None:
+    expansion.emit("LDI", expansion.destination, "#0")
+
+MOVE_EXPANSIONS = [copy_with_or, copy_with_and, copy_with_add]
+
+def get_expansions(opcode_str:str, values:tuple) -> list:
+    '''Returns the functions that can expand a macro, given the value of each of its immediate operands (None for registers).
+    Each takes (MacroExpansion, opcode_str) and adds the instructions of the expansion to it.
+    '''
+    first, second = values[1], values[2] if len(values) > 2 else None
+    if all(value is not None for value in values[1:]):
+        return [load_constant]
+    if opcode_str == "MOVE":
+        return MOVE_EXPANSIONS
+    if second is None:
+        if opcode_str in ("LSN", "RSN"):
+            return [shift_by_register]
+        if opcode_str == "MUL":
+            return [multiply_shift_add, multiply_repeated_addition]
+        return [divide_restoring]
+
+    if opcode_str in ("LSN", "RSN"):
+        if second == 0:
+            return MOVE_EXPANSIONS
+        return [load_zero] if second >= 8 else [shift_by_constant]
+    if opcode_str == "MUL":
+        if second == 0:
+            return [load_zero]
+        if second == 1:
+            return MOVE_EXPANSIONS
+        return [multiply_binary, multiply_signed_digits, multiply_shift_add, multiply_repeated_addition]
+    if second == 1:
+        return [load_zero] if opcode_str == "MOD" else MOVE_EXPANSIONS
+    if second & (second - 1) == 0:
+        return [mask_low_bits] if opcode_str == "MOD" else [shift_by_constant]
+    return [divide_repeated_subtraction, divide_restoring]
+
+def estimate_ticks(instructions:list, inputs:dict, cost_model:CostModel) -> float:
+    '''Returns the ticks an expansion takes to run, starting with the given dict of register operand : value.'''
+    label_positions = {instruction.label: index for index, instruction in enumerate(instructions) if instruction.label is not None}
+    values = dict(inputs)
+    taken_branch = cost_model.event_ticks["taken_branch"]
+    ticks = 0
+    index = 0
+    while index < len(instructions):
+        instruction = instructions[index]
+        opcode_str = instruction.opcode_str
+        ticks += cost_model.instruction_ticks(COST_OPCODES.get(opcode_str, opcode_str))
+        index += 1
+        if opcode_str in ("BRU", "BRE", "BRLT"):
+            if opcode_str == "BRU" or evaluate_branch(instruction, values):
+                ticks += taken_branch
+                index = label_positions[instruction.operands[0]]
+        else:
+            values[instruction.operands[0]] = evaluate(instruction, values)
+    return ticks
+
+def get_canonical_operands(operands:tuple) -> tuple:
+    '''Returns the operands of a macro with its registers renamed R1, R2, R3 in order of first use, as the choice of expansion
+    only depends on which operands are the same register, and on the immediates.
+    '''
+    names = {}
+    canonical = []
+    for operand in operands:
+        if operand[0] == "#":
+            canonical.append(operand)
+        else:
+            canonical.append(names.setdefault(operand, f"R{len(names) + 1}"))
+    return tuple(canonical)
+
+@functools.lru_cache(maxsize=None)
+def choose_expansion(opcode_str:str, operands:tuple, opcode_ticks:tuple, event_ticks:tuple) -> int:
+    '''Returns the index in get_expansions() of the expansion that takes the fewest ticks on average over the sample values,
+    for a macro with canonical operands (see get_canonical_operands) and a cost model given as sorted tuples of its costs.
+    Ties go to the shorter expansion.
+    '''
+    values = tuple(int(operand[1:]) if operand[0] == "#" else None for operand in operands)
+    expansions = get_expansions(opcode_str, values)
+    if len(expansions) == 1:
+        return 0
+    cost_model = CostModel(dict(opcode_ticks), dict(event_ticks))
+
+    #dividing by a register holding 0 has a result, but isn't worth optimizing for
+    registers = sorted({operand for operand in operands[1:] if operand[0] != "#"})
+    samples = []
+    for register in registers:
+        is_divisor = opcode_str in ("DIV", "MOD") and register == operands[2]
+        samples.append([value for value in SAMPLE_VALUES if value != 0 or not is_divisor])
+
+    best = None
+    for index, expand in enumerate(expansions):
+        expansion = MacroExpansion(operands, values, lambda number: f"S{number}", "_")
+        expand(expansion, opcode_str)
+        ticks = 0
+        runs = 0
+        for sample in itertools.product(*samples):
+            ticks += estimate_ticks(expansion.instructions, dict(zip(registers, sample)), cost_model)
+            runs += 1
+        score = (ticks / runs, len(expansion.instructions))
+        if best is None or score < best[0]:
+            best = (score, index)
+    return best[1]
+
+def check_macro(instruction:Instruction) -> None:
+    '''Raises an exception if a macro's operands aren't a register to write followed by the right number of registers or immediates.'''
+    operand_count = 2 if instruction.opcode_str == "MOVE" else 3
+    if len(instruction.operands) != operand_count:
+        raise Exception(f"Line {instruction.line}: {instruction.opcode_str} takes {operand_count} operands.")
+    if instruction.kinds[0] != REGISTER_OPERAND:
+        raise Exception(f"Line {instruction.line}, operand 0: must be a register.")
+    for operand_index in range(1, operand_count):
+        kind, value = instruction.kinds[operand_index], instruction.values[operand_index]
+        if kind not in (REGISTER_OPERAND, IMMEDIATE_OPERAND) or value is None:
+            raise Exception(f"Line {instruction.line}, operand {operand_index}: must be a register or an immediate.")
+        if kind == IMMEDIATE_OPERAND and (value < 0 or value > 0xFF):
+            raise Exception(f"Line {instruction.line}, operand {operand_index}: immediates must be between 0 and 255.")
+    if instruction.opcode_str in ("DIV", "MOD") and instruction.operands[2] == "#0":
+        raise Exception(f"Line {instruction.line}: division by 0.")
+
+def has_macros(instructions:list) -> bool:
+    return any(instruction.opcode_str in MACRO_OPCODES for instruction in instructions)
+
+def expand_macros(instructions:list, available_registers:list, cost_model:CostModel=None) -> list:
+    '''Replaces each macro in the instructions (with comments removed) with its fastest expansion under cost_model.
+    Scratch registers are taken from available_registers, highest first, leaving out any the program uses.
+    Returns the numbers of the registers used as scratch registers.
+    '''
+    if cost_model is None:
+        cost_model = CostModel()
+    opcode_ticks = tuple(sorted(cost_model.opcode_ticks.items()))
+    event_ticks = tuple(sorted(cost_model.event_ticks.items()))
+
+    used_registers = {value for instruction in instructions for kind, value in zip(instruction.kinds, instruction.values) if kind == REGISTER_OPERAND}
+    free_registers = [register for register in available_registers if register not in used_registers]
+    scratch_registers = []
+    def get_scratch(number:int) -> str:
+        while len(scratch_registers) <= number:
+            if len(free_registers) == 0:
+                raise Exception("Run out of registers to use.")
+            scratch_registers.append(free_registers.pop())
+        return f"R{scratch_registers[number]}"
+
+    labels = {instruction.label for instruction in instructions if instruction.label is not None}
+    macro_count = 0
+    expanded = []
+    for instruction in instructions:
+        if instruction.opcode_str not in MACRO_OPCODES:
+            expanded.append(instruction)
+            continue
+        check_macro(instruction)
+
+        #labels are named after the macro, numbered so they can't clash with the program's own
+        macro_count += 1
+        label_prefix = f"_{instruction.opcode_str.lower()}{macro_count}_"
+        while any(label.startswith(label_prefix) for label in labels):
+            macro_count += 1
+            label_prefix = f"_{instruction.opcode_str.lower()}{macro_count}_"
+
+        operands = instruction.operands
+        values = tuple(value if kind == IMMEDIATE_OPERAND else None for kind, value in zip(instruction.kinds, instruction.values))
+        #multiplying is commutative, so a constant is always put second, where it can be strength reduced
+        if instruction.opcode_str == "MUL" and values[1] is not None and values[2] is None:
+            operands = (operands[0], operands[2], operands[1])
+            values = (values[0], values[2], values[1])
+        expand = get_expansions(instruction.opcode_str, values)[choose_expansion(instruction.opcode_str, get_canonical_operands(operands),
+                                                                                opcode_ticks, event_ticks)]
+        expansion = MacroExpansion(operands, values, get_scratch, label_prefix)
+        expand(expansion, instruction.opcode_str)
+        if instruction.label is not None:
+            if expansion.instructions[0].label is not None:
+                raise Exception(f"Line {instruction.line}: the expansion of {instruction.opcode_str} can't start with a label.")
+            expansion.instructions[0].label = instruction.label
+        for expanded_instruction in expansion.instructions:
+            expanded_instruction.line = instruction.line
+        expanded.extend(expansion.instructions)
+    instructions[:] = expanded
+    return scratch_registers
@@ -0,0 +1,754 @@
+import argparse
+import collections
+import concurrent.futures
+import heapq
+import json
+
+from assembler import OPCODES
+from block_compiler import step
+from simulator import (DATA_CELL_OF_ADDRESS, DATA_MEMORY_CELLS, DEFAULT_MAX_CYCLES, INSTRUCTIONS_PER_BLOCK, NUMBER_OF_REGISTERS,
+                       PAGE_FRAMES, WORD_MASK, SimulationResult, decode_program, get_machine_code_path, read_machine_code_file)
+
+'''Discrete-event simulation of several CPUs connected by links, for sizing multi-CPU designs and I/O device polling loops
+before building them in the world.
+
+Data memory cells can be reserved as ports. A link carries bytes one way, from an output port of one CPU to an input port of
+another, or from a source device to a CPU, or from a CPU to a sink device:
+- STR to an output port sends the value. If the link already holds capacity values, the CPU stalls until one is taken.
+- LD from an input port takes the oldest value that has arrived. If there isn't one, the CPU stalls until one arrives.
+- LD from a status port doesn't stall: the status port of an input gives the number of values that have arrived,
+  and the status port of an output gives the space left in the link, so programs can poll instead of stalling.
+A value takes latency time units to arrive, and counts towards the capacity of the link from when it is sent until it is taken.
+
+Each CPU runs its program like simulator.py, taking cycle_time time units per instruction and page_load_time for each page load.
+Instructions that don't touch a port can't affect another CPU, so a CPU runs until its next port access in one go,
+and only the port accesses are put on the priority queue that orders events across the network by time.
+The simulation ends when every CPU and device has finished or is stalled with nothing left that could wake it.
+Parts of the network that aren't linked to each other are independent, so with more than one worker they are run in separate processes.
+'''
+
+RUNNING = "running"
+STALLED = "stalled"
+FINISHED = "finished"
+
+MAX_PORT_VALUE = WORD_MASK
+'''Status ports give counts above 255 as 255.'''
+
+class Link:
+    '''Link : Class
+    One-way connection carrying bytes between two ends. An end is a CPU (with a port address) or a device (with address None).
+
+    Attributes:
+    name:str -- name used in reports
+    sender:str -- name of the CPU or source device that sends values
+    sender_address:int -- data memory address of the output port on the sending CPU, None for a device
+    receiver:str -- name of the CPU or sink device that takes values
+    receiver_address:int -- data memory address of the input port on the receiving CPU, None for a device
+    capacity:int -- number of values the link can hold at once, including values still in transit
+    latency:float -- time units a value takes to arrive
+    sender_status_address:int -- address the sending CPU can LD to get the space left in the link, or None
+    receiver_status_address:int -- address the receiving CPU can LD to get the number of values that have arrived, or None
+    '''
+    def __init__(self, name:str, sender:str, sender_address:int, receiver:str, receiver_address:int, capacity:int=1, latency:float=0,
+                 sender_status_address:int=None, receiver_status_address:int=None):
+        self.name = name
+        self.sender = sender
+        self.sender_address = sender_address
+        self.receiver = receiver
+        self.receiver_address = receiver_address
+        self.capacity = capacity
+        self.latency = latency
+        self.sender_status_address = sender_status_address
+        self.receiver_status_address = receiver_status_address
+
+class CPUConfig:
+    '''CPUConfig : Class
+
+    Attributes:
+    machine_code:list -- the program, as produced by convert_to_machine_code() in assembler.py
+    cycle_time:float -- time units each instruction takes
+    page_load_time:float -- time units each page load takes
+    registers:list -- starting values of R1-R15, or None for all zeros
+    memory:list -- starting values of the 60 data memory cells, or None for all zeros
+    '''
+    def __init__(self, machine_code:list, cycle_time:float=1, page_load_time:float=0, registers:list=None, memory:list=None):
+        self.machine_code = machine_code
+        self.cycle_time = cycle_time
+        self.page_load_time = page_load_time
+        self.registers = registers
+        self.memory = memory
+
+class SourceConfig:
+    '''SourceConfig : Class
+    An input device, such as a row of levers, that sends a list of values, one every interval time units after the last was accepted.
+
+    Attributes:
+    values:list -- bytes to send, in order
+    interval:float -- time units between values
+    '''
+    def __init__(self, values:list, interval:float=1):
+        self.values = values
+        self.interval = interval
+
+class SinkConfig:
+    '''SinkConfig : Class
+    An output device, such as a display, that takes a value whenever one has arrived, at most one every interval time units.
+
+    Attributes:
+    interval:float -- time units the device needs between values
+    '''
+    def __init__(self, interval:float=1):
+        self.interval = interval
+
+class Network:
+    '''Network : Class
+    CPUs and devices, and the links between them.
+
+    Attributes:
+    cpus:dict -- name : CPUConfig
+    sources:dict -- name : SourceConfig
+    sinks:dict -- name : SinkConfig
+    links:list -- Link instances
+    '''
+    def __init__(self):
+        self.cpus = {}
+        self.sources = {}
+        self.sinks = {}
+        self.links = []
+
+    def check_new_name(self, name:str) -> None:
+        '''Raises an exception if a CPU or device already has the name.'''
+        if name in self.cpus or name in self.sources or name in self.sinks:
+            raise Exception(f"{name} is already in the network.")
+
+    def add_cpu(self, name:str, machine_code:list, cycle_time:float=1, page_load_time:float=0, registers:list=None, memory:list=None) -> None:
+        '''Adds a CPU running the given machine code.'''
+        self.check_new_name(name)
+        self.cpus[name] = CPUConfig(machine_code, cycle_time, page_load_time, registers, memory)
+
+    def add_source(self, name:str, values:list, interval:float=1) -> None:
+        '''Adds an input device sending the given values.'''
+        self.check_new_name(name)
+        self.sources[name] = SourceConfig(list(values), interval)
+
+    def add_sink(self, name:str, interval:float=1) -> None:
+        '''Adds an output device.'''
+        self.check_new_name(name)
+        self.sinks[name] = SinkConfig(interval)
+
+    def connect(self, sender:str, receiver:str, sender_address:int=None, receiver_address:int=None, capacity:int=1, latency:float=0,
+                sender_status_address:int=None, receiver_status_address:int=None, name:str=None) -> Link:
+        '''Adds a link from sender to receiver. Addresses are only given for the ends that are CPUs. Returns the Link.'''
+        name = name if name is not None else f"{sender}->{receiver}"
+        if any(link.name == name for link in self.links):
+            raise Exception(f"There is already a link called {name}.")
+        if sender not in self.cpus and sender not in self.sources:
+            raise Exception(f"Link {name}: {sender} is not a CPU or source device.")
+        if receiver not in self.cpus and receiver not in self.sinks:
+            raise Exception(f"Link {name}: {receiver} is not a CPU or sink device.")
+        if capacity < 1:
+            raise Exception(f"Link {name}: capacity must be at least 1.")
+        link = Link(name, sender, sender_address, receiver, receiver_address, capacity, latency, sender_status_address, receiver_status_address)
+        self.links.append(link)
+        #checks the port addresses straight away, so mistakes are reported where the link is added
+        try:
+            for end in (sender, receiver):
+                if end in self.cpus:
+                    get_port_map(self, end)
+        except Exception:
+            self.links.pop()
+            raise
+        return link
+
+    def get_links_of(self, name:str) -> list:
+        '''Returns the links that a CPU or device sends or takes values on.'''
+        return [link for link in self.links if link.sender == name or link.receiver == name]
+
+    def split(self) -> list:
+        '''Returns list of Networks, one for each group of CPUs and devices that are linked to each other.'''
+        group_of = {}
+        def find(name:str) -> str:
+            while group_of.setdefault(name, name) != name:
+                name = group_of[name]
+            return name
+        for link in self.links:
+            group_of[find(link.sender)] = find(link.receiver)
+
+        parts = {}
+        for name in list(self.cpus) + list(self.sources) + list(self.sinks):
+            part = parts.setdefault(find(name), Network())
+            for members, configs in ((part.cpus, self.cpus), (part.sources, self.sources), (part.sinks, self.sinks)):
+                if name in configs:
+                    members[name] = configs[name]
+        for link in self.links:
+            parts[find(link.sender)].links.append(link)
+        return list(parts.values())
+
+def get_port_map(network:Network, cpu_name:str) -> dict:
+    '''Returns dict of (address, True for STR/False for LD) : (Link, kind of port) for a CPU, where the kind is
+    "send", "receive", "space" or "count". Raises an exception if an address isn't a data memory cell or is used twice in the same way.
+    '''
+    ports = {}
+    for link in network.links:
+        uses = []
+        if link.sender == cpu_name:
+            uses += [(link.sender_address, True, "send"), (link.sender_status_address, False, "space")]
+        if link.receiver == cpu_name:
+            uses += [(link.receiver_address, False, "receive"), (link.receiver_status_address, False, "count")]
+        for address, is_store, kind in uses:
+            if address is None:
+                if kind in ("send", "receive"):
+                    raise Exception(f"Link {link.name}: the port address on CPU {cpu_name} must be given.")
+                continue
+            if address < 0 or address > WORD_MASK or DATA_CELL_OF_ADDRESS[address] < 0:
+                raise Exception(f"Link {link.name}: {hex(address)} is not a data memory address.")
+            if (address, is_store) in ports:
+                raise Exception(f"Link {link.name}: CPU {cpu_name} already uses {hex(address)} as a port.")
+            ports[(address, is_store)] = (link, kind)
+    return ports
+
+class LinkState:
+    '''LinkState : Class
+    A link during a simulation, with its statistics.
+
+    Attributes:
+    link:Link -- the link
+    queue:collections.deque -- (arrival time, value) of the values sent and not yet taken, oldest first
+    sender -- Actor that sends on the link
+    receiver -- Actor that takes values from the link
+    values_sent:int -- number of values sent
+    values_received:int -- number of values taken
+    sender_stall_time:float -- time the sender spent stalled because the link was full
+    receiver_stall_time:float -- time the receiver spent stalled because no value had arrived
+    max_depth:int -- most values the link held at once
+    depth_area:float -- values held multiplied by the time they were held for, for the average depth
+    total_latency:float -- time from sending to taking, summed over the values taken
+    last_change:float -- time the number of values held last changed
+    '''
+    def __init__(self, link:Link):
+        self.link = link
+        self.queue = collections.deque()
+        self.sender = None
+        self.receiver = None
+        self.values_sent = 0
+        self.values_received = 0
+        self.sender_stall_time = 0
+        self.receiver_stall_time = 0
+        self.max_depth = 0
+        self.depth_area = 0
+        self.total_latency = 0
+        self.last_change = 0
+
+    def record_depth(self, now:float) -> None:
+        '''Adds the time since the last change to depth_area. Called before the number of values held changes.'''
+        self.depth_area += len(self.queue) * (now - self.last_change)
+        self.last_change = now
+
+    def arrived_count(self, now:float) -> int:
+        '''Returns the number of values that have arrived and not been taken.'''
+        count = 0
+        for arrival, value in self.queue:
+            if arrival > now:
+                break
+            count += 1
+        return count
+
+    def try_send(self, simulation, value:int) -> bool:
+        '''Sends a value if the link has space, waking the receiver if it is waiting. Returns False if the link is full.'''
+        now = simulation.now
+        if len(self.queue) >= self.link.capacity:
+            return False
+        self.record_depth(now)
+        self.queue.append((now + self.link.latency, value))
+        self.values_sent += 1
+        self.max_depth = max(self.max_depth, len(self.queue))
+        if len(self.queue) == 1:
+            simulation.wake(self.receiver, now + self.link.latency)
+        return True
+
+    def try_receive(self, simulation):
+        '''Takes the oldest value that has arrived, waking the sender if it is waiting. Returns None if no value has arrived.'''
+        now = simulation.now
+        if len(self.queue) == 0 or self.queue[0][0] > now:
+            return None
+        arrival, value = self.queue[0]
+        self.record_depth(now)
+        self.queue.popleft()
+        self.values_received += 1
+        self.total_latency += now - (arrival - self.link.latency)
+        simulation.wake(self.sender, now)
+        return value
+
+class Actor:
+    '''Actor : Class
+    Something in the network that runs over time: a CPU or a device.
+
+    Attributes:
+    name:str -- name in the network
+    state:str -- RUNNING, STALLED or FINISHED
+    stalled_since:float -- time the actor stalled, if it is stalled
+    stall_time:float -- total time spent stalled
+    stalled_on:LinkState -- link the actor is stalled on, if it is stalled
+    wake_time:float -- time of the resume event scheduled for the actor, or None if there isn't one
+    '''
+    def __init__(self, name:str):
+        self.name = name
+        self.state = RUNNING
+        self.stalled_since = 0
+        self.stall_time = 0
+        self.stalled_on = None
+        self.wake_time = None
+
+    def stall(self, simulation, link_state:LinkState, is_sender:bool) -> None:
+        '''Marks the actor as stalled on a link. A receiver waiting for a value still in transit is woken when it arrives.'''
+        self.state = STALLED
+        self.stalled_since = simulation.now
+        self.stalled_on = (link_state, is_sender)
+        if not is_sender and len(link_state.queue) > 0:
+            simulation.wake(self, link_state.queue[0][0])
+
+    def unstall(self, now:float) -> None:
+        '''Adds the time stalled to the actor and the link it was stalled on.'''
+        if self.state != STALLED:
+            return
+        stalled = now - self.stalled_since
+        self.stall_time += stalled
+        link_state, is_sender = self.stalled_on
+        if is_sender:
+            link_state.sender_stall_time += stalled
+        else:
+            link_state.receiver_stall_time += stalled
+        self.state = RUNNING
+        self.stalled_on = None
+
+class CPUActor(Actor):
+    '''CPUActor : Class
+    A CPU during a simulation. Registers, memory, paging and errors are the same as run() in simulator.py.
+
+    Attributes:
+    config:CPUConfig -- the CPU's settings
+    program:list -- decoded instructions
+    ports:dict -- (address, True for STR/False for LD) : (LinkState, kind of port), see get_port_map()
+    regs:list -- registers, index 0 is unused
+    mem:list -- data memory cells
+    counts:list -- number of times each instruction was executed
+    index:int -- index of the next instruction
+    cycles:int -- instructions executed
+    page_loads:int -- number of page loads
+    frames:list -- blocks in the page frames, the block executed most recently last
+    block_end:int -- index at which the block being executed ends
+    port_accesses:int -- number of LDs and STRs that used a port
+    finish_time:float -- time the program finished, or None
+    '''
+    def __init__(self, name:str, config:CPUConfig, ports:dict):
+        super().__init__(name)
+        self.config = config
+        self.program = decode_program(config.machine_code)
+        self.ports = ports
+        self.regs = [0] * (NUMBER_OF_REGISTERS + 1)
+        if config.registers is not None:
+            if len(config.registers) != NUMBER_OF_REGISTERS:
+                raise Exception(f"{name}: registers must contain {NUMBER_OF_REGISTERS} values.")
+            self.regs[1:] = [value & WORD_MASK for value in config.registers]
+        self.mem = [0] * DATA_MEMORY_CELLS
+        if config.memory is not None:
+            if len(config.memory) != DATA_MEMORY_CELLS:
+                raise Exception(f"{name}: memory must contain {DATA_MEMORY_CELLS} values.")
+            self.mem[:] = [value & WORD_MASK for value in config.memory]
+        self.counts = [0] * len(self.program)
+        self.index = 0
+        self.cycles = 0
+        self.page_loads = 0
+        self.frames = []
+        self.block_end = 0
+        self.port_accesses = 0
+        self.finish_time = None
+
+    def load_page(self) -> bool:
+        '''Moves the block of the next instruction into a page frame, if execution has moved to another block.
+        Returns True if a page had to be loaded.
+        '''
+        if self.index < self.block_end and self.index >= self.block_end - INSTRUCTIONS_PER_BLOCK:
+            return False
+        block = self.index // INSTRUCTIONS_PER_BLOCK
+        self.block_end = (block + 1) * INSTRUCTIONS_PER_BLOCK
+        if block in self.frames:
+            self.frames.remove(block)
+            self.frames.append(block)
+            return False
+        self.page_loads += 1
+        if len(self.frames) == PAGE_FRAMES:
+            self.frames.pop(0)
+        self.frames.append(block)
+        return True
+
+    def resume(self, simulation) -> None:
+        '''Runs instructions up to the next port access, which is scheduled at the time the CPU reaches it, or carried out if that is now.'''
+        program = self.program
+        length = len(program)
+        ports = self.ports
+        LD, STR = OPCODES["LD"], OPCODES["STR"]
+        time = simulation.now
+        while True:
+            while self.index < length:
+                if self.load_page():
+                    time += self.config.page_load_time
+                opcode, a, b, c = program[self.index]
+                if (opcode == LD or opcode == STR) and (self.regs[b], opcode == STR) in ports:
+                    break
+                if self.cycles >= simulation.max_cycles:
+                    raise Exception(f"{self.name}: program did not finish within {simulation.max_cycles} cycles.")
+                self.counts[self.index] += 1
+                self.cycles += 1
+                self.index = step(program, self.index, self.regs, self.mem)
+                time += self.config.cycle_time
+            if self.index >= length:
+                self.state = FINISHED
+                self.finish_time = time
+                return
+            if time > simulation.now:
+                simulation.schedule(time, self)
+                return
+            if not self.access_port(simulation):
+                return
+            time += self.config.cycle_time
+
+    def access_port(self, simulation) -> bool:
+        '''Carries out the LD or STR at index on a port. Returns False if the CPU has to stall.'''
+        opcode, a, b, c = self.program[self.index]
+        link_state, kind = self.ports[(self.regs[b], opcode == OPCODES["STR"])]
+        if kind == "send":
+            if not link_state.try_send(simulation, self.regs[a]):
+                self.stall(simulation, link_state, True)
+                return False
+        elif kind == "receive":
+            value = link_state.try_receive(simulation)
+            if value is None:
+                self.stall(simulation, link_state, False)
+                return False
+            self.regs[a] = value
+        elif kind == "count":
+            self.regs[a] = min(link_state.arrived_count(simulation.now), MAX_PORT_VALUE)
+        else:
+            self.regs[a] = min(link_state.link.capacity - len(link_state.queue), MAX_PORT_VALUE)
+        self.counts[self.index] += 1
+        self.cycles += 1
+        self.port_accesses += 1
+        self.index += 1
+        return True
+
+    def get_result(self) -> SimulationResult:
+        '''Returns the state of the CPU as a SimulationResult.'''
+        return SimulationResult(registers=self.regs[1:], memory=list(self.mem), cycles=self.cycles, page_loads=self.page_loads,
+                                execution_counts=list(self.counts))
+
+class SourceActor(Actor):
+    '''SourceActor : Class
+    A source device during a simulation.
+
+    Attributes:
+    config:SourceConfig -- the device's settings
+    link_state:LinkState -- link it sends on
+    next_value:int -- index of the next value to send
+    '''
+    def __init__(self, name:str, config:SourceConfig, link_state:LinkState):
+        super().__init__(name)
+        self.config = config
+        self.link_state = link_state
+        self.next_value = 0
+
+    def resume(self, simulation) -> None:
+        '''Sends the next value, then waits for the interval.'''
+        if self.next_value >= len(self.config.values):
+            self.state = FINISHED
+            return
+        if not self.link_state.try_send(simulation, self.config.values[self.next_value] & WORD_MASK):
+            self.stall(simulation, self.link_state, True)
+            return
+        self.next_value += 1
+        simulation.schedule(simulation.now + self.config.interval, self)
+
+class SinkActor(Actor):
+    '''SinkActor : Class
+    A sink device during a simulation.
+
+    Attributes:
+    config:SinkConfig -- the device's settings
+    link_state:LinkState -- link it takes values from
+    values:list -- values taken
+    ready_time:float -- time the device can take its next value
+    '''
+    def __init__(self, name:str, config:SinkConfig, link_state:LinkState):
+        super().__init__(name)
+        self.config = config
+        self.link_state = link_state
+        self.values = []
+        self.ready_time = 0
+
+    def resume(self, simulation) -> None:
+        '''Takes a value if one has arrived and the device is ready, otherwise waits.'''
+        if simulation.now < self.ready_time:
+            simulation.schedule(self.ready_time, self)
+            return
+        value = self.link_state.try_receive(simulation)
+        if value is None:
+            self.stall(simulation, self.link_state, False)
+            return
+        self.values.append(value)
+        self.ready_time = simulation.now + self.config.interval
+        simulation.schedule(self.ready_time, self)
+
+class LinkReport:
+    '''LinkReport : Class
+    Statistics of a link over a simulation.
+
+    Attributes:
+    name:str -- name of the link
+    values_sent:int -- number of values sent
+    values_received:int -- number of values taken
+    throughput:float -- values taken per 1000 time units
+    sender_stall_time:float -- time the sender spent stalled because the link was full
+    receiver_stall_time:float -- time the receiver spent stalled because no value had arrived
+    max_depth:int -- most values the link held at once
+    average_depth:float -- number of values held, averaged over the simulation
+    average_latency:float -- time from sending to taking, averaged over the values taken
+    final_depth:int -- values still held when the simulation ended
+    '''
+    def __init__(self, link_state:LinkState, duration:float):
+        link_state.record_depth(duration)
+        self.name = link_state.link.name
+        self.values_sent = link_state.values_sent
+        self.values_received = link_state.values_received
+        self.throughput = link_state.values_received * 1000 / duration if duration > 0 else 0.0
+        self.sender_stall_time = link_state.sender_stall_time
+        self.receiver_stall_time = link_state.receiver_stall_time
+        self.max_depth = link_state.max_depth
+        self.average_depth = link_state.depth_area / duration if duration > 0 else 0.0
+        self.average_latency = link_state.total_latency / link_state.values_received if link_state.values_received > 0 else 0.0
+        self.final_depth = len(link_state.queue)
+
+class ActorReport:
+    '''ActorReport : Class
+    State of a CPU or device at the end of a simulation.
+
+    Attributes:
+    name:str -- name in the network
+    state:str -- RUNNING (stopped by the time limit), STALLED or FINISHED
+    stall_time:float -- time spent stalled
+    finish_time:float -- time the program finished, None for devices and CPUs that didn't finish
+    stalled_on:str -- name of the link the actor was stalled on at the end, or None
+    result:SimulationResult -- final state of a CPU, None for devices
+    port_accesses:int -- number of port accesses of a CPU
+    values:list -- values taken by a sink device, None for anything else
+    '''
+    def __init__(self, actor:Actor, now:float):
+        self.name = actor.name
+        self.state = actor.state
+        self.stalled_on = actor.stalled_on[0].link.name if actor.state == STALLED else None
+        #the time stalled at the end counts towards the actor's and the link's stall time
+        actor.unstall(now)
+        self.stall_time = actor.stall_time
+        self.finish_time = getattr(actor, "finish_time", None)
+        self.result = actor.get_result() if isinstance(actor, CPUActor) else None
+        self.port_accesses = getattr(actor, "port_accesses", 0)
+        self.values = list(actor.values) if isinstance(actor, SinkActor) else None
+
+class NetworkReport:
+    '''NetworkReport : Class
+
+    Attributes:
+    duration:float -- time at which the simulation ended
+    cpus:dict -- CPU name : ActorReport
+    devices:dict -- device name : ActorReport
+    links:dict -- link name : LinkReport
+    '''
+    def __init__(self, duration:float, cpus:dict, devices:dict, links:dict):
+        self.duration = duration
+        self.cpus = cpus
+        self.devices = devices
+        self.links = links
+
+    def get_deadlocked_cpus(self) -> list:
+        '''Returns the names of the CPUs left stalled at the end of the simulation.'''
+        return [name for name, report in self.cpus.items() if report.state == STALLED]
+
+    def __str__(self):
+        lines = [f"Simulated {self.duration:g} time units"]
+        lines.append(f"{'cpu/device':<16} {'state':<9} {'finish':>10} {'cycles':>9} {'pages':>6} {'ports':>7} {'stalled':>10} {'stall %':>7}")
+        for name, report in list(self.cpus.items()) + list(self.devices.items()):
+            finish = f"{report.finish_time:g}" if report.finish_time is not None else "-"
+            share = 100 * report.stall_time / self.duration if self.duration > 0 else 0.0
+            cycles, page_loads = (report.result.cycles, report.result.page_loads) if report.result is not None else ("-", "-")
+            lines.append(f"{name:<16} {report.state:<9} {finish:>10} {cycles:>9} {page_loads:>6} "
+                         f"{report.port_accesses:>7} {report.stall_time:>10g} {share:>7.1f}")
+        lines.append("")
+        lines.append(f"{'link':<24} {'sent':>7} {'taken':>7} {'per 1000':>9} {'latency':>8} {'depth':>6} {'max':>4} "
+                     f"{'send stall':>10} {'take stall':>10}")
+        for name, report in self.links.items():
+            lines.append(f"{name:<24} {report.values_sent:>7} {report.values_received:>7} {report.throughput:>9.2f} "
+                         f"{report.average_latency:>8.1f} {report.average_depth:>6.2f} {report.max_depth:>4} "
+                         f"{report.sender_stall_time:>10g} {report.receiver_stall_time:>10g}")
+        for name in self.get_deadlocked_cpus():
+            lines.append(f"{name} was left stalled on {self.cpus[name].stalled_on}.")
+        return "\n".join(lines)
+
+class NetworkSimulation:
+    '''NetworkSimulation : Class
+    Runs a Network on a priority queue of events ordered by time.
+
+    Attributes:
+    network:Network -- the network being simulated
+    max_time:float -- time after which no more events are handled, so no more port accesses are carried out
+    max_cycles:int -- instructions a CPU may execute before an exception is raised
+    now:float -- time of the event being handled
+    events:list -- heap of (time, sequence number, Actor) resume events
+    sequence:int -- number of events scheduled so far, so that events at the same time run in the order they were scheduled
+    cpus:dict -- name : CPUActor
+    devices:dict -- name : SourceActor or SinkActor
+    link_states:dict -- link name : LinkState
+    '''
+    def __init__(self, network:Network, max_time:float=None, max_cycles:int=DEFAULT_MAX_CYCLES):
+        self.network = network
+        self.max_time = max_time
+        self.max_cycles = max_cycles
+        self.now = 0
+        self.events = []
+        self.sequence = 0
+        self.link_states = {link.name: LinkState(link) for link in network.links}
+        self.cpus = {}
+        for name, config in network.cpus.items():
+            ports = {key: (self.link_states[link.name], kind) for key, (link, kind) in get_port_map(network, name).items()}
+            self.cpus[name] = CPUActor(name, config, ports)
+        self.devices = {}
+        for name, config in network.sources.items():
+            links = network.get_links_of(name)
+            if len(links) != 1:
+                raise Exception(f"Source {name} must have exactly one link.")
+            self.devices[name] = SourceActor(name, config, self.link_states[links[0].name])
+        for name, config in network.sinks.items():
+            links = network.get_links_of(name)
+            if len(links) != 1:
+                raise Exception(f"Sink {name} must have exactly one link.")
+            self.devices[name] = SinkActor(name, config, self.link_states[links[0].name])
+        actors = dict(self.cpus, **self.devices)
+        for link_state in self.link_states.values():
+            link_state.sender = actors[link_state.link.sender]
+            link_state.receiver = actors[link_state.link.receiver]
+
+    def schedule(self, time:float, actor:Actor) -> None:
+        '''Schedules actor.resume() at the given time, replacing any earlier resume event of the actor.'''
+        actor.wake_time = time
+        heapq.heappush(self.events, (time, self.sequence, actor))
+        self.sequence += 1
+
+    def wake(self, actor:Actor, time:float) -> None:
+        '''Schedules a stalled actor to resume at the given time, when what it is waiting for will be ready.'''
+        if actor.state == STALLED and (actor.wake_time is None or actor.wake_time > time):
+            self.schedule(time, actor)
+
+    def run(self) -> NetworkReport:
+        '''Runs the network until nothing is left that can run, or until max_time. Returns a NetworkReport.'''
+        for actor in list(self.cpus.values()) + list(self.devices.values()):
+            self.schedule(0, actor)
+        while len(self.events) > 0:
+            time, sequence, actor = heapq.heappop(self.events)
+            #events replaced by a later call to schedule() are skipped
+            if actor.wake_time != time or actor.state == FINISHED:
+                continue
+            if self.max_time is not None and time > self.max_time:
+                self.now = self.max_time
+                break
+            self.now = time
+            actor.wake_time = None
+            actor.unstall(time)
+            actor.resume(self)
+        #a CPU runs ahead of the clock between port accesses, so it can finish after the last event
+        self.now = max([self.now] + [cpu.finish_time for cpu in self.cpus.values() if cpu.finish_time is not None])
+        return self.get_report()
+
+    def get_report(self) -> NetworkReport:
+        '''Returns the NetworkReport for the simulation so far.'''
+        cpus = {name: ActorReport(cpu, self.now) for name, cpu in self.cpus.items()}
+        devices = {name: ActorReport(device, self.now) for name, device in self.devices.items()}
+        links = {name: LinkReport(link_state, self.now) for name, link_state in self.link_states.items()}
+        return NetworkReport(self.now, cpus, devices, links)
+
+def simulate_part(task:tuple) -> NetworkReport:
+    '''Simulates a (Network, max time, max cycles) task in a worker process.'''
+    network, max_time, max_cycles = task
+    return NetworkSimulation(network, max_time, max_cycles).run()
+
+def simulate(network:Network, max_time:float=None, max_cycles:int=DEFAULT_MAX_CYCLES, workers:int=1) -> NetworkReport:
+    '''Simulates a network, returning a NetworkReport. With more than 1 worker, parts of the network that aren't linked
+    to each other are simulated in separate processes; each part keeps its own clock, and the duration is that of the longest.
+    '''
+    parts = network.split()
+    tasks = [(part, max_time, max_cycles) for part in parts]
+    if (workers is not None and workers <= 1) or len(parts) <= 1:
+        reports = [simulate_part(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            reports = list(executor.map(simulate_part, tasks))
+
+    cpus = {}
+    devices = {}
+    links = {}
+    for report in reports:
+        cpus.update(report.cpus)
+        devices.update(report.devices)
+        links.update(report.links)
+    #reports are given in the order the network was described
+    return NetworkReport(duration=max(report.duration for report in reports) if len(reports) > 0 else 0,
+                         cpus={name: cpus[name] for name in network.cpus},
+                         devices={name: devices[name] for name in list(network.sources) + list(network.sinks)},
+                         links={link.name: links[link.name] for link in network.links})
+
+def parse_address(address) -> int:
+    '''Returns an address given as an integer or a string such as "0x4f", or None.'''
+    if address is None or isinstance(address, int):
+        return address
+    return int(address, 0)
+
+def read_network_file(path:str) -> Network:
+    '''Reads a network from a JSON file in the form:
+    {"cpus": {"name": {"program": "program name", "cycle_time": 1, "page_load_time": 0}},
+     "sources": {"name": {"values": [1, 2, 3], "interval": 10}},
+     "sinks": {"name": {"interval": 10}},
+     "links": [{"from": "name", "from_address": "0x4f", "to": "name", "to_address": "0x4f", "capacity": 1, "latency": 0,
+                "from_status_address": "0x4e", "to_status_address": "0x4e", "name": "link name"}]}
+    Programs are read from their machine code files, as written by the assembler. Only "program", "values" and the link ends are required.
+    '''
+    with open(path, 'r') as input_file:
+        description = json.load(input_file)
+    network = Network()
+    for name, cpu in description.get("cpus", {}).items():
+        machine_code = read_machine_code_file(get_machine_code_path(cpu["program"]))
+        network.add_cpu(name, machine_code, cpu.get("cycle_time", 1), cpu.get("page_load_time", 0), cpu.get("registers"), cpu.get("memory"))
+    for name, source in description.get("sources", {}).items():
+        network.add_source(name, source["values"], source.get("interval", 1))
+    for name, sink in description.get("sinks", {}).items():
+        network.add_sink(name, sink.get("interval", 1))
+    for link in description.get("links", []):
+        network.connect(link["from"], link["to"], parse_address(link.get("from_address")), parse_address(link.get("to_address")),
+                        link.get("capacity", 1), link.get("latency", 0), parse_address(link.get("from_status_address")),
+                        parse_address(link.get("to_status_address")), link.get("name"))
+    return network
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulates CPUs and I/O devices connected through memory mapped ports, "
+                                     "printing the throughput, stall time and queue depth of each link.")
+    parser.add_argument("network", help="JSON file describing the CPUs, devices and links")
+    parser.add_argument("--max-time", type=float, default=None, help="time at which to stop the simulation")
+    parser.add_argument("--max-cycles", type=int, default=DEFAULT_MAX_CYCLES, help="instructions each CPU may execute")
+    parser.add_argument("--workers", type=int, default=1, help="processes to run unlinked parts of the network in")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the final state of each CPU and the values each sink took")
+    args = parser.parse_args()
+
+    report = simulate(read_network_file(args.network), args.max_time, args.max_cycles, args.workers)
+    print(report)
+    if args.verbose:
+        for name, cpu_report in report.cpus.items():
+            print(f"\n{name}:\n{cpu_report.result}")
+        for name, device_report in report.devices.items():
+            if device_report.values is not None:
+                print(f"\n{name} took: {device_report.values}")
@@ -0,0 +1,144 @@
+import os
+import struct
+
+from assembler import ASSEMBLER_VERSION, OPCODES, REGISTER_OPERAND, AssemblerOptions, assemble, parse_source
+from build_cache import BuildCache, hash_key
+from machine_code_format import decode_instructions, decode_symbol_table, encode_instructions, encode_symbol_table
+
+'''Relocatable object files, which hold a module of a program assembled on its own so that it can be linked with others (see linker).
+A module is assembled as if it starts at instruction cycle 0. Its branches may go to labels that other modules declare, and the
+addresses of all of the labels it branches to are loaded by LDIs at its start, which the linker sets once it knows where each
+module is placed. The file is laid out like a binary machine code file (see machine_code_format):
+- header: the magic bytes MCPO, the format version, the number of instructions, symbols and relocations, and a mask of the
+  registers the source names (bit x for Rx)
+- the instructions, 2 bytes each
+- the symbol table: the labels the module declares, with their instruction cycles
+- the relocation table: for each LDI of a label address, its instruction cycle and the label, in the same form as the symbol table
+The registers the source names are how modules pass values to each other. Any other register the module uses holds one of its
+constants, label addresses or macro scratch values, and is private to it, so the linker can give it another register.
+'''
+
+MAGIC = b"MCPO"
+FORMAT_VERSION = 1
+HEADER = struct.Struct(">4sBHHHH")
+OBJECT_EXTENSION = ".obj"
+OBJECT_DIRECTORY = "programs/objects"
+
+REGISTER_PARTS = {
+    OPCODES["ADD"]: (1, 2, 3),
+    OPCODES["SUB"]: (1, 2, 3),
+    OPCODES["NOT"]: (1, 2),
+    OPCODES["AND"]: (1, 2, 3),
+    OPCODES["OR"]: (1, 2, 3),
+    OPCODES["LS"]: (1, 2),
+    OPCODES["RS"]: (1, 2),
+    OPCODES["LD"]: (1, 2),
+    OPCODES["LDI"]: (1,),
+    OPCODES["STR"]: (1, 2),
+    OPCODES["BRE"]: (1, 2, 3),
+    OPCODES["BRLT"]: (1, 2, 3),
+}
+'''Dict of opcode : indexes of the parts of a machine code instruction that are register numbers.'''
+
+class ObjectFile:
+    '''ObjectFile : Class
+    A module assembled on its own, with the labels it declares and the LDIs the linker has to set.
+
+    Attributes:
+    instructions:list -- machine code instructions, each a list of 4 integers, as if the module starts at instruction cycle 0
+    symbols:dict -- labels the module declares and their instruction cycle numbers
+    relocations:list -- (instruction cycle, label) of each LDI of a label address
+    public_registers:list -- numbers of the registers the source names, which hold the values passed between modules
+    '''
+    def __init__(self, instructions:list, symbols:dict, relocations:list, public_registers:list):
+        self.instructions = instructions
+        self.symbols = symbols
+        self.relocations = relocations
+        self.public_registers = public_registers
+
+    def get_used_registers(self) -> set:
+        '''Returns the numbers of every register the machine code uses.'''
+        return {instruction[part] for instruction in self.instructions for part in REGISTER_PARTS[instruction[0]] if instruction[part] != 0}
+
+    def get_private_registers(self) -> list:
+        '''Returns the numbers of the registers the module uses that the source doesn't name, in order.'''
+        return sorted(self.get_used_registers() - set(self.public_registers))
+
+    def get_external_labels(self) -> list:
+        '''Returns the labels the module branches to that other modules declare, in the order they are first loaded.'''
+        return list(dict.fromkeys(label for instr_cycle, label in self.relocations if label not in self.symbols))
+
+def get_source_registers(source:str) -> list:
+    '''Returns the numbers of the registers named in the text of a program, in order.'''
+    registers = set()
+    for instruction in parse_source(source):
+        registers.update(value for kind, value in zip(instruction.kinds, instruction.values) if kind == REGISTER_OPERAND)
+    return sorted(registers)
+
+def assemble_object(source:str, options:AssemblerOptions=None) -> ObjectFile:
+    '''Assembles the text of a module into an ObjectFile.'''
+    machine_code = assemble(source, options, module=True)
+    return ObjectFile(machine_code.instructions, machine_code.branch_labels, machine_code.relocations, get_source_registers(source))
+
+def encode_object(object_file:ObjectFile) -> bytes:
+    '''Returns the contents of an object file.'''
+    if len(object_file.instructions) > 0xFFFF:
+        raise Exception("Module is too large for the object file format.")
+    register_mask = sum(1 << register for register in object_file.public_registers)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(object_file.instructions), len(object_file.symbols), len(object_file.relocations), register_mask)
+    return (header + encode_instructions(object_file.instructions) + encode_symbol_table(object_file.symbols.items())
+            + encode_symbol_table((label, instr_cycle) for instr_cycle, label in object_file.relocations))
+
+def decode_object(data:bytes, path:str="object file") -> ObjectFile:
+    '''Reads the contents of an object file, naming it path in any exception.'''
+    if len(data) < HEADER.size:
+        raise Exception(f"{path} is too short to be an object file.")
+    magic, version, instruction_count, symbol_count, relocation_count, register_mask = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise Exception(f"{path} is not an object file.")
+    if version != FORMAT_VERSION:
+        raise Exception(f"{path} has format version {version}, only version {FORMAT_VERSION} can be read.")
+    code_end = HEADER.size + 2*instruction_count
+    if len(data) < code_end:
+        raise Exception(f"{path} is shorter than its header says.")
+    instructions = decode_instructions(data[HEADER.size:code_end])
+    symbols, offset = decode_symbol_table(data, code_end, symbol_count)
+    relocations, offset = decode_symbol_table(data, offset, relocation_count)
+    public_registers = [register for register in range(16) if register_mask >> register & 1]
+    return ObjectFile(instructions, dict(symbols), [(instr_cycle, label) for label, instr_cycle in relocations], public_registers)
+
+def write_object_file(path:str, object_file:ObjectFile) -> None:
+    with open(path, 'wb') as output_file:
+        output_file.write(encode_object(object_file))
+
+def read_object_file(path:str) -> ObjectFile:
+    with open(path, 'rb') as input_file:
+        return decode_object(input_file.read(), path)
+
+def get_object_path(name:str) -> str:
+    '''Returns the path of the object file for the module programs/<name>.txt.'''
+    return os.path.join(OBJECT_DIRECTORY, name + OBJECT_EXTENSION)
+
+def get_object_cache_key(source:str, options:AssemblerOptions) -> str:
+    '''Returns the build cache key for assembling source into an object file with the given options.'''
+    return hash_key("object", ASSEMBLER_VERSION, FORMAT_VERSION, options.cache_parts(), source)
+
+def assemble_module(name:str, options:AssemblerOptions=None, cache:BuildCache=None, force:bool=False) -> tuple:
+    '''Assembles the module programs/<name>.txt into its object file, unless a cache is given and the object file is up to date
+    (and force is False), updating the cache but not saving it. Returns (ObjectFile, True if it was assembled).
+    '''
+    if options is None:
+        options = AssemblerOptions()
+    with open("programs/" + name + ".txt", 'r') as input_file:
+        source = input_file.read()
+    path = get_object_path(name)
+    cache_key = get_object_cache_key(source, options)
+    if cache is not None and not force and cache.is_current(path, cache_key, path):
+        return read_object_file(path), False
+
+    object_file = assemble_object(source, options)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_object_file(path, object_file)
+    if cache is not None:
+        cache.update(path, cache_key)
+    return object_file, True
@@ -0,0 +1,220 @@
+import contextlib
+import itertools
+import json
+import time
+
+'''Optional instrumentation for the assembler passes, enabled by passing a PassProfiler to assemble() or convert_syntax(),
+or with --profile on the command line. For each pass it records:
+- the wall time it took
+- the number of instructions before and after, and how many were inserted and removed
+- the number of opcodes and operands it rewrote, and how many of those operands were label names replaced by registers
+- the number of unused registers it gave a value to
+Passes are grouped by the function that runs them (assemble, convert_syntax, convert_to_machine_code), and the results can be written as
+JSON, as a Chrome trace (chrome://tracing, Perfetto or speedscope), or as folded stacks for flamegraph.pl.
+
+The instructions are copied before each pass so that they can be compared afterwards; the copying isn't included in the times.
+Instructions are matched up on the assumption that passes only add instructions to the beginning, or remove instructions without
+changing the rest. For passes that do anything else (such as the layout and peephole passes), only the number of instructions is recorded.
+'''
+
+PROFILE_FORMATS = ["json", "chrome", "folded"]
+
+class PassStats:
+    '''PassStats : Class
+
+    Attributes:
+    name:str -- name of the pass
+    stack:list -- names of the groups the pass was run in, outermost first
+    start:float -- seconds from the start of profiling to the start of the pass
+    seconds:float -- wall time of the pass
+    instructions_before:int -- number of instructions before the pass
+    instructions_after:int -- number of instructions after the pass
+    instructions_inserted:int -- number of instructions added by the pass
+    instructions_removed:int -- number of instructions removed by the pass
+    opcodes_rewritten:int -- number of instructions whose opcode was changed, None if the instructions couldn't be matched up
+    operands_rewritten:int -- number of operands changed, added or removed, None if the instructions couldn't be matched up
+    labels_resolved:int -- number of the rewritten operands that were label names
+    registers_consumed:int -- number of registers taken from the assembler's unused registers
+    '''
+    def __init__(self, name:str, stack:list, start:float):
+        self.name = name
+        self.stack = stack
+        self.start = start
+        self.seconds = 0.0
+        self.instructions_before = 0
+        self.instructions_after = 0
+        self.instructions_inserted = 0
+        self.instructions_removed = 0
+        self.opcodes_rewritten = None
+        self.operands_rewritten = None
+        self.labels_resolved = None
+        self.registers_consumed = 0
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+class GroupStats:
+    '''GroupStats : Class
+
+    Attributes:
+    name:str -- name of the group of passes
+    stack:list -- names of the groups it was run in, outermost first
+    start:float -- seconds from the start of profiling to the start of the group
+    seconds:float -- wall time of the group, including anything run in it that isn't a pass
+    '''
+    def __init__(self, name:str, stack:list, start:float):
+        self.name = name
+        self.stack = stack
+        self.start = start
+        self.seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+def get_parts(instruction) -> list:
+    '''Returns an Instruction, or an instruction already converted to machine code, as a list of its parts.'''
+    return list(instruction) if isinstance(instruction, list) else instruction.to_parts()
+
+def strip_label(instruction:list) -> list:
+    '''Returns the parts of an instruction without the label declared at it.'''
+    return instruction[1:] if isinstance(instruction[0], str) and instruction[0][-1:] == ":" else instruction
+
+def match_instructions(before:list, after:list) -> list:
+    '''Returns list of (instruction before, instruction after) pairs for the instructions kept by a pass, or None if they can't be matched up.
+    Instructions added to the beginning are skipped. If instructions were removed, the rest must be unchanged.
+    '''
+    if len(after) >= len(before):
+        return list(zip(before, after[len(after) - len(before):]))
+    pairs = []
+    after_index = 0
+    for instruction in before:
+        if after_index < len(after) and after[after_index] == instruction:
+            pairs.append((instruction, after[after_index]))
+            after_index += 1
+    return pairs if after_index == len(after) else None
+
+class PassProfiler:
+    '''PassProfiler : Class
+    Records the statistics of assembler passes. Pass one to assemble() or convert_syntax(), then write or print the results.
+
+    Attributes:
+    passes:list -- PassStats of each pass, in the order they were run
+    groups:list -- GroupStats of each group, in the order they finished
+    stack:list -- names of the groups currently running, outermost first
+    start_time:float -- perf_counter() time the profiler was created
+    '''
+    def __init__(self):
+        self.passes = []
+        self.groups = []
+        self.stack = []
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def group(self, name:str):
+        '''Context manager that records the passes run in it as part of the group name.'''
+        stats = GroupStats(name, list(self.stack), time.perf_counter() - self.start_time)
+        self.stack.append(name)
+        try:
+            yield stats
+        finally:
+            self.stack.pop()
+            stats.seconds = time.perf_counter() - self.start_time - stats.start
+            self.groups.append(stats)
+
+    def run_pass(self, function, instructions:list, name:str=None, assembler=None):
+        '''Runs function(instructions), recording its statistics. assembler is the Assembler the pass belongs to, if any,
+        for counting the labels and registers it uses. Returns what the function returns.
+        '''
+        before = [get_parts(instruction) for instruction in instructions]
+        unused_before = len(assembler.unused_registers) if assembler is not None else 0
+        stats = PassStats(name or function.__name__, list(self.stack), 0.0)
+
+        start = time.perf_counter()
+        result = function(instructions)
+        stats.seconds = time.perf_counter() - start
+        stats.start = start - self.start_time
+
+        stats.instructions_before = len(before)
+        stats.instructions_after = len(instructions)
+        stats.instructions_inserted = max(len(instructions) - len(before), 0)
+        stats.instructions_removed = max(len(before) - len(instructions), 0)
+        if assembler is not None:
+            stats.registers_consumed = unused_before - len(assembler.unused_registers)
+
+        pairs = match_instructions(before, [get_parts(instruction) for instruction in instructions])
+        if pairs is not None:
+            labels = assembler.int_branch_labels if assembler is not None else {}
+            stats.opcodes_rewritten = 0
+            stats.operands_rewritten = 0
+            stats.labels_resolved = 0
+            for instruction_before, instruction_after in pairs:
+                instruction_before = strip_label(instruction_before)
+                instruction_after = strip_label(instruction_after)
+                if instruction_before[:1] != instruction_after[:1]:
+                    stats.opcodes_rewritten += 1
+                for operand_before, operand_after in itertools.zip_longest(instruction_before[1:], instruction_after[1:]):
+                    if operand_before != operand_after:
+                        stats.operands_rewritten += 1
+                        if operand_before in labels:
+                            stats.labels_resolved += 1
+        self.passes.append(stats)
+        return result
+
+    def total_seconds(self) -> float:
+        '''Returns the total time of the passes.'''
+        return sum(stats.seconds for stats in self.passes)
+
+    def to_json(self) -> dict:
+        return {
+            "total_pass_seconds": self.total_seconds(),
+            "passes": [stats.to_dict() for stats in self.passes],
+            "groups": [stats.to_dict() for stats in self.groups],
+        }
+
+    def to_chrome_trace(self) -> dict:
+        '''Returns the passes and groups as complete events in the Chrome trace event format, with times in microseconds.'''
+        events = []
+        for stats in sorted(self.groups + self.passes, key=lambda stats: (stats.start, len(stats.stack))):
+            event = {"name": stats.name, "ph": "X", "pid": 0, "tid": 0, "ts": stats.start * 1e6, "dur": stats.seconds * 1e6}
+            if isinstance(stats, PassStats):
+                event["args"] = {key: value for key, value in stats.to_dict().items() if key not in ("name", "stack", "start", "seconds")}
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_folded(self) -> str:
+        '''Returns the passes as folded stacks ("group;pass microseconds" lines), the input format of flamegraph.pl.
+        Time spent in a group outside of its passes is given to the group itself.
+        '''
+        self_times = {}
+        for stats in self.passes + self.groups:
+            stack = ";".join(stats.stack + [stats.name])
+            self_times[stack] = self_times.get(stack, 0.0) + stats.seconds
+            if len(stats.stack) > 0:
+                parent = ";".join(stats.stack)
+                self_times[parent] = self_times.get(parent, 0.0) - stats.seconds
+        return "\n".join(f"{stack} {max(round(seconds * 1e6), 0)}" for stack, seconds in self_times.items())
+
+    def write(self, path:str, profile_format:str="json") -> None:
+        '''Writes the results to path in one of PROFILE_FORMATS.'''
+        if profile_format not in PROFILE_FORMATS:
+            raise Exception(f"Profile format must be one of {PROFILE_FORMATS}.")
+        with open(path, 'w') as output_file:
+            if profile_format == "json":
+                json.dump(self.to_json(), output_file, indent=1)
+            elif profile_format == "chrome":
+                json.dump(self.to_chrome_trace(), output_file)
+            else:
+                output_file.write(self.to_folded() + "\n")
+
+    def __str__(self):
+        lines = [f"{'pass':<32} {'ms':>9} {'%':>6} {'instrs':>7} {'+':>5} {'-':>5} {'operands':>8} {'labels':>6} {'regs':>4}"]
+        total = self.total_seconds()
+        for stats in self.passes:
+            name = "  " * len(stats.stack) + stats.name
+            operands = stats.operands_rewritten if stats.operands_rewritten is not None else "-"
+            labels = stats.labels_resolved if stats.labels_resolved is not None else "-"
+            share = stats.seconds / total * 100 if total > 0 else 0
+            lines.append(f"{name:<32} {stats.seconds*1000:>9.3f} {share:>6.1f} {stats.instructions_after:>7} {stats.instructions_inserted:>5} "
+                         f"{stats.instructions_removed:>5} {operands:>8} {labels:>6} {stats.registers_consumed:>4}")
+        lines.append(f"{'total':<32} {total*1000:>9.3f}")
+        return "\n".join(lines)
@@ -0,0 +1,332 @@
+from assembler import MACRO_OPCODES, Instruction, convert_cycle_to_instruction_cell_int, get_opcode_str, get_operand_value, get_operands
+from constant_analysis import evaluate, evaluate_branch, find_constant_values, run_forward_dataflow
+from layout_optimizer import find_label_registers, simulate
+from register_allocator import WRITE_BACK_OPCODES, get_reads_and_writes, is_branch, is_conditional_branch
+
+'''Optional assembler pass that removes redundant instructions from a converted program, run after convert_syntax().
+Like the layout pass, it relocates the LDIs of label addresses, so instructions can be removed without re-assembling the program.
+The passes below are repeated until none of them changes anything:
+- constant folding: an instruction whose operands hold known values becomes an LDI of the result (so LDI/ADD chains collapse),
+  and is removed if the register already holds that value. Branches with a known outcome become unconditional or are removed.
+- copy propagation: after a move such as ADD Rx, Ry, #0, later reads of Rx read Ry instead, so the move can become dead.
+- dead store elimination: instructions whose result is never read are removed.
+- redundant branch removal: branches to the next instruction, and instructions that can never run, are removed.
+
+Optimization levels:
+1 -- the final values of the registers the source program writes to are kept, as well as the data memory.
+2 -- only the data memory is kept, so every register is treated as scratch space.
+'''
+
+OPTIMIZATION_LEVELS = [0, 1, 2]
+
+class OptimizationReport:
+    '''OptimizationReport : Class
+
+    Attributes:
+    level:int -- optimization level the pass was run at
+    instructions_before:int, instructions_after:int -- program length before and after the pass
+    constants_folded:int -- instructions replaced by an LDI, or removed because the register already held the value
+    copies_propagated:int -- register reads replaced by the register they were copied from
+    dead_instructions_removed:int -- instructions removed because their result is never read
+    branches_removed:int -- branches removed or made unconditional, and unreachable instructions removed
+    cycles_before:int, cycles_after:int -- instructions executed before and after the pass, None if the program couldn't be simulated
+    message:str -- why the program was left unchanged or couldn't be simulated, if it was
+    '''
+    def __init__(self, level:int, instructions_before:int=0):
+        self.level = level
+        self.instructions_before = instructions_before
+        self.instructions_after = instructions_before
+        self.constants_folded = 0
+        self.copies_propagated = 0
+        self.dead_instructions_removed = 0
+        self.branches_removed = 0
+        self.cycles_before = None
+        self.cycles_after = None
+        self.message = ""
+
+    def __str__(self):
+        removed = self.instructions_before - self.instructions_after
+        report = (f"Optimization level {self.level}: instructions: {self.instructions_before} -> {self.instructions_after} ({removed} removed), "
+                  f"constants folded: {self.constants_folded}, copies propagated: {self.copies_propagated}, "
+                  f"dead instructions removed: {self.dead_instructions_removed}, branches removed: {self.branches_removed}")
+        if self.cycles_before is not None:
+            report = report + f"\nCycles: {self.cycles_before} -> {self.cycles_after} ({self.cycles_before - self.cycles_after} saved)"
+        if self.message:
+            report = report + f"\n{self.message}"
+        return report
+
+def find_result_registers(instructions:list) -> set:
+    '''Returns the numbers of the registers written to by a program in source form (as returned by parse_source).'''
+    registers = set()
+    for instruction in instructions:
+        if instruction.is_comment():
+            continue
+        if get_opcode_str(instruction) in WRITE_BACK_OPCODES or get_opcode_str(instruction) in MACRO_OPCODES:
+            registers.add(get_operand_value(get_operands(instruction)[0]))
+    return registers
+
+def get_copy_source(instruction:list, values:dict):
+    '''Returns the register an instruction copies into its destination unchanged, or None if it isn't a move.'''
+    opcode_str = get_opcode_str(instruction)
+    operands = get_operands(instruction)
+    if opcode_str not in ("ADD", "SUB", "AND", "OR"):
+        return None
+    first, second = operands[1], operands[2]
+    if opcode_str in ("AND", "OR") and first == second:
+        return first
+    if opcode_str in ("ADD", "SUB", "OR") and values.get(second) == 0:
+        return first
+    if opcode_str in ("ADD", "OR") and values.get(first) == 0:
+        return second
+    return None
+
+class Program:
+    '''Program : Class
+    A converted program whose label LDIs hold label names, so that instructions can be removed.
+
+    Attributes:
+    instructions:list -- instructions in correct syntax, with label LDIs in the form LDI Rx, label
+    labels:list -- for each instruction, the list of labels declared at it
+    label_registers:dict -- register operand (e.g. "R12") : label whose address it holds
+    input_registers:set -- numbers of the registers whose starting values are given when the program is run, rather than 0
+    '''
+    def __init__(self, instructions:list, branch_labels:dict, input_registers=()):
+        self.input_registers = set(input_registers)
+        label_registers = find_label_registers(instructions, branch_labels)
+        self.label_registers = {f"R{register}": label for register, label in label_registers.items()}
+        self.instructions = [instruction.copy() for instruction in instructions]
+        self.labels = [[] for instruction in instructions]
+        for label, instr_cycle in branch_labels.items():
+            if instr_cycle >= len(instructions):
+                raise Exception(f"Label {label} is past the end of the program.")
+            self.labels[instr_cycle].append(label)
+        for instruction in self.instructions:
+            if get_opcode_str(instruction) == "LDI" and instruction.operands[0] in self.label_registers:
+                instruction.set_operand(1, self.label_registers[instruction.operands[0]])
+
+    def get_successors(self) -> list:
+        '''Returns, for each instruction, the list of instruction indexes that can run after it.'''
+        label_positions = {}
+        for instruction_index, labels in enumerate(self.labels):
+            for label in labels:
+                label_positions[label] = instruction_index
+        successors = []
+        for instruction_index, instruction in enumerate(self.instructions):
+            following = []
+            if is_branch(instruction):
+                following.append(label_positions[self.label_registers[get_operands(instruction)[0]]])
+                if is_conditional_branch(instruction):
+                    following.append(instruction_index + 1)
+            else:
+                following.append(instruction_index + 1)
+            successors.append(following)
+        return successors
+
+    def can_remove(self, instruction_index:int) -> bool:
+        '''Returns True if the instruction can be removed. Labels declared at a removed instruction move to the next one,
+        so the last instruction is always kept for them to move to.
+        '''
+        return instruction_index + 1 < len(self.instructions)
+
+    def remove(self, removed_indexes:set) -> None:
+        '''Removes the instructions at the given indexes, moving their labels to the next instruction that is kept.'''
+        instructions = []
+        labels = []
+        carried_labels = []
+        for instruction_index, instruction in enumerate(self.instructions):
+            carried_labels = carried_labels + self.labels[instruction_index]
+            if instruction_index not in removed_indexes:
+                instructions.append(instruction)
+                labels.append(carried_labels)
+                carried_labels = []
+        self.instructions = instructions
+        self.labels = labels
+
+    def emit(self) -> tuple:
+        '''Returns (instructions with label addresses relocated, dict of label : instruction cycle).'''
+        label_cycles = {}
+        for instruction_index, labels in enumerate(self.labels):
+            for label in labels:
+                label_cycles[label] = instruction_index
+        instructions = [instruction.copy() for instruction in self.instructions]
+        for instruction in instructions:
+            if get_opcode_str(instruction) == "LDI" and instruction.operands[1] in label_cycles:
+                instruction.set_operand(1, f"#{convert_cycle_to_instruction_cell_int(label_cycles[instruction.operands[1]])}")
+        return instructions, label_cycles
+
+def fold_constants(program:Program, report:OptimizationReport) -> bool:
+    '''Folds instructions with known operands, and branches with a known outcome. Removes unreachable instructions.
+    Returns True if the program was changed.
+    '''
+    successors = program.get_successors()
+    values = find_constant_values(program.instructions, successors, program.input_registers)
+    changed = False
+    removed_indexes = set()
+    for instruction_index, instruction in enumerate(program.instructions):
+        state = values[instruction_index]
+        if state is None:
+            if program.can_remove(instruction_index):
+                removed_indexes.add(instruction_index)
+                report.branches_removed += 1
+            continue
+        opcode_str = get_opcode_str(instruction)
+        if is_conditional_branch(instruction):
+            taken = evaluate_branch(instruction, state)
+            if taken is False and program.can_remove(instruction_index):
+                removed_indexes.add(instruction_index)
+                report.branches_removed += 1
+            elif taken is True:
+                target = get_operands(instruction)[0]
+                program.instructions[instruction_index] = Instruction("BRE", (target, target, target), line=instruction.line)
+                report.branches_removed += 1
+                changed = True
+            continue
+        reads, writes = get_reads_and_writes(instruction)
+        if len(writes) == 0:
+            continue
+        value = evaluate(instruction, state)
+        if value is None:
+            continue
+        if state.get(writes[0]) == value and program.can_remove(instruction_index):
+            removed_indexes.add(instruction_index)
+            report.constants_folded += 1
+        elif opcode_str != "LDI":
+            program.instructions[instruction_index] = Instruction("LDI", (writes[0], f"#{value}"), line=instruction.line)
+            report.constants_folded += 1
+            changed = True
+    program.remove(removed_indexes)
+    return changed or len(removed_indexes) > 0
+
+def propagate_copies(program:Program, report:OptimizationReport) -> bool:
+    '''Replaces reads of registers that were copied from another register with reads of the original,
+    and removes moves of a register into itself. Returns True if the program was changed.
+    '''
+    successors = program.get_successors()
+    values = find_constant_values(program.instructions, successors, program.input_registers)
+
+    def transfer(instruction_index:int, state:dict) -> dict:
+        instruction = program.instructions[instruction_index]
+        reads, writes = get_reads_and_writes(instruction)
+        if len(writes) == 0:
+            return state
+        written = writes[0]
+        state_after = {copy: source for copy, source in state.items() if copy != written and source != written}
+        source = get_copy_source(instruction, values[instruction_index] or {})
+        if source is not None and source != written:
+            state_after[written] = source
+        return state_after
+
+    copies = run_forward_dataflow(len(program.instructions), successors, {}, transfer)
+    changed = False
+    removed_indexes = set()
+    for instruction_index, instruction in enumerate(program.instructions):
+        state = copies[instruction_index]
+        if state is None:
+            continue
+        #the destination of a write-back instruction and the target of a branch are left alone
+        first_read = 1 if get_opcode_str(instruction) in WRITE_BACK_OPCODES or is_branch(instruction) else 0
+        if get_opcode_str(instruction) != "LDI":
+            for operand_index in range(first_read, len(instruction.operands)):
+                if instruction.operands[operand_index] in state:
+                    instruction.set_operand(operand_index, state[instruction.operands[operand_index]])
+                    report.copies_propagated += 1
+                    changed = True
+        reads, writes = get_reads_and_writes(instruction)
+        if len(writes) > 0 and get_copy_source(instruction, values[instruction_index]) == writes[0] and program.can_remove(instruction_index):
+            removed_indexes.add(instruction_index)
+            report.dead_instructions_removed += 1
+    program.remove(removed_indexes)
+    return changed or len(removed_indexes) > 0
+
+def remove_dead_instructions(program:Program, exit_live:set, report:OptimizationReport) -> bool:
+    '''Removes instructions whose result is never read, given the set of register operands that are read after the program ends.
+    Returns True if the program was changed.
+    '''
+    successors = program.get_successors()
+    reads_and_writes = [get_reads_and_writes(instruction) for instruction in program.instructions]
+    live_in = [set() for instruction in program.instructions] + [set(exit_live)]
+    live_out = [set() for instruction in program.instructions]
+    changed = True
+    while changed:
+        changed = False
+        for instruction_index in range(len(program.instructions) - 1, -1, -1):
+            out = set()
+            for following in successors[instruction_index]:
+                out |= live_in[following]
+            reads, writes = reads_and_writes[instruction_index]
+            new_in = (out - set(writes)) | set(reads)
+            if out != live_out[instruction_index] or new_in != live_in[instruction_index]:
+                live_out[instruction_index] = out
+                live_in[instruction_index] = new_in
+                changed = True
+
+    removed_indexes = set()
+    for instruction_index, (reads, writes) in enumerate(reads_and_writes):
+        if len(writes) > 0 and writes[0] not in live_out[instruction_index] and program.can_remove(instruction_index):
+            removed_indexes.add(instruction_index)
+    report.dead_instructions_removed += len(removed_indexes)
+    program.remove(removed_indexes)
+    return len(removed_indexes) > 0
+
+def remove_redundant_branches(program:Program, report:OptimizationReport) -> bool:
+    '''Removes branches to the instruction straight after them. Returns True if the program was changed.'''
+    successors = program.get_successors()
+    removed_indexes = set()
+    for instruction_index, instruction in enumerate(program.instructions):
+        if is_branch(instruction) and successors[instruction_index][0] == instruction_index + 1 and program.can_remove(instruction_index):
+            removed_indexes.add(instruction_index)
+    report.branches_removed += len(removed_indexes)
+    program.remove(removed_indexes)
+    return len(removed_indexes) > 0
+
+def has_same_results(result, original_result, result_registers:set) -> bool:
+    '''Returns True if both simulation results have the same memory and the same values in result_registers.'''
+    if result.memory != original_result.memory:
+        return False
+    return all(result.register(register) == original_result.register(register) for register in result_registers)
+
+def optimize_program(instructions:list, branch_labels:dict, level:int, result_registers:set, input_registers=()) -> OptimizationReport:
+    '''Removes redundant instructions from a program (after convert_syntax), at the given optimization level.
+    result_registers are the registers whose final values are kept at level 1 (see find_result_registers),
+    and nothing is assumed about the starting values of input_registers.
+    Modifies instructions and branch_labels (label : instruction cycle) in place, and returns an OptimizationReport.
+    The program is left unchanged if its branch targets can't be relocated.
+    '''
+    if level not in OPTIMIZATION_LEVELS:
+        raise Exception(f"Optimization level must be one of {OPTIMIZATION_LEVELS}.")
+    report = OptimizationReport(level, instructions_before=len(instructions))
+    if level == 0:
+        return report
+    try:
+        program = Program(instructions, branch_labels, input_registers)
+    except Exception as e:
+        report.message = f"Program unchanged: {e}"
+        return report
+
+    kept_registers = set(result_registers) if level == 1 else set()
+    exit_live = {f"R{register}" for register in kept_registers} - set(program.label_registers.keys())
+    changed = True
+    while changed:
+        changed = fold_constants(program, report)
+        changed = propagate_copies(program, report) or changed
+        changed = remove_dead_instructions(program, exit_live, report) or changed
+        changed = remove_redundant_branches(program, report) or changed
+    optimized_instructions, label_cycles = program.emit()
+
+    try:
+        original_result = simulate(instructions)
+        result = simulate(optimized_instructions)
+    except Exception as e:
+        report.message = f"Cycles not estimated: {e}"
+    else:
+        if not has_same_results(result, original_result, kept_registers):
+            report.message = "Program unchanged: the optimized program gave different results."
+            return report
+        report.cycles_before = original_result.cycles
+        report.cycles_after = result.cycles
+
+    instructions[:] = optimized_instructions
+    branch_labels.clear()
+    branch_labels.update(label_cycles)
+    report.instructions_after = len(instructions)
+    return report
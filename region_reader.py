@@ -0,0 +1,272 @@
+import argparse
+import mmap
+import os
+import sys
+import time
+
+from region_writer import (LOCATION, SECTOR_SIZE, decode_stored_chunk, get_chunk_index, get_region_coordinates,
+                           get_region_path, unpack_block_states)
+from schematic_generator import (BARREL, DEFAULT_BLOCK_SPACING, INSTRUCTION_COLUMN_POSITIONS, SIGNAL_STRENGTH_LOWER_BOUNDS,
+                                 read_file_into_list, split_into_blocks)
+from simulator import DATA_MEMORY_CELLS, data_cell_to_address, run
+
+'''Reads the programs and data memory stored in a world save, to check a run without looking at the barrels and lamps in the game.
+Region files are mapped into memory, and the table at the start of each file is used to find and decompress only the chunks
+that are read, each at most once. The blocks of secondary storage are read from the barrels where region_writer.py
+(and the combined schematic) puts them, and each barrel's contents are turned back into a signal strength using SIGNAL_STRENGTH_LOWER_BOUNDS.
+The data memory cells are read from redstone lamps, one per bit with the most significant bit at the start of the cell:
+as the layout depends on the build, the position of the first lamp and the steps between bits, cells and rows of 15 cells are given on the command line.
+
+Given the name of a program, the blocks read are compared with its machine code, and the data memory with the memory the simulator
+finishes the program with, and each difference is printed.
+'''
+
+REDSTONE_LAMP = "minecraft:redstone_lamp"
+BITS_PER_CELL = 8
+CELLS_PER_ROW = 15
+
+def get_signal_strength(block_entity:dict) -> int:
+    '''Returns the signal strength a comparator reads from a barrel block entity: the highest strength whose lower bound
+    the number of items reaches. Returns None if the block entity isn't a barrel.
+    '''
+    if block_entity is None or block_entity["id"][1] != BARREL:
+        return None
+    item_count = sum(item["Count"][1] for item in block_entity.get("Items", (0, (0, [])))[1][1])
+    return max(signal_strength for signal_strength, lower_bound in SIGNAL_STRENGTH_LOWER_BOUNDS.items() if item_count >= lower_bound)
+
+class RegionReader:
+    '''RegionReader : Class
+    A region file mapped into memory for reading chunks. Use as a context manager, or call close() when finished with it.
+
+    Attributes:
+    path:str -- file that is mapped
+    view:memoryview -- the mapped file
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as input_file:
+            if os.path.getsize(path) < 2 * SECTOR_SIZE:
+                raise Exception(f"{path} is too short to be a region file.")
+            self.mapping = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+
+    def read_chunk(self, chunk_index:int) -> dict:
+        '''Returns the decoded NBT of a chunk, or None if it hasn't been generated.'''
+        location = LOCATION.unpack_from(self.view, chunk_index * 4)[0]
+        first_sector, sector_count = location >> 8, location & 0xFF
+        if sector_count == 0:
+            return None
+        stored = self.view[first_sector * SECTOR_SIZE:(first_sector + sector_count) * SECTOR_SIZE]
+        try:
+            return decode_stored_chunk(stored, f"Chunk {chunk_index} of {self.path}")
+        finally:
+            stored.release()
+
+    def close(self) -> None:
+        self.view.release()
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ChunkBlocks:
+    '''ChunkBlocks : Class
+    The blocks and block entities of a decoded chunk, indexed by position.
+
+    Attributes:
+    sections:dict -- section y : block_states compound of the section
+    block_indexes:dict -- section y : palette index of each block of the section, unpacked when a block of it is first read
+    block_entities:dict -- (x, y, z) world position : block entity compound
+    '''
+    def __init__(self, chunk:dict):
+        self.sections = {section["Y"][1]: section["block_states"][1] for section in chunk["sections"][1][1] if "block_states" in section}
+        self.block_indexes = {}
+        self.block_entities = {(block_entity["x"][1], block_entity["y"][1], block_entity["z"][1]): block_entity
+                               for block_entity in chunk.get("block_entities", (0, (0, [])))[1][1]}
+
+    def get_block_state(self, position:tuple) -> dict:
+        '''Returns the block state compound ({"Name": ..., "Properties": ...}) at a world position, None if it is outside the world.'''
+        x, y, z = position
+        section_y = y >> 4
+        if section_y not in self.sections:
+            return None
+        if section_y not in self.block_indexes:
+            self.block_indexes[section_y] = unpack_block_states(self.sections[section_y])
+        palette = self.sections[section_y]["palette"][1][1]
+        return palette[self.block_indexes[section_y][((y & 15) << 8) | ((z & 15) << 4) | (x & 15)]]
+
+class WorldReader:
+    '''WorldReader : Class
+    Reads blocks from the region files of a world save, mapping each file and decoding each chunk the first time it is needed.
+    Use as a context manager, or call close() when finished with it.
+
+    Attributes:
+    world:str -- world save folder
+    regions:dict -- region file path : RegionReader, None if the file doesn't exist
+    chunks:dict -- (chunk x, chunk z) : ChunkBlocks, None if the chunk hasn't been generated
+    '''
+    def __init__(self, world:str):
+        self.world = world
+        self.regions = {}
+        self.chunks = {}
+
+    def get_chunk(self, chunk_x:int, chunk_z:int) -> ChunkBlocks:
+        if (chunk_x, chunk_z) not in self.chunks:
+            path = get_region_path(self.world, *get_region_coordinates(chunk_x * 16, chunk_z * 16))
+            if path not in self.regions:
+                self.regions[path] = RegionReader(path) if os.path.isfile(path) else None
+            chunk = self.regions[path].read_chunk(get_chunk_index(chunk_x, chunk_z)) if self.regions[path] is not None else None
+            self.chunks[(chunk_x, chunk_z)] = ChunkBlocks(chunk) if chunk is not None else None
+        return self.chunks[(chunk_x, chunk_z)]
+
+    def get_block_state(self, position:tuple) -> dict:
+        '''Returns the block state compound at a world position, None if its chunk hasn't been generated.'''
+        chunk = self.get_chunk(position[0] >> 4, position[2] >> 4)
+        return chunk.get_block_state(position) if chunk is not None else None
+
+    def get_block_entity(self, position:tuple) -> dict:
+        '''Returns the block entity compound at a world position, None if there isn't one.'''
+        chunk = self.get_chunk(position[0] >> 4, position[2] >> 4)
+        return chunk.block_entities.get(position) if chunk is not None else None
+
+    def close(self) -> None:
+        for region_reader in self.regions.values():
+            if region_reader is not None:
+                region_reader.close()
+        self.regions = {}
+        self.chunks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_block(world_reader:WorldReader, origin:tuple, block_number:int, block_spacing:int=DEFAULT_BLOCK_SPACING) -> list:
+    '''Reads a block of secondary storage (numbered from 1) from the barrels placed by region_writer.py.
+    Returns list of 15 instructions, each a list of 4 signal strengths, with None for any barrel that is missing.
+    '''
+    z_offset = (block_number - 1) * block_spacing
+    block = []
+    for positions in INSTRUCTION_COLUMN_POSITIONS:
+        block.append([get_signal_strength(world_reader.get_block_entity((origin[0] + x, origin[1] + y, origin[2] + z + z_offset)))
+                      for x, y, z in positions])
+    return block
+
+def read_program(world_reader:WorldReader, origin:tuple, block_count:int, first_block:int=1, block_spacing:int=DEFAULT_BLOCK_SPACING) -> list:
+    '''Reads block_count blocks of secondary storage, starting at first_block. Returns list of blocks, as returned by read_block().'''
+    return [read_block(world_reader, origin, block_number, block_spacing) for block_number in range(first_block, first_block + block_count)]
+
+def is_lamp_lit(block_state:dict) -> bool:
+    '''Returns True if a block state is a lit redstone lamp, False if it is an unlit one, or None if it isn't a redstone lamp.'''
+    if block_state is None or block_state["Name"][1] != REDSTONE_LAMP:
+        return None
+    return block_state.get("Properties", (0, {}))[1].get("lit", (0, "false"))[1] == "true"
+
+def read_data_memory(world_reader:WorldReader, origin:tuple, bit_step:tuple, cell_step:tuple, row_step:tuple=None) -> list:
+    '''Reads the 60 data memory cells from redstone lamps. origin is the lamp of the most significant bit of address 0x11,
+    bit_step the offset from one bit of a cell to the next, cell_step from one cell to the next, and row_step from the first cell of
+    a row of 15 (0x11, 0x21, ...) to the first of the next, by default the same as continuing the row.
+    Returns list of 60 values, with None for any cell that has a bit without a lamp.
+    '''
+    row_step = row_step if row_step is not None else tuple(step * CELLS_PER_ROW for step in cell_step)
+    memory = []
+    for cell in range(DATA_MEMORY_CELLS):
+        row, column = divmod(cell, CELLS_PER_ROW)
+        cell_origin = [origin[axis] + row * row_step[axis] + column * cell_step[axis] for axis in range(3)]
+        value = 0
+        for bit in range(BITS_PER_CELL):
+            lit = is_lamp_lit(world_reader.get_block_state(tuple(cell_origin[axis] + bit * bit_step[axis] for axis in range(3))))
+            if lit is None:
+                value = None
+                break
+            value = value << 1 | lit
+        memory.append(value)
+    return memory
+
+def find_program_differences(expected_instructions:list, blocks:list, first_block:int=1) -> list:
+    '''Compares blocks read from the world with machine code instructions. Returns a description of each part that differs.
+    Barrels past the end of the program are expected to be missing or empty.
+    '''
+    differences = []
+    expected_blocks = split_into_blocks(expected_instructions)
+    for block_index, block in enumerate(blocks):
+        expected_block = expected_blocks[block_index] if block_index < len(expected_blocks) else []
+        for instruction_index, instruction in enumerate(block):
+            expected = expected_block[instruction_index] if instruction_index < len(expected_block) else None
+            for part_index, found in enumerate(instruction):
+                if expected is None:
+                    if found not in (None, 0):
+                        differences.append(f"Block {first_block + block_index}, instruction {instruction_index + 1}, part {part_index + 1}: "
+                                           f"expected no barrel or an empty one, found {found}")
+                elif found != expected[part_index]:
+                    found_text = "no barrel" if found is None else found
+                    differences.append(f"Block {first_block + block_index}, instruction {instruction_index + 1}, part {part_index + 1}: "
+                                       f"expected {expected[part_index]}, found {found_text}")
+    return differences
+
+def find_memory_differences(expected_memory:list, memory:list) -> list:
+    '''Compares data memory read from the world with the expected values. Returns a description of each cell that differs.'''
+    differences = []
+    for cell, (expected, found) in enumerate(zip(expected_memory, memory)):
+        if expected != found:
+            found_text = "a missing lamp" if found is None else found
+            differences.append(f"Data memory {hex(data_cell_to_address(cell))}: expected {expected}, found {found_text}")
+    return differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reads the programs and data memory stored in a world save and compares them with a program's machine code.")
+    parser.add_argument("filename", nargs="?", help="program name, reading programs/machine code/<filename>_converted.bin, or .txt if there is no .bin")
+    parser.add_argument("--world", default="create CPU v2.2", help="world save folder")
+    parser.add_argument("--origin", type=int, nargs=3, required=True, metavar=("X", "Y", "Z"),
+                        help="position of the top barrel of the first instruction of block 1 of secondary storage")
+    parser.add_argument("--first-block", type=int, default=1, help="block of secondary storage the program starts at")
+    parser.add_argument("--blocks", type=int, default=None, help="number of blocks to read (default: the length of the program)")
+    parser.add_argument("--block-spacing", type=int, default=DEFAULT_BLOCK_SPACING, help="distance between blocks of secondary storage along the z axis")
+    parser.add_argument("--memory-origin", type=int, nargs=3, metavar=("X", "Y", "Z"),
+                        help="also read data memory: position of the lamp of the most significant bit of address 0x11")
+    parser.add_argument("--bit-step", type=int, nargs=3, default=[1, 0, 0], metavar=("DX", "DY", "DZ"), help="offset from one bit of a cell to the next")
+    parser.add_argument("--cell-step", type=int, nargs=3, default=[0, 0, 2], metavar=("DX", "DY", "DZ"), help="offset from one cell to the next")
+    parser.add_argument("--row-step", type=int, nargs=3, default=None, metavar=("DX", "DY", "DZ"),
+                        help="offset from the first cell of a row of 15 to the first of the next (default: continue the row)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every instruction and memory cell read")
+    args = parser.parse_args()
+
+    if args.filename is None and args.blocks is None:
+        parser.error("give a program name to compare with, or --blocks to read")
+    expected_instructions = read_file_into_list(args.filename) if args.filename is not None else []
+    block_count = args.blocks if args.blocks is not None else len(split_into_blocks(expected_instructions))
+
+    start = time.perf_counter()
+    differences = []
+    with WorldReader(args.world) as world_reader:
+        blocks = read_program(world_reader, tuple(args.origin), block_count, args.first_block, args.block_spacing)
+        memory = None
+        if args.memory_origin is not None:
+            memory = read_data_memory(world_reader, tuple(args.memory_origin), tuple(args.bit_step), tuple(args.cell_step),
+                                      tuple(args.row_step) if args.row_step is not None else None)
+        chunk_count = sum(1 for chunk in world_reader.chunks.values() if chunk is not None)
+    seconds = time.perf_counter() - start
+
+    if args.verbose:
+        for block_index, block in enumerate(blocks):
+            print(f"Block {args.first_block + block_index}:")
+            for instruction in block:
+                print(instruction)
+        if memory is not None:
+            print(", ".join(f"{hex(data_cell_to_address(cell))}={value}" for cell, value in enumerate(memory)))
+    if args.filename is not None:
+        differences = find_program_differences(expected_instructions, blocks, args.first_block)
+        if memory is not None:
+            try:
+                differences += find_memory_differences(run(expected_instructions).memory, memory)
+            except Exception as e:
+                print(f"Data memory not compared, as the program couldn't be simulated: {e}")
+    for difference in differences:
+        print(difference)
+    print(f"Read {block_count} block(s) from {chunk_count} chunk(s) in {seconds*1000:.0f} ms, {len(differences)} difference(s)")
+    if len(differences) > 0:
+        sys.exit(1)
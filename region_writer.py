@@ -0,0 +1,384 @@
+import argparse
+import concurrent.futures
+import functools
+import gzip
+import os
+import struct
+import time
+import zlib
+
+from schem_writer import (TAG_BYTE, TAG_BYTE_ARRAY, TAG_COMPOUND, TAG_DOUBLE, TAG_END, TAG_FLOAT, TAG_INT, TAG_INT_ARRAY, TAG_LIST, TAG_LONG,
+                          TAG_LONG_ARRAY, TAG_SHORT, TAG_STRING, encode_string)
+from schematic_generator import BARREL, DEFAULT_BLOCK_SPACING, get_block_barrels, read_file_into_list, split_into_blocks
+
+'''Writes programs straight into the region files of a world save, so that a program can be loaded into secondary storage
+without pasting a schematic for each block. The world must be closed in Minecraft while it is written to.
+A region file (region/r.<x>.<z>.mca) holds 32x32 chunks:
+- the first 4 KiB sector is a table of where each chunk is: its first sector (3 bytes) and number of sectors (1 byte)
+- the second sector is a table of when each chunk was last saved, in seconds
+- each chunk is stored in whole 4 KiB sectors, as its length (4 bytes), compression type (1 byte) and compressed NBT
+A chunk's blocks are kept in 16x16x16 sections, each with a palette of block states and the palette index of every block packed into longs.
+
+Barrels are placed where the combined schematic would put them (see schematic_generator.py), with the top barrel of the first instruction
+of the first block at the given origin and each block block_spacing further along the z axis. Only the chunks with barrels in them are
+decoded and rewritten: a chunk that still fits in its sectors is written back in place, otherwise it is moved to the first free sectors
+that are large enough, and every other chunk in the file is left as it is. Region files are independent, so they are written in parallel.
+Modified chunks have their light and heightmaps cleared, which Minecraft recalculates when it loads them.
+'''
+
+SECTOR_SIZE = 4096
+CHUNKS_PER_REGION = 32
+BLOCKS_PER_SECTION = 4096
+MAX_SECTORS_PER_CHUNK = 0xFF
+
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+COMPRESSION_NONE = 3
+EXTERNAL_CHUNK_FLAG = 0x80
+
+LOCATION = struct.Struct(">I")
+CHUNK_HEADER = struct.Struct(">iB")
+
+BARREL_BLOCK_STATE = {"Name": (TAG_STRING, BARREL), "Properties": (TAG_COMPOUND, {"facing": (TAG_STRING, "north"), "open": (TAG_STRING, "false")})}
+'''Block state of a barrel as it is stored in a palette: the default state, the same as a barrel pasted from a schematic.'''
+
+SCALAR_TAGS = {
+    TAG_BYTE: struct.Struct(">b"),
+    TAG_SHORT: struct.Struct(">h"),
+    TAG_INT: struct.Struct(">i"),
+    TAG_LONG: struct.Struct(">q"),
+    TAG_FLOAT: struct.Struct(">f"),
+    TAG_DOUBLE: struct.Struct(">d"),
+}
+'''Format of the payload of each NBT tag type that holds a single number.'''
+
+ARRAY_TAGS = {TAG_INT_ARRAY: "i", TAG_LONG_ARRAY: "q"}
+'''struct format character of the elements of each NBT array type other than byte arrays.'''
+
+def decode_payload(buffer:bytes, offset:int, tag_id:int) -> tuple:
+    '''Decodes the payload of an NBT tag of type tag_id starting at offset. Returns (payload, offset after the payload).
+    Compounds are decoded into dicts of name : (tag id, payload) and lists into (element tag id, list of payloads),
+    so that they can be encoded again exactly as they were.
+    '''
+    if tag_id in SCALAR_TAGS:
+        scalar = SCALAR_TAGS[tag_id]
+        return scalar.unpack_from(buffer, offset)[0], offset + scalar.size
+    if tag_id == TAG_STRING:
+        length = struct.unpack_from(">H", buffer, offset)[0]
+        return bytes(buffer[offset + 2:offset + 2 + length]).decode("utf-8"), offset + 2 + length
+    if tag_id == TAG_BYTE_ARRAY:
+        length = struct.unpack_from(">i", buffer, offset)[0]
+        return bytes(buffer[offset + 4:offset + 4 + length]), offset + 4 + length
+    if tag_id in ARRAY_TAGS:
+        length = struct.unpack_from(">i", buffer, offset)[0]
+        array_format = f">{length}{ARRAY_TAGS[tag_id]}"
+        return list(struct.unpack_from(array_format, buffer, offset + 4)), offset + 4 + struct.calcsize(array_format)
+    if tag_id == TAG_LIST:
+        element_id, length = struct.unpack_from(">bi", buffer, offset)
+        offset += 5
+        elements = []
+        for i in range(length):
+            element, offset = decode_payload(buffer, offset, element_id)
+            elements.append(element)
+        return (element_id, elements), offset
+    if tag_id == TAG_COMPOUND:
+        compound = {}
+        while buffer[offset] != TAG_END:
+            child_id = buffer[offset]
+            name, offset = decode_payload(buffer, offset + 1, TAG_STRING)
+            child, offset = decode_payload(buffer, offset, child_id)
+            compound[name] = (child_id, child)
+        return compound, offset + 1
+    raise Exception(f"Unknown NBT tag type {tag_id}.")
+
+def encode_payload(tag_id:int, payload) -> bytes:
+    '''Encodes the payload of an NBT tag, in the form returned by decode_payload().'''
+    if tag_id in SCALAR_TAGS:
+        return SCALAR_TAGS[tag_id].pack(payload)
+    if tag_id == TAG_STRING:
+        return encode_string(payload)
+    if tag_id == TAG_BYTE_ARRAY:
+        return struct.pack(">i", len(payload)) + payload
+    if tag_id in ARRAY_TAGS:
+        return struct.pack(f">i{len(payload)}{ARRAY_TAGS[tag_id]}", len(payload), *payload)
+    if tag_id == TAG_LIST:
+        element_id, elements = payload
+        return struct.pack(">bi", element_id, len(elements)) + b"".join(encode_payload(element_id, element) for element in elements)
+    if tag_id == TAG_COMPOUND:
+        parts = []
+        for name, (child_id, child) in payload.items():
+            parts.append(bytes((child_id,)) + encode_string(name))
+            parts.append(encode_payload(child_id, child))
+        parts.append(bytes((TAG_END,)))
+        return b"".join(parts)
+    raise Exception(f"Unknown NBT tag type {tag_id}.")
+
+def decode_root(buffer:bytes) -> dict:
+    '''Decodes a complete NBT document (a named root compound) into a dict, ignoring the root name.'''
+    if buffer[0] != TAG_COMPOUND:
+        raise Exception("NBT data must begin with a compound tag.")
+    name, offset = decode_payload(buffer, 1, TAG_STRING)
+    return decode_payload(buffer, offset, TAG_COMPOUND)[0]
+
+def encode_root(compound:dict) -> bytes:
+    '''Encodes a dict, in the form returned by decode_root(), as a complete NBT document with an empty root name.'''
+    return bytes((TAG_COMPOUND,)) + encode_string("") + encode_payload(TAG_COMPOUND, compound)
+
+@functools.lru_cache(maxsize=None)
+def decode_barrel_items(barrel_items:bytes) -> dict:
+    '''Decodes the encoded named tags of a barrel's contents (from BARREL_PALETTE) into a compound, for adding to a block entity.'''
+    return decode_payload(barrel_items + bytes((TAG_END,)), 0, TAG_COMPOUND)[0]
+
+def get_bits_per_block(palette_size:int) -> int:
+    '''Returns the number of bits used for each palette index of a section with palette_size block states (at least 4).'''
+    return max(4, (palette_size - 1).bit_length())
+
+def unpack_block_states(block_states:dict) -> list:
+    '''Returns the palette index of each of the 4096 blocks of a section, ordered by y, then z, then x.
+    Indexes are packed into longs from the lowest bits up, and don't cross from one long into the next.
+    '''
+    palette = block_states["palette"][1][1]
+    if "data" not in block_states:
+        return [0] * BLOCKS_PER_SECTION
+    bits = get_bits_per_block(len(palette))
+    mask = (1 << bits) - 1
+    per_long = 64 // bits
+    indexes = []
+    for packed in block_states["data"][1]:
+        packed &= 0xFFFFFFFFFFFFFFFF
+        for i in range(per_long):
+            indexes.append(packed & mask)
+            packed >>= bits
+    return indexes[:BLOCKS_PER_SECTION]
+
+def pack_block_states(palette:list, indexes:list) -> dict:
+    '''Returns the block_states compound of a section from its palette and the palette index of each block.
+    Block states that are no longer used are removed from the palette.
+    '''
+    used = sorted(set(indexes))
+    if len(used) == 1:
+        return {"palette": (TAG_LIST, (TAG_COMPOUND, [palette[used[0]]]))}
+    new_index = {old_index: index for index, old_index in enumerate(used)}
+    bits = get_bits_per_block(len(used))
+    per_long = 64 // bits
+    data = []
+    for start in range(0, BLOCKS_PER_SECTION, per_long):
+        packed = 0
+        for i, palette_index in enumerate(indexes[start:start + per_long]):
+            packed |= new_index[palette_index] << (i * bits)
+        data.append(packed - (1 << 64) if packed >= 1 << 63 else packed)
+    return {"palette": (TAG_LIST, (TAG_COMPOUND, [palette[old_index] for old_index in used])), "data": (TAG_LONG_ARRAY, data)}
+
+def place_barrels_in_chunk(chunk:dict, barrels:list) -> None:
+    '''Places barrels in a decoded chunk. barrels is a list of ((x, y, z) world position, encoded barrel contents) pairs.'''
+    sections = {section["Y"][1]: section for section in chunk["sections"][1][1]}
+    barrels_by_section = {}
+    for position, barrel_items in barrels:
+        section_y = position[1] >> 4
+        if section_y not in sections:
+            raise Exception(f"{position} is outside of the height of the world.")
+        barrels_by_section.setdefault(section_y, []).append((position, barrel_items))
+
+    for section_y, section_barrels in barrels_by_section.items():
+        block_states = sections[section_y]["block_states"][1]
+        palette = list(block_states["palette"][1][1])
+        indexes = unpack_block_states(block_states)
+        if BARREL_BLOCK_STATE not in palette:
+            palette.append(BARREL_BLOCK_STATE)
+        barrel_index = palette.index(BARREL_BLOCK_STATE)
+        for (x, y, z), barrel_items in section_barrels:
+            indexes[((y & 15) << 8) | ((z & 15) << 4) | (x & 15)] = barrel_index
+        sections[section_y]["block_states"] = (TAG_COMPOUND, pack_block_states(palette, indexes))
+        #the light of the section is recalculated when the chunk is loaded
+        sections[section_y].pop("BlockLight", None)
+        sections[section_y].pop("SkyLight", None)
+
+    positions = {position for position, barrel_items in barrels}
+    block_entities = [block_entity for block_entity in chunk["block_entities"][1][1]
+                      if (block_entity["x"][1], block_entity["y"][1], block_entity["z"][1]) not in positions]
+    for (x, y, z), barrel_items in barrels:
+        block_entity = {"id": (TAG_STRING, BARREL), "x": (TAG_INT, x), "y": (TAG_INT, y), "z": (TAG_INT, z), "keepPacked": (TAG_BYTE, 0)}
+        block_entity.update(decode_barrel_items(barrel_items))
+        block_entities.append(block_entity)
+    chunk["block_entities"] = (TAG_LIST, (TAG_COMPOUND, block_entities))
+    chunk["isLightOn"] = (TAG_BYTE, 0)
+    chunk.pop("Heightmaps", None)
+
+def get_region_coordinates(x:int, z:int) -> tuple:
+    '''Returns the (x, z) coordinates of the region file holding a block.'''
+    return (x >> 9, z >> 9)
+
+def get_region_path(world:str, region_x:int, region_z:int) -> str:
+    return os.path.join(world, "region", f"r.{region_x}.{region_z}.mca")
+
+def get_chunk_index(chunk_x:int, chunk_z:int) -> int:
+    '''Returns the index of a chunk in the tables at the start of its region file.'''
+    return (chunk_x % CHUNKS_PER_REGION) + (chunk_z % CHUNKS_PER_REGION) * CHUNKS_PER_REGION
+
+def decode_stored_chunk(stored:bytes, description:str="Chunk") -> dict:
+    '''Decompresses and decodes a chunk from its sectors (starting with its length and compression type). description names the chunk in errors.'''
+    length, compression = CHUNK_HEADER.unpack_from(stored)
+    if compression & EXTERNAL_CHUNK_FLAG:
+        raise Exception(f"{description} is stored in a separate file, which isn't supported.")
+    data = stored[CHUNK_HEADER.size:CHUNK_HEADER.size - 1 + length]
+    if compression == COMPRESSION_ZLIB:
+        data = zlib.decompress(data)
+    elif compression == COMPRESSION_GZIP:
+        data = gzip.decompress(data)
+    elif compression == COMPRESSION_NONE:
+        data = bytes(data)
+    else:
+        raise Exception(f"{description} uses unsupported compression type {compression}.")
+    return decode_root(data)
+
+class RegionFile:
+    '''RegionFile : Class
+    A region file opened for rewriting some of its chunks. Use as a context manager, or call close() when finished with it.
+
+    Attributes:
+    path:str -- file that is open
+    locations:list -- (first sector, number of sectors) of each of the 1024 chunks, (0, 0) for chunks that haven't been generated
+    used_sectors:bytearray -- 1 for each sector of the file that is in use
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.file = open(path, 'r+b')
+        header = self.file.read(SECTOR_SIZE)
+        if len(header) < SECTOR_SIZE:
+            self.file.close()
+            raise Exception(f"{path} is too short to be a region file.")
+        self.locations = []
+        for chunk_index in range(CHUNKS_PER_REGION * CHUNKS_PER_REGION):
+            location = LOCATION.unpack_from(header, chunk_index * 4)[0]
+            self.locations.append((location >> 8, location & 0xFF))
+        file_sectors = (os.path.getsize(path) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        self.used_sectors = bytearray(max(file_sectors, 2))
+        self.used_sectors[0:2] = b"\x01\x01"
+        for first_sector, sector_count in self.locations:
+            self.mark_sectors(first_sector, sector_count, 1)
+
+    def mark_sectors(self, first_sector:int, sector_count:int, used:int) -> None:
+        if first_sector + sector_count > len(self.used_sectors):
+            self.used_sectors.extend(bytes(first_sector + sector_count - len(self.used_sectors)))
+        self.used_sectors[first_sector:first_sector + sector_count] = bytes((used,)) * sector_count
+
+    def read_chunk(self, chunk_index:int) -> dict:
+        '''Returns the decoded NBT of a chunk, or None if it hasn't been generated.'''
+        first_sector, sector_count = self.locations[chunk_index]
+        if sector_count == 0:
+            return None
+        self.file.seek(first_sector * SECTOR_SIZE)
+        return decode_stored_chunk(self.file.read(sector_count * SECTOR_SIZE), f"Chunk {chunk_index} of {self.path}")
+
+    def find_free_sectors(self, sector_count:int) -> int:
+        '''Returns the first sector of the first run of sector_count free sectors, which may be past the end of the file.'''
+        run_start = 2
+        for sector in range(2, len(self.used_sectors)):
+            if self.used_sectors[sector]:
+                run_start = sector + 1
+            elif sector - run_start + 1 == sector_count:
+                return run_start
+        return run_start
+
+    def write_chunk(self, chunk_index:int, chunk:dict) -> None:
+        '''Compresses a chunk and writes it to its sectors if it still fits, otherwise to the first free sectors large enough,
+        then updates its location and timestamp.
+        '''
+        data = zlib.compress(encode_root(chunk))
+        stored = CHUNK_HEADER.pack(len(data) + 1, COMPRESSION_ZLIB) + data
+        sector_count = (len(stored) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        if sector_count > MAX_SECTORS_PER_CHUNK:
+            raise Exception(f"Chunk {chunk_index} of {self.path} is too large to store in a region file.")
+        stored += bytes(sector_count * SECTOR_SIZE - len(stored))
+
+        first_sector, old_sector_count = self.locations[chunk_index]
+        self.mark_sectors(first_sector, old_sector_count, 0)
+        if sector_count > old_sector_count:
+            first_sector = self.find_free_sectors(sector_count)
+        self.mark_sectors(first_sector, sector_count, 1)
+        self.locations[chunk_index] = (first_sector, sector_count)
+
+        self.file.seek(first_sector * SECTOR_SIZE)
+        self.file.write(stored)
+        self.file.seek(chunk_index * 4)
+        self.file.write(LOCATION.pack(first_sector << 8 | sector_count))
+        self.file.seek(SECTOR_SIZE + chunk_index * 4)
+        self.file.write(LOCATION.pack(int(time.time())))
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_barrels_to_region(path:str, barrels_by_chunk:dict) -> int:
+    '''Places barrels in the chunks of one region file. barrels_by_chunk is dict of (chunk x, chunk z) : list of (position, encoded barrel contents).
+    Returns the number of chunks rewritten.
+    '''
+    if not os.path.isfile(path):
+        raise Exception(f"{path} doesn't exist: the area must have been loaded in the game before a program can be written to it.")
+    with RegionFile(path) as region_file:
+        for (chunk_x, chunk_z), barrels in sorted(barrels_by_chunk.items()):
+            chunk_index = get_chunk_index(chunk_x, chunk_z)
+            chunk = region_file.read_chunk(chunk_index)
+            if chunk is None or chunk.get("Status", (TAG_STRING, ""))[1] != "minecraft:full":
+                raise Exception(f"Chunk ({chunk_x}, {chunk_z}) in {path} hasn't been fully generated: load it in the game first.")
+            place_barrels_in_chunk(chunk, barrels)
+            region_file.write_chunk(chunk_index, chunk)
+    return len(barrels_by_chunk)
+
+def write_barrels_to_region_task(task:tuple) -> int:
+    '''Runs write_barrels_to_region() for a (path, barrels by chunk) task in a worker process.'''
+    return write_barrels_to_region(*task)
+
+def get_program_barrels(instructions:list, origin:tuple, first_block:int=1, block_spacing:int=DEFAULT_BLOCK_SPACING) -> list:
+    '''Returns the barrels of a program placed in secondary storage, as a list of ((x, y, z) world position, encoded barrel contents) pairs.
+    origin is the position of the top barrel of the first instruction of block 1 of secondary storage, and the program starts at first_block.
+    '''
+    barrels = []
+    for block_number, block in enumerate(split_into_blocks(instructions), start=first_block - 1):
+        for (x, y, z), barrel_items in get_block_barrels(block):
+            barrels.append(((origin[0] + x, origin[1] + y, origin[2] + z + block_number*block_spacing), barrel_items))
+    return barrels
+
+def group_barrels_by_region(world:str, barrels:list) -> dict:
+    '''Returns dict of region file path : dict of (chunk x, chunk z) : barrels in that chunk.'''
+    regions = {}
+    for position, barrel_items in barrels:
+        x, y, z = position
+        path = get_region_path(world, *get_region_coordinates(x, z))
+        regions.setdefault(path, {}).setdefault((x >> 4, z >> 4), []).append((position, barrel_items))
+    return regions
+
+def write_program_to_world(instructions:list, world:str, origin:tuple, first_block:int=1, block_spacing:int=DEFAULT_BLOCK_SPACING,
+                           workers:int=None) -> int:
+    '''Writes a program into secondary storage in a world save, rewriting only the chunks it is placed in.
+    Region files are shared between a pool of worker processes when there is more than one. Returns the number of chunks rewritten.
+    '''
+    regions = group_barrels_by_region(world, get_program_barrels(instructions, origin, first_block, block_spacing))
+    tasks = sorted(regions.items())
+    if len(tasks) > 1 and workers != 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(write_barrels_to_region_task, tasks))
+    return sum(write_barrels_to_region_task(task) for task in tasks)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a machine code program into secondary storage in a world save, without WorldEdit.")
+    parser.add_argument("filename", help="program name, reading programs/machine code/<filename>_converted.bin, or .txt if there is no .bin")
+    parser.add_argument("--world", default="create CPU v2.2", help="world save folder (close the world in Minecraft first)")
+    parser.add_argument("--origin", type=int, nargs=3, required=True, metavar=("X", "Y", "Z"),
+                        help="position of the top barrel of the first instruction of block 1 of secondary storage")
+    parser.add_argument("--first-block", type=int, default=1, help="block of secondary storage to write the start of the program to")
+    parser.add_argument("--block-spacing", type=int, default=DEFAULT_BLOCK_SPACING, help="distance between blocks of secondary storage along the z axis")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    if args.first_block < 1:
+        parser.error("--first-block must be at least 1")
+    instructions = read_file_into_list(args.filename)
+    start = time.perf_counter()
+    chunk_count = write_program_to_world(instructions, args.world, tuple(args.origin), args.first_block, args.block_spacing, args.workers)
+    print(f"Wrote {len(split_into_blocks(instructions))} block(s) to {chunk_count} chunk(s) in {(time.perf_counter() - start)*1000:.0f} ms")
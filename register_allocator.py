@@ -0,0 +1,470 @@
+from assembler import (ALLOCATABLE_REGISTERS, OPCODES, REGISTER_OPERAND, VIRTUAL_OPERAND, Instruction, begins_with_label,
+                       convert_cycle_to_instruction_cell_int, get_instruction_label, get_opcode_str, get_operands, get_operand_value,
+                       is_operand_immediate)
+
+'''Register allocator used by the assembler in place of the immediate_registers scheme, when register allocation is enabled.
+Instead of loading every constant and label address into its own register at the start of the program, it:
+- builds a control-flow graph of basic blocks from the labels and branches, and finds the loops in it
+- gives each use of an immediate operand or branch label a virtual register, loaded by an LDI placed in front of the use,
+  or in front of the outermost loop around it so that it isn't executed on every iteration
+- shares one LDI between uses of the same value where the LDI is executed before all of them (it dominates them)
+- works out which registers are live at each instruction, and assigns each virtual register a real one that isn't
+  live at the same time: one that the program never uses, or one of the program's own registers while its value is dead.
+If that runs out of registers, LDIs are placed closer to their uses, which needs fewer registers at once.
+All registers the program writes to keep their final values, as these are the program's results.
+'''
+
+HOIST_TO_OUTERMOST_LOOP = 0
+HOIST_TO_INNERMOST_LOOP = 1
+NO_HOISTING = 2
+PLACEMENT_STRATEGIES = [
+    (HOIST_TO_OUTERMOST_LOOP, True),
+    (HOIST_TO_INNERMOST_LOOP, True),
+    (NO_HOISTING, True),
+    (NO_HOISTING, False),
+]
+'''(hoisting, share LDIs between basic blocks) pairs, tried in order until the registers can be allocated.
+Each one executes more LDIs than the one before, but keeps fewer constants in registers at once.'''
+
+WRITE_BACK_OPCODES = ["ADD", "SUB", "NOT", "AND", "OR", "LS", "RS", "LD", "LDI"]
+REGISTER_KINDS = (REGISTER_OPERAND, VIRTUAL_OPERAND)
+
+def is_conditional_branch(instruction:Instruction) -> bool:
+    '''Returns True if instruction is a BRE or BRLT that may or may not be taken.'''
+    opcode_str = instruction.opcode_str
+    if opcode_str == "BRLT":
+        return True
+    return opcode_str == "BRE" and instruction.operands[1] != instruction.operands[2]
+
+def is_branch(instruction:Instruction) -> bool:
+    '''Returns True if instruction is a BRE or BRLT.'''
+    return instruction.opcode_str in ("BRE", "BRLT")
+
+def get_reads_and_writes(instruction:Instruction) -> tuple:
+    '''Returns (registers read, registers written) by an instruction, as operand strings such as "R3" or "V2".
+    A BRE comparing a register with itself doesn't depend on the value of that register, so it isn't a read.
+    '''
+    opcode_str = instruction.opcode_str
+    operands = instruction.operands
+    #the operand of an LDI is a value or a label name, never a register
+    if opcode_str == "LDI":
+        return ([], operands[:1])
+    kinds = instruction.kinds
+    if opcode_str in WRITE_BACK_OPCODES:
+        return ([operands[index] for index in range(1, len(operands)) if kinds[index] in REGISTER_KINDS], operands[:1])
+    registers = [operands[index] for index in range(len(operands)) if kinds[index] in REGISTER_KINDS]
+    if opcode_str == "BRE" and operands[1] == operands[2]:
+        return (registers[:1], [])
+    return (registers, [])
+
+def get_label_positions(instructions:list) -> dict:
+    '''Returns dict of label : index of the instruction it is declared on.'''
+    label_positions = {}
+    for instruction_index, instruction in enumerate(instructions):
+        if begins_with_label(instruction):
+            label = get_instruction_label(instruction)
+            if label in label_positions:
+                raise Exception(f"Label {label} is declared more than once.")
+            label_positions[label] = instruction_index
+    return label_positions
+
+def get_successors(instructions:list, label_positions:dict, target_labels:dict=None) -> list:
+    '''Returns, for each instruction, the list of instruction indexes that can run after it.
+    An index equal to len(instructions) means execution runs off the end of the program.
+    target_labels maps virtual registers used as branch targets to the label they hold.
+    '''
+    if target_labels is None:
+        target_labels = {}
+    successors = []
+    for instruction_index, instruction in enumerate(instructions):
+        following = []
+        if is_branch(instruction):
+            target = get_operands(instruction)[0]
+            following.append(label_positions[target_labels.get(target, target)])
+            if is_conditional_branch(instruction):
+                following.append(instruction_index + 1)
+        else:
+            following.append(instruction_index + 1)
+        successors.append(following)
+    return successors
+
+def find_basic_blocks(instructions:list, label_positions:dict) -> list:
+    '''Returns list of (start index, end index) for each basic block, in program order. The end index is exclusive.'''
+    leaders = {0}
+    leaders.update(label_positions.values())
+    for instruction_index, instruction in enumerate(instructions):
+        if is_branch(instruction):
+            leaders.add(instruction_index + 1)
+    leaders = sorted(leader for leader in leaders if leader < len(instructions))
+    return [(start, leaders[block_index + 1] if block_index + 1 < len(leaders) else len(instructions))
+            for block_index, start in enumerate(leaders)]
+
+def find_dominators(block_successors:list) -> list:
+    '''Returns, for each block, the set of blocks that every path from the first block to it passes through.'''
+    number_of_blocks = len(block_successors)
+    predecessors = [[] for i in range(number_of_blocks)]
+    for block, successors in enumerate(block_successors):
+        for successor in successors:
+            predecessors[successor].append(block)
+
+    all_blocks = set(range(number_of_blocks))
+    dominators = [set(all_blocks) for i in range(number_of_blocks)]
+    dominators[0] = {0}
+    changed = True
+    while changed:
+        changed = False
+        for block in range(1, number_of_blocks):
+            incoming = [dominators[predecessor] for predecessor in predecessors[block]]
+            new_dominators = set.intersection(*incoming) if incoming else set()
+            new_dominators = new_dominators | {block}
+            if new_dominators != dominators[block]:
+                dominators[block] = new_dominators
+                changed = True
+    return dominators
+
+def find_loops(block_successors:list, dominators:list) -> dict:
+    '''Returns dict of loop header block : set of blocks in the loop, from the back edges of the graph.'''
+    predecessors = [[] for i in range(len(block_successors))]
+    for block, successors in enumerate(block_successors):
+        for successor in successors:
+            predecessors[successor].append(block)
+
+    loops = {}
+    for block, successors in enumerate(block_successors):
+        for header in successors:
+            #an edge back to a block that dominates it closes a loop
+            if header in dominators[block]:
+                body = loops.setdefault(header, {header})
+                stack = [block]
+                while stack:
+                    member = stack.pop()
+                    if member not in body:
+                        body.add(member)
+                        stack.extend(predecessors[member])
+    return loops
+
+class ControlFlowGraph:
+    '''ControlFlowGraph : Class
+
+    Attributes:
+    blocks:list -- (start index, end index) of each basic block
+    block_of:list -- block number of each instruction
+    dominators:list -- set of blocks dominating each block
+    loops:dict -- loop header block : set of blocks in the loop
+    hoistable_loops:list -- for each block, the headers of the loops around it that an LDI can be placed in front of, outermost first
+    '''
+    def __init__(self, instructions:list):
+        label_positions = get_label_positions(instructions)
+        successors = get_successors(instructions, label_positions)
+        self.blocks = find_basic_blocks(instructions, label_positions)
+        self.block_of = [0] * len(instructions)
+        for block, (start, end) in enumerate(self.blocks):
+            for instruction_index in range(start, end):
+                self.block_of[instruction_index] = block
+
+        block_successors = []
+        for start, end in self.blocks:
+            block_successors.append(sorted({self.block_of[following] for following in successors[end - 1] if following < len(instructions)}))
+        self.dominators = find_dominators(block_successors)
+        self.loops = find_loops(block_successors, self.dominators)
+
+        #an LDI placed in front of a loop header (before its label) only runs when the loop is entered from the instruction above it,
+        #so it can only be hoisted there if that is the only way into the loop
+        entry_points = {}
+        for block, following_blocks in enumerate(block_successors):
+            for following_block in following_blocks:
+                entry_points.setdefault(following_block, []).append(block)
+        hoistable = []
+        for header, body in self.loops.items():
+            outside_predecessors = [block for block in entry_points.get(header, []) if block not in body]
+            start = self.blocks[header][0]
+            falls_through = all(predecessor == header - 1 and self.is_fall_through(instructions, start) for predecessor in outside_predecessors)
+            if falls_through:
+                hoistable.append(header)
+
+        self.hoistable_loops = []
+        for block in range(len(self.blocks)):
+            around = [header for header in hoistable if block in self.loops[header]]
+            around.sort(key=lambda header: -len(self.loops[header]))
+            self.hoistable_loops.append(around)
+
+    @staticmethod
+    def is_fall_through(instructions:list, start:int) -> bool:
+        '''Returns True if the instruction before start only reaches it by running on, not by branching to it.'''
+        if start == 0:
+            return True
+        previous = instructions[start - 1]
+        if not is_branch(previous):
+            return True
+        #a branch whose target is this instruction would skip an LDI placed in front of it
+        label = get_instruction_label(instructions[start]) if begins_with_label(instructions[start]) else None
+        return is_conditional_branch(previous) and get_operands(previous)[0] != label
+
+    def dominates(self, block:int, other_block:int) -> bool:
+        '''Returns True if block dominates other_block.'''
+        return block in self.dominators[other_block]
+
+class ConstantUse:
+    '''ConstantUse : Class
+
+    Attributes:
+    instruction_index:int -- instruction with the operand
+    operand_index:int -- position of the operand among the instruction's operands
+    value -- the integer value of an immediate operand, or the label name for a branch target
+    '''
+    def __init__(self, instruction_index:int, operand_index:int, value):
+        self.instruction_index = instruction_index
+        self.operand_index = operand_index
+        self.value = value
+
+class ConstantLoad:
+    '''ConstantLoad : Class
+    An LDI of a value into a virtual register, shared by one or more uses.
+
+    Attributes:
+    value -- integer value, or label name whose address is loaded
+    virtual_register:str -- "V" followed by a number
+    before_header:bool -- True if the LDI goes in front of a loop header (before its label), False if in front of an instruction in a block
+    instruction_index:int -- instruction the LDI is placed in front of
+    uses:list -- ConstantUse instances reading the virtual register
+    '''
+    def __init__(self, value, virtual_register:str, before_header:bool, instruction_index:int):
+        self.value = value
+        self.virtual_register = virtual_register
+        self.before_header = before_header
+        self.instruction_index = instruction_index
+        self.uses = []
+
+    def dominates(self, cfg:ControlFlowGraph, instruction_index:int) -> bool:
+        '''Returns True if this LDI runs before the given instruction on every path to it.'''
+        block = cfg.block_of[self.instruction_index]
+        other_block = cfg.block_of[instruction_index]
+        if self.before_header:
+            return cfg.dominates(block, other_block)
+        if block == other_block:
+            return self.instruction_index <= instruction_index
+        return cfg.dominates(block, other_block)
+
+def find_constant_uses(instructions:list, label_positions:dict) -> list:
+    '''Returns a ConstantUse for every immediate operand outside an LDI, and every branch label.'''
+    uses = []
+    for instruction_index, instruction in enumerate(instructions):
+        opcode_str = get_opcode_str(instruction)
+        if opcode_str not in OPCODES:
+            raise Exception(f"i {instruction_index}: unknown opcode {opcode_str}.")
+        operands = get_operands(instruction)
+        if opcode_str in WRITE_BACK_OPCODES and is_operand_immediate(operands[0]):
+            raise Exception(f"i {instruction_index}, operand 0: must be a register.")
+        for operand_index, operand in enumerate(operands):
+            if is_branch(instruction) and operand_index == 0:
+                if operand not in label_positions:
+                    raise Exception(f"i {instruction_index}: branch target {operand} is not a label.")
+                uses.append(ConstantUse(instruction_index, operand_index, operand))
+            elif opcode_str != "LDI" and is_operand_immediate(operand):
+                uses.append(ConstantUse(instruction_index, operand_index, get_operand_value(operand)))
+            elif operand[0] != "R" and not is_operand_immediate(operand):
+                raise Exception(f"i {instruction_index}: {operand} is not a register, immediate value or label.")
+    return uses
+
+def place_constant_loads(uses:list, cfg:ControlFlowGraph, hoisting:int, share_between_blocks:bool) -> list:
+    '''Groups constant uses into ConstantLoads, placed according to the hoisting strategy.'''
+    loads = {}
+    for use in uses:
+        block = cfg.block_of[use.instruction_index]
+        loops = cfg.hoistable_loops[block]
+        if hoisting == HOIST_TO_OUTERMOST_LOOP and len(loops) > 0:
+            placement = (True, cfg.blocks[loops[0]][0])
+        elif hoisting == HOIST_TO_INNERMOST_LOOP and len(loops) > 0:
+            placement = (True, cfg.blocks[loops[-1]][0])
+        else:
+            placement = (False, block)
+        key = (type(use.value), use.value, placement)
+        if key not in loads:
+            before_header, position = placement
+            #in a block, the LDI goes in front of the first use of the value
+            instruction_index = position if before_header else use.instruction_index
+            loads[key] = ConstantLoad(use.value, "", before_header, instruction_index)
+        loads[key].uses.append(use)
+
+    ordered_loads = sorted(loads.values(), key=lambda load: (load.instruction_index, not load.before_header))
+    if share_between_blocks:
+        #uses can share the LDI of an earlier load with the same value if that LDI always runs before them
+        shared_loads = []
+        for load in ordered_loads:
+            for earlier in shared_loads:
+                if type(earlier.value) == type(load.value) and earlier.value == load.value and all(earlier.dominates(cfg, use.instruction_index) for use in load.uses):
+                    earlier.uses.extend(load.uses)
+                    break
+            else:
+                shared_loads.append(load)
+        ordered_loads = shared_loads
+
+    for load_number, load in enumerate(ordered_loads):
+        load.virtual_register = f"V{load_number}"
+    return ordered_loads
+
+def insert_constant_loads(instructions:list, loads:list) -> list:
+    '''Returns a new list of instructions with each ConstantLoad's LDI inserted, and constant operands replaced by virtual registers.
+    Label LDIs keep the label name as their operand until the label addresses are known.
+    '''
+    rewritten = [instruction.copy() for instruction in instructions]
+    for load in loads:
+        for use in load.uses:
+            rewritten[use.instruction_index].set_operand(use.operand_index, load.virtual_register)
+
+    before_headers = {}
+    in_blocks = {}
+    for load in loads:
+        operand = load.value if isinstance(load.value, str) else f"#{load.value}"
+        ldi = Instruction("LDI", (load.virtual_register, operand))
+        target = before_headers if load.before_header else in_blocks
+        target.setdefault(load.instruction_index, []).append(ldi)
+
+    result = []
+    for instruction_index, instruction in enumerate(rewritten):
+        result.extend(before_headers.get(instruction_index, []))
+        ldis = in_blocks.get(instruction_index, [])
+        #LDIs in front of a labelled instruction take the label, so branches to it run them too
+        if len(ldis) > 0 and begins_with_label(instruction):
+            ldis[0].label = instruction.label
+            instruction.label = None
+        result.extend(ldis)
+        result.append(instruction)
+    return result
+
+def find_live_out(instructions:list, exit_live:set, target_labels:dict) -> list:
+    '''Returns, for each instruction, the set of registers whose values may be read after it runs.'''
+    label_positions = get_label_positions(instructions)
+    successors = get_successors(instructions, label_positions, target_labels)
+    reads_and_writes = [get_reads_and_writes(instruction) for instruction in instructions]
+    live_in = [set() for instruction in instructions] + [set(exit_live)]
+    live_out = [set() for instruction in instructions]
+    changed = True
+    while changed:
+        changed = False
+        for instruction_index in range(len(instructions) - 1, -1, -1):
+            out = set()
+            for following in successors[instruction_index]:
+                out |= live_in[following]
+            reads, writes = reads_and_writes[instruction_index]
+            new_in = (out - set(writes)) | set(reads)
+            if out != live_out[instruction_index] or new_in != live_in[instruction_index]:
+                live_out[instruction_index] = out
+                live_in[instruction_index] = new_in
+                changed = True
+    return live_out
+
+def build_interference(instructions:list, live_out:list, virtual_values:dict) -> dict:
+    '''Returns dict of virtual register : set of registers (real or virtual) it can't share a register with.
+    Two virtual registers holding the same value never conflict, as either can stand in for the other.
+    '''
+    interference = {virtual: set() for virtual in virtual_values}
+    for instruction_index, instruction in enumerate(instructions):
+        reads, writes = get_reads_and_writes(instruction)
+        for written in writes:
+            for live in live_out[instruction_index]:
+                if live == written:
+                    continue
+                if written in virtual_values and live in virtual_values and virtual_values[written] == virtual_values[live]:
+                    continue
+                if written in interference:
+                    interference[written].add(live)
+                if live in interference:
+                    interference[live].add(written)
+    return interference
+
+def assign_registers(interference:dict, virtual_values:dict, program_registers:set) -> dict:
+    '''Greedily assigns each virtual register a real register. Returns dict of virtual register : register number.
+    Raises an exception if a virtual register conflicts with every allocatable register.
+    '''
+    assignment = {}
+    #most constrained virtual registers first
+    order = sorted(interference.keys(), key=lambda virtual: (-len(interference[virtual]), int(virtual[1:])))
+    for virtual in order:
+        taken = set()
+        for other in interference[virtual]:
+            if other[0] == "R":
+                taken.add(get_operand_value(other))
+            elif other in assignment:
+                taken.add(assignment[other])
+        available = [register for register in ALLOCATABLE_REGISTERS if register not in taken]
+        if len(available) == 0:
+            raise Exception("Run out of registers to use.")
+
+        same_value = {assignment[other] for other in assignment if virtual_values[other] == virtual_values[virtual]}
+        other_values = set(assignment[other] for other in assignment) - same_value
+        def preference(register:int) -> tuple:
+            #share registers between equal values, then prefer registers the program doesn't use, highest first
+            return (register not in same_value, register in program_registers, register in other_values, -register)
+        assignment[virtual] = min(available, key=preference)
+    return assignment
+
+def remove_constant_zero_ldis(instructions:list) -> list:
+    '''Removes LDI #0 instructions into registers that are never written with anything else, as registers start at 0.'''
+    other_writes = set()
+    for instruction in instructions:
+        reads, writes = get_reads_and_writes(instruction)
+        is_zero_ldi = get_opcode_str(instruction) == "LDI" and get_operands(instruction)[1] == "#0"
+        if not is_zero_ldi:
+            other_writes.update(writes)
+
+    result = []
+    for instruction in instructions:
+        operands = get_operands(instruction)
+        #labelled LDIs are kept, as branches to them need an instruction to land on
+        if get_opcode_str(instruction) == "LDI" and operands[1] == "#0" and operands[0] not in other_writes and not begins_with_label(instruction):
+            continue
+        result.append(instruction)
+    return result
+
+def allocate_registers(instructions:list) -> dict:
+    '''Converts instructions (with comments removed and custom branches converted) into correct syntax,
+    on a 1-1 relationship with the machine code, allocating registers for immediate operands and branch labels.
+    Modifies instructions in place. Returns dict of labels and their instruction cycle numbers.
+    '''
+    if len(instructions) == 0:
+        return {}
+    label_positions = get_label_positions(instructions)
+    uses = find_constant_uses(instructions, label_positions)
+    cfg = ControlFlowGraph(instructions)
+
+    program_registers = set()
+    for instruction in instructions:
+        for operand in get_operands(instruction):
+            if operand[0] == "R":
+                program_registers.add(get_operand_value(operand))
+    #the values left in the program's registers are its results, so they are all live when the program ends
+    written_registers = set()
+    for instruction in instructions:
+        written_registers.update(get_reads_and_writes(instruction)[1])
+
+    error = None
+    for hoisting, share_between_blocks in PLACEMENT_STRATEGIES:
+        loads = place_constant_loads(uses, cfg, hoisting, share_between_blocks)
+        rewritten = insert_constant_loads(instructions, loads)
+        virtual_values = {load.virtual_register: (type(load.value), load.value) for load in loads}
+        target_labels = {load.virtual_register: load.value for load in loads if isinstance(load.value, str)}
+        live_out = find_live_out(rewritten, written_registers, target_labels)
+        interference = build_interference(rewritten, live_out, virtual_values)
+        try:
+            assignment = assign_registers(interference, virtual_values, program_registers)
+            break
+        except Exception as e:
+            error = e
+    else:
+        raise error
+
+    for instruction in rewritten:
+        if VIRTUAL_OPERAND in instruction.kinds:
+            instruction.set_operands(f"R{assignment[operand]}" if kind == VIRTUAL_OPERAND else operand
+                                     for operand, kind in zip(instruction.operands, instruction.kinds))
+    rewritten = remove_constant_zero_ldis(rewritten)
+
+    branch_labels = get_label_positions(rewritten)
+    for instruction in rewritten:
+        if instruction.opcode_str == "LDI" and instruction.operands[1] in branch_labels:
+            label_cycle = branch_labels[instruction.operands[1]]
+            instruction.set_operand(1, f"#{convert_cycle_to_instruction_cell_int(instr_cycle=label_cycle)}")
+        instruction.label = None
+    instructions[:] = rewritten
+    return branch_labels
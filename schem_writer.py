@@ -0,0 +1,147 @@
+import gzip
+import struct
+
+'''Writes Sponge schematic (.schem, version 2) files, the format WorldEdit uses, without any third-party packages.
+A .schem file is a gzipped NBT compound. The parts of it used here are:
+- Palette: each different block state in the schematic, mapped to an index
+- BlockData: the palette index of every block in the schematic's bounding box, as varints, ordered by x, then z, then y
+- BlockEntities: the extra data of blocks such as barrels (their items), with the position of the block
+
+Blocks with the same block entity data share one encoded copy of it, so a schematic of barrels only encodes the
+16 different barrels once, however many of them there are. See https://github.com/SpongePowered/Schematic-Specification.
+'''
+
+SPONGE_SCHEMATIC_VERSION = 2
+DATA_VERSION_1_20_1 = 3465
+'''Minecraft data version of Java Edition 1.20.1, the version the CPU is built in.'''
+
+DEFAULT_COMPRESSION_LEVEL = 9
+AIR = "minecraft:air"
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+TAG_BYTE_ARRAY = 7
+TAG_LONG_ARRAY = 12
+
+def encode_varint(value:int) -> bytes:
+    '''Encodes a non-negative integer as a varint: 7 bits per byte, lowest first, with the top bit set on all but the last byte.'''
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def encode_string(text:str) -> bytes:
+    '''Encodes the payload of an NBT string: its length in bytes, then the UTF-8 text.'''
+    encoded = text.encode("utf-8")
+    return struct.pack(">H", len(encoded)) + encoded
+
+def encode_tag_header(tag_id:int, name:str) -> bytes:
+    '''Encodes the type and name that come before the payload of a named NBT tag.'''
+    return bytes((tag_id,)) + encode_string(name)
+
+def encode_byte(name:str, value:int) -> bytes:
+    return encode_tag_header(TAG_BYTE, name) + struct.pack(">b", value)
+
+def encode_short(name:str, value:int) -> bytes:
+    return encode_tag_header(TAG_SHORT, name) + struct.pack(">h", value)
+
+def encode_int(name:str, value:int) -> bytes:
+    return encode_tag_header(TAG_INT, name) + struct.pack(">i", value)
+
+def encode_named_string(name:str, text:str) -> bytes:
+    return encode_tag_header(TAG_STRING, name) + encode_string(text)
+
+def encode_int_array(name:str, values:list) -> bytes:
+    return encode_tag_header(TAG_INT_ARRAY, name) + struct.pack(f">i{len(values)}i", len(values), *values)
+
+def encode_compound_list(name:str, compounds:list) -> bytes:
+    '''Encodes a list of compounds, each given as the bytes of its named tags (without the end tag).'''
+    parts = [encode_tag_header(TAG_LIST, name), struct.pack(">bi", TAG_COMPOUND, len(compounds))]
+    for compound in compounds:
+        parts.append(compound)
+        parts.append(bytes((TAG_END,)))
+    return b"".join(parts)
+
+class Schematic:
+    '''Schematic : Class
+    Blocks to be saved as a Sponge schematic. Positions are (x, y, z) tuples relative to where the schematic is pasted.
+
+    Attributes:
+    blocks:dict -- position : block state, such as "minecraft:barrel"
+    block_entities:dict -- position : (block entity id, encoded block entity data)
+    '''
+    def __init__(self):
+        self.blocks = {}
+        self.block_entities = {}
+
+    def set_block(self, position:tuple, block_state:str, block_entity_id:str=None, block_entity_data:bytes=None) -> None:
+        '''Places a block. block_entity_data is the encoded named tags of its block entity (see encode_byte etc.),
+        and is stored by reference, so blocks given the same bytes object share it.
+        '''
+        self.blocks[position] = block_state
+        if block_entity_id is not None:
+            self.block_entities[position] = (block_entity_id, block_entity_data or b"")
+        else:
+            self.block_entities.pop(position, None)
+
+    def get_bounds(self) -> tuple:
+        '''Returns ((min x, min y, min z), (width, height, length)) of the box containing every block.'''
+        if len(self.blocks) == 0:
+            return ((0, 0, 0), (1, 1, 1))
+        minimum = tuple(min(position[axis] for position in self.blocks) for axis in range(3))
+        maximum = tuple(max(position[axis] for position in self.blocks) for axis in range(3))
+        return (minimum, tuple(maximum[axis] - minimum[axis] + 1 for axis in range(3)))
+
+    def encode_block_data(self, minimum:tuple, size:tuple) -> tuple:
+        '''Returns (palette dict of block state : index, BlockData bytes). Positions without a block are air.'''
+        width, height, length = size
+        palette = {AIR: 0}
+        indexes = [0] * (width * height * length)
+        for (x, y, z), block_state in self.blocks.items():
+            palette_index = palette.setdefault(block_state, len(palette))
+            indexes[((y - minimum[1])*length + (z - minimum[2]))*width + (x - minimum[0])] = palette_index
+        #every index fits in one byte unless there are more than 127 block states
+        if len(palette) <= 0x80:
+            return palette, bytes(indexes)
+        varints = [encode_varint(palette_index) for palette_index in range(len(palette))]
+        return palette, b"".join(varints[palette_index] for palette_index in indexes)
+
+    def save(self, path:str, compression_level:int=DEFAULT_COMPRESSION_LEVEL, data_version:int=DATA_VERSION_1_20_1) -> None:
+        '''Writes the schematic to path, gzipped at the given level (0-9, 0 for no compression).'''
+        minimum, size = self.get_bounds()
+        palette, block_data = self.encode_block_data(minimum, size)
+
+        block_entities = []
+        for (x, y, z), (block_entity_id, data) in self.block_entities.items():
+            position = [x - minimum[0], y - minimum[1], z - minimum[2]]
+            block_entities.append(encode_int_array("Pos", position) + encode_named_string("Id", block_entity_id) + data)
+
+        metadata = encode_int("WEOffsetX", minimum[0]) + encode_int("WEOffsetY", minimum[1]) + encode_int("WEOffsetZ", minimum[2])
+        palette_tags = b"".join(encode_int(block_state, palette_index) for block_state, palette_index in palette.items())
+
+        with gzip.open(path, 'wb', compresslevel=compression_level) as output_file:
+            output_file.write(encode_tag_header(TAG_COMPOUND, "Schematic"))
+            output_file.write(encode_int("Version", SPONGE_SCHEMATIC_VERSION))
+            output_file.write(encode_int("DataVersion", data_version))
+            output_file.write(encode_tag_header(TAG_COMPOUND, "Metadata") + metadata + bytes((TAG_END,)))
+            output_file.write(encode_short("Width", size[0]) + encode_short("Height", size[1]) + encode_short("Length", size[2]))
+            output_file.write(encode_int_array("Offset", list(minimum)))
+            output_file.write(encode_int("PaletteMax", len(palette)))
+            output_file.write(encode_tag_header(TAG_COMPOUND, "Palette") + palette_tags + bytes((TAG_END,)))
+            output_file.write(encode_tag_header(TAG_BYTE_ARRAY, "BlockData") + struct.pack(">i", len(block_data)))
+            output_file.write(block_data)
+            output_file.write(encode_compound_list("BlockEntities", block_entities))
+            output_file.write(bytes((TAG_END,)))
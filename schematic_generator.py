@@ -1,7 +1,10 @@
-import mcschematic
+import argparse
+import os
 import re
-import sys
-import math
+
+from build_cache import BuildCache, hash_key
+from machine_code_format import MachineCodeFile, get_binary_path
+from schem_writer import DEFAULT_COMPRESSION_LEVEL, Schematic, encode_byte, encode_compound_list, encode_named_string
 
 '''This script takes a generated machine code program and creates a 1.20.1 Minecraft schematic to represent this.
 A schematic is a collection of blocks that can be spawned in using the WorldEdit mod: this allows large programs to be spawned instantly without the possibility of human error.
@@ -10,6 +13,8 @@ A program is represented by a collection of redstone signal strengths, and there
 '''The script takes a program file name as input and generates one or more schematics, stored in the schematics folder.
 If the program is longer than 15 instructions, it will need to be broken into more than one schematic.
 Schematics will be named: filename_block1.schem, filename_block2.schem, etc.
+With --combined, every block is also written into one schematic, filename.schem, with the blocks side by side along the z axis.
+Schematics are written by schem_writer.py.
 '''
 
 '''The format for generating a minecraft container block is as follows:
@@ -35,9 +40,18 @@ The lower bounds for each signal strength in barrels are as follows:
 15 = 27 stacks
 '''
 
+SCHEMATIC_GENERATOR_VERSION = 2
+'''Increase whenever a change to this script changes the schematics it produces, so that cached schematics are rebuilt.'''
+
+INSTRUCTIONS_PER_BLOCK = 15
+
 # the gap between instructions, used to calculate the coordinates of barrels
 HORIZONTAL_GAP = 5
 VERTICAL_GAP = 2
+# the gap between blocks in a combined schematic
+DEFAULT_BLOCK_SPACING = 2
+
+BARREL = "minecraft:barrel"
 
 SIGNAL_STRENGTH_LOWER_BOUNDS = {
     0:0,
@@ -60,9 +74,15 @@ SIGNAL_STRENGTH_LOWER_BOUNDS = {
 '''Describes the number of blocks needed in a barrel to achieve a given signal strength.'''
 
 def read_file_into_list(filename:str) -> list:
-    '''Reads machine code file into list of instructions. Each instruction is a list of 4 integers.'''
+    '''Reads machine code file into list of instructions. Each instruction is a list of 4 integers.
+    The binary machine code file is read if the assembler has written one, otherwise the text file.
+    '''
+    text_path = "programs/machine code/" + filename + "_converted.txt"
+    if os.path.isfile(get_binary_path(text_path)):
+        with MachineCodeFile(get_binary_path(text_path)) as machine_code_file:
+            return machine_code_file.to_list()
     results = []
-    with open("programs/machine code/" + filename + "_converted.txt", 'r') as input_file:
+    with open(text_path, 'r') as input_file:
         for line in input_file:
             line = line[:-1] if line[-1] == '\n' else line
             parts = re.split(" ", line)
@@ -85,59 +105,182 @@ def calculate_barrel_position(instruction_index:int, parameter_index:int) -> tup
     coords = (x, y, 0)
     return coords
 
-def get_barrel_string(signal_strength:str) -> str:
-    '''Returns string describing barrel of given signal strength.'''
+def encode_barrel_items(signal_strength:int) -> bytes:
+    '''Returns the encoded NBT of the items in a barrel of given signal strength, for the block entity of the barrel.'''
     blocks_needed = SIGNAL_STRENGTH_LOWER_BOUNDS[signal_strength]
-    stacks = blocks_needed // 64
-    remainder = blocks_needed % 64
-
-    barrel_string = "minecraft:barrel{Items:["
-    for inventory_slot in range(stacks):
-        barrel_string = barrel_string + "{Slot:" + str(inventory_slot) + ", Count:64, id:\"minecraft:oak_planks\"}, "
-    
-    # if barrel is not full, add final stack
-    if signal_strength < 15:
-        barrel_string = barrel_string + "{Slot:" + str(stacks) + ", Count:" + str(remainder) +", id:\"minecraft:oak_planks\"}"
-    # if barrel is full, remove the final comma
+    stacks = [64] * (blocks_needed // 64)
+    if blocks_needed % 64 > 0:
+        stacks.append(blocks_needed % 64)
+    items = [encode_byte("Slot", inventory_slot) + encode_byte("Count", count) + encode_named_string("id", "minecraft:oak_planks")
+             for inventory_slot, count in enumerate(stacks)]
+    return encode_compound_list("Items", items)
+
+BARREL_PALETTE = [encode_barrel_items(signal_strength) for signal_strength in range(16)]
+'''Barrel contents for each of the 16 signal strengths, encoded once and shared by every barrel placed.'''
+
+INSTRUCTION_COLUMN_POSITIONS = [[calculate_barrel_position(instruction_index, parameter_index) for parameter_index in range(4)]
+                                for instruction_index in range(INSTRUCTIONS_PER_BLOCK)]
+'''Coordinates of the 4 barrels of each instruction in a block.'''
+
+def get_instruction_column(instruction:list, instruction_index:int) -> list:
+    '''Returns the barrels representing an instruction, as a list of (position, encoded barrel contents) pairs.'''
+    if instruction_index < INSTRUCTIONS_PER_BLOCK and len(instruction) <= 4:
+        positions = INSTRUCTION_COLUMN_POSITIONS[instruction_index]
     else:
-        barrel_string = barrel_string[:-2]
-    barrel_string = barrel_string + "]}"
-    
-    return barrel_string
+        positions = [calculate_barrel_position(instruction_index, parameter_index) for parameter_index in range(len(instruction))]
+    return [(positions[parameter_index], BARREL_PALETTE[parameter]) for parameter_index, parameter in enumerate(instruction)]
 
-def add_instruction_to_schematic(schematic:mcschematic.MCSchematic, instruction:list, instruction_index:int) -> None:
+def get_block_barrels(block:list) -> list:
+    '''Returns the barrels representing a block of instructions, as a list of (position, encoded barrel contents) pairs.'''
+    barrels = []
+    for instruction_index, instruction in enumerate(block):
+        barrels.extend(get_instruction_column(instruction, instruction_index))
+    return barrels
+
+def add_instruction_to_schematic(schematic:Schematic, instruction:list, instruction_index:int) -> None:
     '''Adds a given instruction to the schematic.'''
-    # for each 4 bits of the instruction, add it to the schematic
-    for parameter_index in range(len(instruction)):
-        parameter = instruction[parameter_index]
-        barrel_position = calculate_barrel_position(instruction_index=instruction_index, parameter_index=parameter_index)
-        barrel_string = get_barrel_string(signal_strength=parameter)
-        schematic.setBlock(barrel_position, barrel_string)
-
-def create_block_schematic(block:list, block_index:int) -> None:
+    for barrel_position, barrel_items in get_instruction_column(instruction, instruction_index):
+        schematic.set_block(barrel_position, BARREL, BARREL, barrel_items)
+
+def add_block_to_schematic(schematic:Schematic, block:list, z_offset:int=0) -> None:
+    '''Adds a block of instructions to the schematic, moved z_offset along the z axis.'''
+    #every barrel of the block is worked out first, then placed in one loop
+    set_block = schematic.set_block
+    for (x, y, z), barrel_items in get_block_barrels(block):
+        set_block((x, y, z + z_offset), BARREL, BARREL, barrel_items)
+
+def get_schematic_path(filename:str, block_index:int) -> str:
+    '''Returns the path of the schematic file for a block of a program.'''
+    return f"schematics/{filename}_block{block_index}.schem"
+
+def get_combined_schematic_path(filename:str) -> str:
+    '''Returns the path of the schematic file holding every block of a program.'''
+    return f"schematics/{filename}.schem"
+
+def create_block_schematic(block:list, block_index:int, filename:str, compression_level:int=DEFAULT_COMPRESSION_LEVEL) -> None:
     '''Given a block of 15 instructions, creates a schematic file to represent the code.'''
-    schematic = mcschematic.MCSchematic()
-    
-    for instruction_index in range(len(block)):
-        instruction = block[instruction_index]
-        add_instruction_to_schematic(schematic, instruction, instruction_index)
-    
-    schematic.save(outputFolderPath="schematics", schemName=f"{sys.argv[1]}_block{block_index}", version=mcschematic.Version.JE_1_20_1)
-
-def generate_schematics(instructions:list) -> None:
-    '''Given a list of instructions, splits them into blocks of 15 then generates 1 or more schematic files and stores them in schematics folder.'''
-    number_of_blocks = math.ceil(len(instructions)/15)
-    for block_index in range(1, number_of_blocks+1):
-        start_index = (block_index-1)*15
-        end_index = start_index + 15
-        if end_index >= len(instructions):
-            end_index = len(instructions)
-        
-        block = instructions[start_index:end_index]
-        create_block_schematic(block, block_index)
-
-instructions = read_file_into_list(sys.argv[1])
-'''for instr in instructions:
-    print(instr)'''
-
-generate_schematics(instructions)
\ No newline at end of file
+    schematic = Schematic()
+    add_block_to_schematic(schematic, block)
+    schematic.save(get_schematic_path(filename, block_index), compression_level)
+
+def create_block_schematic_task(task:tuple) -> int:
+    '''Runs create_block_schematic() for a (block, block index, filename, compression level) task in a worker process. Returns the block index.'''
+    block, block_index, filename, compression_level = task
+    create_block_schematic(block, block_index, filename, compression_level)
+    return block_index
+
+def get_block_cache_key(block:list, compression_level:int=DEFAULT_COMPRESSION_LEVEL) -> str:
+    '''Returns the build cache key for the schematic of a block.'''
+    return hash_key("schematic", SCHEMATIC_GENERATOR_VERSION, "JE_1_20_1", compression_level, block)
+
+def split_into_blocks(instructions:list) -> list:
+    '''Splits instructions into blocks of 15, the last of which may be shorter.'''
+    return [instructions[start_index:start_index + INSTRUCTIONS_PER_BLOCK] for start_index in range(0, len(instructions), INSTRUCTIONS_PER_BLOCK)]
+
+def remove_stale_blocks(filename:str, number_of_blocks:int, cache:BuildCache) -> None:
+    '''Deletes block schematics recorded in the cache for a program that are past its last block, as the program has got shorter.'''
+    for output_name in cache.names_with_prefix(f"schematics/{filename}_block"):
+        block_number = re.match(r".*_block(\d+)\.schem$", output_name)
+        if block_number is not None and output_name == get_schematic_path(filename, int(block_number.group(1))):
+            if int(block_number.group(1)) > number_of_blocks:
+                if os.path.isfile(output_name):
+                    os.remove(output_name)
+                cache.remove(output_name)
+
+def generate_schematics(instructions:list, filename:str, cache:BuildCache=None, force:bool=False, workers:int=None,
+                        compression_level:int=DEFAULT_COMPRESSION_LEVEL) -> list:
+    '''Given a list of instructions, splits them into blocks of 15 then generates 1 or more schematic files and stores them in schematics folder.
+    If a cache is given, blocks whose schematic is already up to date are skipped (unless force is True), and the cache is updated but not saved.
+    Blocks are independent, so when more than one needs generating they are shared between a pool of worker processes (one per core by default).
+    Returns the numbers of the blocks that were generated.
+    '''
+    os.makedirs("schematics", exist_ok=True)
+    tasks = []
+    cache_keys = {}
+    blocks = split_into_blocks(instructions)
+    number_of_blocks = len(blocks)
+    for block_index, block in enumerate(blocks, start=1):
+        schematic_path = get_schematic_path(filename, block_index)
+        if cache is not None:
+            cache_keys[block_index] = get_block_cache_key(block, compression_level)
+            if not force and cache.is_current(schematic_path, cache_keys[block_index], schematic_path):
+                continue
+        tasks.append((block, block_index, filename, compression_level))
+
+    if len(tasks) > 1 and workers != 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            generated_blocks = list(executor.map(create_block_schematic_task, tasks))
+    else:
+        generated_blocks = [create_block_schematic_task(task) for task in tasks]
+
+    if cache is not None:
+        for block_index in generated_blocks:
+            cache.update(get_schematic_path(filename, block_index), cache_keys[block_index])
+
+    if cache is not None:
+        remove_stale_blocks(filename, number_of_blocks, cache)
+    return generated_blocks
+
+def generate_combined_schematic(instructions:list, filename:str, cache:BuildCache=None, force:bool=False,
+                                compression_level:int=DEFAULT_COMPRESSION_LEVEL, block_spacing:int=DEFAULT_BLOCK_SPACING) -> bool:
+    '''Generates one schematic holding every block of a program, each block_spacing further along the z axis than the last.
+    If a cache is given, the schematic is skipped if it is already up to date (unless force is True), and the cache is updated but not saved.
+    Returns True if the schematic was generated.
+    '''
+    os.makedirs("schematics", exist_ok=True)
+    schematic_path = get_combined_schematic_path(filename)
+    if cache is not None:
+        cache_key = hash_key("combined schematic", SCHEMATIC_GENERATOR_VERSION, "JE_1_20_1", compression_level, block_spacing, instructions)
+        if not force and cache.is_current(schematic_path, cache_key, schematic_path):
+            return False
+
+    schematic = Schematic()
+    for block_number, block in enumerate(split_into_blocks(instructions)):
+        add_block_to_schematic(schematic, block, z_offset=block_number*block_spacing)
+    schematic.save(schematic_path, compression_level)
+
+    if cache is not None:
+        cache.update(schematic_path, cache_key)
+    return True
+
+def add_arguments(parser:argparse.ArgumentParser) -> None:
+    '''Adds the schematic generator's command line options to parser.'''
+    parser.add_argument("--force", action="store_true", help="regenerate every block, even if its schematic is up to date")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--combined", action="store_true", help="also write every block into one schematic, schematics/<filename>.schem")
+    parser.add_argument("--block-spacing", type=int, default=DEFAULT_BLOCK_SPACING, help="distance between blocks along the z axis in the combined schematic")
+    parser.add_argument("--compression-level", type=int, choices=range(10), default=DEFAULT_COMPRESSION_LEVEL, metavar="0-9",
+                        help="gzip compression level of the schematic files")
+
+def run_command(args:argparse.Namespace, instructions:list=None, cache:BuildCache=None) -> int:
+    '''Generates the schematics of args.filename with the options parsed by a parser set up with add_arguments(), saving the cache.
+    instructions is the machine code of the program if it is already in memory, otherwise it is read from the machine code file.
+    Returns the exit status.
+    '''
+    if instructions is None:
+        instructions = read_file_into_list(args.filename)
+    if args.verbose:
+        for instr in instructions:
+            print(instr)
+
+    if cache is None:
+        cache = BuildCache()
+    generated_blocks = generate_schematics(instructions, args.filename, cache, force=args.force, workers=args.workers,
+                                           compression_level=args.compression_level)
+    print(f"Generated {len(generated_blocks)} block schematic(s): {generated_blocks}")
+    if args.combined:
+        if generate_combined_schematic(instructions, args.filename, cache, force=args.force,
+                                       compression_level=args.compression_level, block_spacing=args.block_spacing):
+            print(f"Generated {get_combined_schematic_path(args.filename)}")
+        else:
+            print(f"{get_combined_schematic_path(args.filename)} is up to date.")
+    cache.save()
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates WorldEdit schematics for a machine code program.")
+    parser.add_argument("filename", help="program name, reading programs/machine code/<filename>_converted.bin, or .txt if there is no .bin")
+    add_arguments(parser)
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the machine code instructions")
+    run_command(parser.parse_args())
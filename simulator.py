@@ -0,0 +1,235 @@
+import argparse
+import os
+import re
+
+from assembler import NUMBER_OF_REGISTERS, OPCODES
+from machine_code_format import MachineCodeFile, get_binary_path, is_binary_machine_code_file
+
+'''This script runs machine code programs for the CPU without loading them into the Minecraft world.
+It models the 15 registers, the 60 cell data memory, the BRE/BRLT branches and the 2 page frames of instruction memory,
+so a program can be checked in milliseconds instead of waiting on redstone ticks.'''
+
+'''Addresses in the CPU use the same custom hexadecimal as the assembler (see convert_cycle_to_custom_hex):
+the first digit is the block/page number and the second digit is the cell within it, both starting at 1.
+- Instruction address 0x1c is block 1, instruction 12.
+- Data memory address 0x11 is the first cell, 0x1f the 15th, 0x21 the 16th, up to 0x4f for the 60th.
+'''
+
+INSTRUCTIONS_PER_BLOCK = 15
+PAGE_FRAMES = 2
+DATA_MEMORY_CELLS = 60
+WORD_MASK = 0xFF
+'''Registers and memory cells are 1 byte wide; arithmetic wraps around.'''
+
+DEFAULT_MAX_CYCLES = 10_000_000
+'''Guards against programs that never reach the end of their last block.'''
+
+def address_to_data_cell(address:int) -> int:
+    '''Converts a custom hex data memory address into a cell index (0-59). Returns -1 if the address has no cell.'''
+    high = address >> 4
+    low = address & 0xF
+    if high < 1 or low < 1:
+        return -1
+    cell = (high - 1)*15 + (low - 1)
+    return cell if cell < DATA_MEMORY_CELLS else -1
+
+def data_cell_to_address(cell:int) -> int:
+    '''Converts a cell index (0-59) into its custom hex data memory address.'''
+    return ((cell // 15) + 1) << 4 | ((cell % 15) + 1)
+
+DATA_CELL_OF_ADDRESS = [address_to_data_cell(address) for address in range(256)]
+'''Lookup table from every byte value to its data memory cell, -1 for addresses that have no cell.'''
+
+class SimulationResult:
+    '''SimulationResult : Class
+
+    Attributes:
+    registers:list -- final register values, index 0 is R1
+    memory:list -- final data memory values, index 0 is address 0x11
+    cycles:int -- number of instructions executed
+    page_loads:int -- number of times a block was loaded into a page frame
+    execution_counts:list -- number of times each instruction of the program was executed
+    taken_counts:list -- number of times each instruction was a branch that was taken, None if the engine doesn't record it
+    page_load_counts:list -- number of page loads made to run each instruction, None if the engine doesn't record it
+    '''
+    def __init__(self, registers:list, memory:list, cycles:int, page_loads:int, execution_counts:list, taken_counts:list=None,
+                 page_load_counts:list=None):
+        self.registers = registers
+        self.memory = memory
+        self.cycles = cycles
+        self.page_loads = page_loads
+        self.execution_counts = execution_counts
+        self.taken_counts = taken_counts
+        self.page_load_counts = page_load_counts
+
+    def register(self, register_number:int) -> int:
+        '''Returns the final value of register Rx.'''
+        return self.registers[register_number - 1]
+
+    def read_memory(self, address:int) -> int:
+        '''Returns the final value of the data memory cell at the given custom hex address.'''
+        cell = address_to_data_cell(address)
+        if cell == -1:
+            raise Exception(f"{hex(address)} is not a data memory address.")
+        return self.memory[cell]
+
+    def __str__(self):
+        registers = ", ".join(f"R{index+1}={value}" for index, value in enumerate(self.registers))
+        memory = ", ".join(f"{hex(data_cell_to_address(cell))}={value}" for cell, value in enumerate(self.memory) if value != 0)
+        return f"Cycles: {self.cycles}, Page loads: {self.page_loads}\nRegisters: {registers}\nMemory: {memory}"
+
+def read_machine_code_file(path:str) -> list:
+    '''Reads a binary (_converted.bin) or text (_converted.txt) machine code file into a list of instructions, each a list of 4 integers.'''
+    if is_binary_machine_code_file(path):
+        with MachineCodeFile(path) as machine_code_file:
+            return machine_code_file.to_list()
+    results = []
+    with open(path, 'r') as input_file:
+        for line in input_file:
+            line = line.strip()
+            if len(line) > 0:
+                parts = re.split(" ", line)[-4:]
+                try:
+                    results.append([int(part) for part in parts])
+                except ValueError:
+                    raise Exception("Machine code must be integers.")
+    return results
+
+def decode_program(machine_code:list) -> list:
+    '''Checks machine code instructions and converts them into tuples of (opcode, a, b, c).'''
+    program = []
+    for instruction_index, instruction in enumerate(machine_code):
+        if len(instruction) != 4:
+            raise Exception(f"Instruction {instruction_index+1} must have 4 parts.")
+        opcode, a, b, c = (int(part) for part in instruction)
+        if opcode not in OPCODES.values():
+            raise Exception(f"Instruction {instruction_index+1}: unknown opcode {opcode}.")
+        for part in (a, b, c):
+            if part < 0 or part > 15:
+                raise Exception(f"Instruction {instruction_index+1}: parts must be between 0 and 15.")
+        program.append((opcode, a, b, c))
+    return program
+
+def run(machine_code:list, registers:list=None, memory:list=None, max_cycles:int=DEFAULT_MAX_CYCLES) -> SimulationResult:
+    '''Runs machine code from the start of the first block until execution passes the end of the last block.
+    Optional registers (R1-R15) and memory (60 cells) give the starting state, all zeros otherwise.
+    Raises an exception if the program branches to an invalid address, accesses memory outside the 60 cells,
+    or runs for more than max_cycles instructions.
+    '''
+    program = decode_program(machine_code)
+    length = len(program)
+
+    #index 0 is unused so that register numbers can index the list directly
+    regs = [0] * (NUMBER_OF_REGISTERS + 1)
+    if registers is not None:
+        if len(registers) != NUMBER_OF_REGISTERS:
+            raise Exception(f"registers must contain {NUMBER_OF_REGISTERS} values.")
+        regs[1:] = [value & WORD_MASK for value in registers]
+    mem = [0] * DATA_MEMORY_CELLS
+    if memory is not None:
+        if len(memory) != DATA_MEMORY_CELLS:
+            raise Exception(f"memory must contain {DATA_MEMORY_CELLS} values.")
+        mem[:] = [value & WORD_MASK for value in memory]
+
+    counts = [0] * length
+    taken_counts = [0] * length
+    page_load_counts = [0] * length
+    cell_of = DATA_CELL_OF_ADDRESS
+    ADD, SUB, NOT, AND, OR = OPCODES["ADD"], OPCODES["SUB"], OPCODES["NOT"], OPCODES["AND"], OPCODES["OR"]
+    LS, RS, LD, LDI, STR = OPCODES["LS"], OPCODES["RS"], OPCODES["LD"], OPCODES["LDI"], OPCODES["STR"]
+    BRE, BRLT = OPCODES["BRE"], OPCODES["BRLT"]
+
+    #page frames hold block numbers (0-based), the block executed most recently is last
+    frames = []
+    page_loads = 0
+    index = 0
+    cycles = 0
+    #block that the instruction at index belongs to, and the index at which the next block starts
+    block = -1
+    block_end = 0
+
+    while index < length:
+        if index >= block_end or index < block_end - INSTRUCTIONS_PER_BLOCK:
+            #execution has moved to another block, load it into a page frame if it isn't in one
+            block = index // INSTRUCTIONS_PER_BLOCK
+            block_end = (block + 1) * INSTRUCTIONS_PER_BLOCK
+            if block not in frames:
+                page_loads += 1
+                page_load_counts[index] += 1
+                #with 2 frames, the frame that isn't currently executing is replaced
+                if len(frames) == PAGE_FRAMES:
+                    frames.pop(0)
+                frames.append(block)
+            elif frames[-1] != block:
+                frames.remove(block)
+                frames.append(block)
+        if cycles >= max_cycles:
+            raise Exception(f"Program did not finish within {max_cycles} cycles.")
+
+        opcode, a, b, c = program[index]
+        counts[index] += 1
+        cycles += 1
+        index += 1
+
+        if opcode == ADD:
+            regs[a] = (regs[b] + regs[c]) & 0xFF
+        elif opcode == LDI:
+            regs[a] = b << 4 | c
+        elif opcode == BRE or opcode == BRLT:
+            taken = regs[b] == regs[c] if opcode == BRE else regs[b] < regs[c]
+            if taken:
+                taken_counts[index - 1] += 1
+                target = regs[a]
+                target_block = (target >> 4) - 1
+                target_offset = (target & 0xF) - 1
+                if target_block < 0 or target_offset < 0:
+                    raise Exception(f"Instruction {index}: branch to invalid address {hex(target)}.")
+                index = target_block * INSTRUCTIONS_PER_BLOCK + target_offset
+        elif opcode == SUB:
+            regs[a] = (regs[b] - regs[c]) & 0xFF
+        elif opcode == STR:
+            cell = cell_of[regs[b]]
+            if cell < 0:
+                raise Exception(f"Instruction {index}: store to invalid address {hex(regs[b])}.")
+            mem[cell] = regs[a]
+        elif opcode == LD:
+            cell = cell_of[regs[b]]
+            if cell < 0:
+                raise Exception(f"Instruction {index}: load from invalid address {hex(regs[b])}.")
+            regs[a] = mem[cell]
+        elif opcode == AND:
+            regs[a] = regs[b] & regs[c]
+        elif opcode == OR:
+            regs[a] = regs[b] | regs[c]
+        elif opcode == LS:
+            regs[a] = (regs[b] << 1) & 0xFF
+        elif opcode == RS:
+            regs[a] = regs[b] >> 1
+        elif opcode == NOT:
+            regs[a] = ~regs[b] & 0xFF
+
+    return SimulationResult(registers=regs[1:], memory=mem, cycles=cycles, page_loads=page_loads, execution_counts=counts,
+                            taken_counts=taken_counts, page_load_counts=page_load_counts)
+
+def get_machine_code_path(filename:str) -> str:
+    '''Returns the path of the machine code file for a program: the binary file if the assembler has written one, otherwise the text file.'''
+    text_path = "programs/machine code/" + filename + "_converted.txt"
+    binary_path = get_binary_path(text_path)
+    return binary_path if os.path.isfile(binary_path) else text_path
+
+def run_file(filename:str, max_cycles:int=DEFAULT_MAX_CYCLES) -> SimulationResult:
+    '''Runs the machine code file for a program, as written by the assembler.'''
+    path = get_machine_code_path(filename)
+    if is_binary_machine_code_file(path):
+        #instructions are decoded straight from the mapped file
+        with MachineCodeFile(path) as machine_code_file:
+            return run(machine_code_file, max_cycles=max_cycles)
+    return run(read_machine_code_file(path), max_cycles=max_cycles)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a machine code program and prints the final register and memory state.")
+    parser.add_argument("filename", help="program name, reading programs/machine code/<filename>_converted.bin, or .txt if there is no .bin")
+    parser.add_argument("--max-cycles", type=int, default=DEFAULT_MAX_CYCLES)
+    args = parser.parse_args()
+
+    print(run_file(args.filename, max_cycles=args.max_cycles))
@@ -0,0 +1,215 @@
+import argparse
+import os
+import shutil
+import time
+
+from assembler import AssemblerOptions, add_arguments, assemble, format_machine_code, get_cache_key, get_options, get_output_paths, is_output_current
+from build_cache import BuildCache
+from machine_code_format import encode_machine_code, get_binary_path, read_machine_code
+from schematic_generator import generate_schematics, get_schematic_path
+
+'''Watches the programs folder and rebuilds a program's machine code and block schematics whenever it is saved,
+so that the assembler and schematic writer are only started once rather than for every change.
+Files are polled rather than watched with an operating system API, so nothing needs installing:
+- a program is rebuilt once its modification time and size have stayed the same for the debounce interval, so that an editor
+  writing a file in several steps causes one rebuild, not several
+- only outputs whose contents change are written: the machine code files are compared with what is already there,
+  and block schematics are skipped when the build cache shows their instructions haven't changed
+- with --worldedit, each schematic written is also copied into the given WorldEdit schematics folder, ready to paste
+'''
+
+DEFAULT_POLL_INTERVAL = 0.02
+DEFAULT_DEBOUNCE = 0.03
+
+def write_if_changed(path:str, contents:bytes) -> bool:
+    '''Writes contents to path unless the file already holds exactly that. Returns True if the file was written.'''
+    if os.path.isfile(path) and os.path.getsize(path) == len(contents):
+        with open(path, 'rb') as existing_file:
+            if existing_file.read() == contents:
+                return False
+    with open(path, 'wb') as output_file:
+        output_file.write(contents)
+    return True
+
+class BuildResult:
+    '''BuildResult : Class
+
+    Attributes:
+    name:str -- program that was built
+    seconds:float -- time from starting the build to all outputs being written
+    instruction_count:int -- number of machine code instructions, None if the machine code was already up to date
+    written_files:list -- paths of the outputs that were written
+    error:str -- message of the exception that stopped the build, empty on success
+    '''
+    def __init__(self, name:str):
+        self.name = name
+        self.seconds = 0.0
+        self.instruction_count = None
+        self.written_files = []
+        self.error = ""
+
+    def __str__(self):
+        if self.error:
+            return f"{self.name}: failed - {self.error}"
+        if len(self.written_files) == 0:
+            return f"{self.name}: unchanged ({self.seconds*1000:.1f} ms)"
+        return f"{self.name}: wrote {', '.join(self.written_files)} ({self.seconds*1000:.1f} ms)"
+
+class ProgramWatcher:
+    '''ProgramWatcher : Class
+    Rebuilds the programs in a folder when they change.
+
+    Attributes:
+    directory:str -- folder of .txt programs to watch
+    output_directory:str -- folder the machine code is written to (directory/machine code)
+    worldedit_directory:str -- folder that schematics are copied into, None to not copy them
+    options:AssemblerOptions -- passes to run when assembling
+    write_text:bool -- also write the _converted.txt machine code
+    debounce:float -- seconds a program must stay unchanged before it is rebuilt
+    cache:BuildCache -- build cache, kept in memory and saved after each build
+    built_signatures:dict -- program name : (modification time, size) of the file when it was last built
+    pending:dict -- program name : ((modification time, size), time the file was first seen like that) for changed programs
+    '''
+    def __init__(self, directory:str="programs", worldedit_directory:str=None, options:AssemblerOptions=None, write_text:bool=True,
+                 debounce:float=DEFAULT_DEBOUNCE, cache:BuildCache=None):
+        self.directory = directory
+        self.output_directory = os.path.join(directory, "machine code")
+        self.worldedit_directory = worldedit_directory
+        self.options = options if options is not None else AssemblerOptions()
+        self.write_text = write_text
+        self.debounce = debounce
+        self.cache = cache if cache is not None else BuildCache()
+        self.built_signatures = {}
+        self.pending = {}
+
+    def scan(self) -> dict:
+        '''Returns dict of program name : (modification time, size) for every .txt program in the folder.'''
+        signatures = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    stat = entry.stat()
+                    signatures[entry.name[:-len(".txt")]] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def poll(self, now:float=None) -> list:
+        '''Checks the folder for changes. Returns the names of changed programs that have stayed the same for the debounce interval.'''
+        now = now if now is not None else time.monotonic()
+        ready = []
+        signatures = self.scan()
+        for name, signature in signatures.items():
+            if self.built_signatures.get(name) == signature:
+                self.pending.pop(name, None)
+                continue
+            pending_signature, first_seen = self.pending.get(name, (None, now))
+            if pending_signature != signature:
+                #the file is still being written, wait until it stops changing
+                self.pending[name] = (signature, now)
+            elif now - first_seen >= self.debounce:
+                ready.append(name)
+        for name in list(self.built_signatures.keys()):
+            if name not in signatures:
+                self.built_signatures.pop(name)
+                self.pending.pop(name, None)
+        return sorted(ready)
+
+    def copy_to_worldedit(self, schematic_path:str) -> None:
+        '''Copies a schematic into the WorldEdit folder, if there is one.'''
+        if self.worldedit_directory is not None:
+            shutil.copyfile(schematic_path, os.path.join(self.worldedit_directory, os.path.basename(schematic_path)))
+
+    def build(self, name:str, signature:tuple=None, force:bool=False) -> BuildResult:
+        '''Assembles a program and generates its block schematics, writing only the outputs that have changed.
+        If force is True, the machine code and schematics are rebuilt even if the build cache shows they are up to date.
+        '''
+        result = BuildResult(name)
+        start = time.perf_counter()
+        try:
+            with open(os.path.join(self.directory, name + ".txt"), 'r') as input_file:
+                source = input_file.read()
+            output_path = os.path.join(self.output_directory, name + "_converted.txt")
+            output_paths = get_output_paths(output_path, self.write_text)
+            cache_key = get_cache_key(source, self.options)
+            if not force and is_output_current(self.cache, output_paths, cache_key):
+                instructions = read_machine_code(get_binary_path(output_path))
+            else:
+                machine_code = assemble(source, self.options)
+                instructions = machine_code.instructions
+                result.instruction_count = len(instructions)
+                os.makedirs(self.output_directory, exist_ok=True)
+                outputs = [encode_machine_code(instructions, machine_code.branch_labels)]
+                if self.write_text:
+                    outputs.append(format_machine_code(instructions).encode("utf-8"))
+                for path, contents in zip(output_paths, outputs):
+                    if write_if_changed(path, contents):
+                        result.written_files.append(path)
+                    self.cache.update(path, cache_key)
+
+            #schematics are written in this process, as starting worker processes would take longer than a few blocks
+            for block_index in generate_schematics(instructions, name, self.cache, force=force, workers=1):
+                schematic_path = get_schematic_path(name, block_index)
+                self.copy_to_worldedit(schematic_path)
+                result.written_files.append(schematic_path)
+            self.cache.save()
+        except Exception as e:
+            result.error = str(e)
+        self.built_signatures[name] = signature if signature is not None else self.scan().get(name)
+        self.pending.pop(name, None)
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def build_changed(self, now:float=None) -> list:
+        '''Polls for changes and builds every program that is ready. Returns list of BuildResult.'''
+        signatures = None
+        results = []
+        for name in self.poll(now):
+            signatures = signatures if signatures is not None else self.scan()
+            results.append(self.build(name, signatures.get(name)))
+        return results
+
+    def copy_missing_to_worldedit(self) -> None:
+        '''Copies any block schematics that aren't in the WorldEdit folder yet into it.'''
+        if self.worldedit_directory is None:
+            return
+        for schematic_path in self.cache.names_with_prefix("schematics/"):
+            if os.path.isfile(schematic_path) and not os.path.isfile(os.path.join(self.worldedit_directory, os.path.basename(schematic_path))):
+                self.copy_to_worldedit(schematic_path)
+
+    def build_all(self, force:bool=False) -> list:
+        '''Builds every program in the folder, skipping outputs that are up to date unless force is True. Returns list of BuildResult.'''
+        results = [self.build(name, signature, force) for name, signature in sorted(self.scan().items())]
+        self.copy_missing_to_worldedit()
+        return results
+
+    def watch(self, poll_interval:float=DEFAULT_POLL_INTERVAL, force:bool=False) -> None:
+        '''Builds every program (rebuilding everything if force is True), then rebuilds programs as they change until interrupted with Ctrl+C.'''
+        for result in self.build_all(force):
+            print(result)
+        print(f"Watching {self.directory} for changes, press Ctrl+C to stop.")
+        try:
+            while True:
+                for result in self.build_changed():
+                    print(result)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            self.cache.save()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds machine code and schematics for the programs in a folder whenever they are saved.")
+    parser.add_argument("--directory", default="programs", help="folder of .txt programs to watch")
+    parser.add_argument("--worldedit", metavar="FOLDER", help="also copy each schematic written into this WorldEdit schematics folder")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="seconds between checks for changes")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE, help="seconds a file must stay unchanged before it is rebuilt")
+    parser.add_argument("--once", action="store_true", help="build every out of date program and exit, rather than watching")
+    add_arguments(parser, batch=False, profile=False)
+    args = parser.parse_args()
+
+    if args.worldedit is not None and not os.path.isdir(args.worldedit):
+        parser.error(f"{args.worldedit} is not a folder")
+    options = get_options(args)
+    watcher = ProgramWatcher(args.directory, args.worldedit, options, write_text=not args.no_text, debounce=args.debounce)
+    if args.once:
+        for result in watcher.build_all(args.force):
+            print(result)
+    else:
+        watcher.watch(args.poll_interval, args.force)